@@ -0,0 +1,139 @@
+import logging
+import os
+import re
+import threading
+
+from PySide2 import QtCore
+
+from app.device_worker import DeviceWorker
+from connect.device_cache import DeviceInfoCache, DEFAULT_CACHE_FILE
+from connect.discovery import PortDiscovery
+from connect.interfaces.qt_serial import QtSerial
+
+
+class DeviceManagerSignals(QtCore.QObject):
+    device_added = QtCore.Signal(str)
+    device_removed = QtCore.Signal(str)
+    # Old and new port name, the worker of the device is kept
+    device_moved = QtCore.Signal(str, str)
+
+    # Discovery events come from its thread, they are handled in the GUI thread
+    port_event = QtCore.Signal(str, str)
+
+
+class DeviceManager(QtCore.QObject):
+    # One DeviceWorker per DK port, all on the shared thread pool.
+    # Workers are bound to their port and stay when the port disappears: a device
+    # that is reset or switched to the bootloader comes back on the same port.
+    # A device that comes back under another port name is matched by its UID: the
+    # worker started for the new port hands it over to the worker of the device.
+    # They are stopped by remove_device() or stop().
+
+    def __init__(self, threadpool: QtCore.QThreadPool, capture_file: str = None, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.threadpool = threadpool
+        self.capture_file = capture_file
+        self.workers = {}
+        # Workers look up the owner of a device from their threads
+        self._lock = threading.Lock()
+
+        self._signals = DeviceManagerSignals()
+        self._signals.port_event.connect(self._port_event_slot)
+
+        self.discovery = PortDiscovery(QtSerial())
+        self.discovery.add_listener(self._on_port_event)
+        self.info_cache = DeviceInfoCache(DEFAULT_CACHE_FILE)
+
+    def signals(self) -> DeviceManagerSignals:
+        return self._signals
+
+    def start(self):
+        self.discovery.start()
+
+    def stop(self):
+        self.discovery.stop()
+        for worker in self.workers.values():
+            worker.stop()
+
+    def port_names(self) -> list:
+        return list(self.workers)
+
+    def worker(self, port_name: str) -> DeviceWorker:
+        return self.workers.get(port_name)
+
+    def add_device(self, port_name: str) -> DeviceWorker:
+        if port_name in self.workers:
+            return self.workers[port_name]
+
+        logging.info('Starting device worker, port: {}'.format(port_name))
+        worker = DeviceWorker(port_name=port_name, discovery=self.discovery, info_cache=self.info_cache,
+                              find_owner=self._find_owner, capture_file=self._capture_file(port_name))
+        worker.signals().port_changed.connect(self._port_changed_slot)
+        with self._lock:
+            self.workers[port_name] = worker
+
+        # Workers run until they are stopped, every one needs its own thread
+        if self.threadpool.activeThreadCount() >= self.threadpool.maxThreadCount():
+            self.threadpool.setMaxThreadCount(self.threadpool.activeThreadCount() + 1)
+        self.threadpool.start(worker)
+
+        self.signals().device_added.emit(port_name)
+        return worker
+
+    def remove_device(self, port_name: str):
+        with self._lock:
+            worker = self.workers.pop(port_name, None)
+        if worker is None:
+            return
+
+        logging.info('Stopping device worker, port: {}'.format(port_name))
+        worker.stop()
+        self.signals().device_removed.emit(port_name)
+
+    def add_command(self, port_names: list, command_name: str, command_params=None):
+        # Fans the command out to the workers, each runs it on its own device
+        for port_name in port_names:
+            worker = self.workers.get(port_name)
+            if worker is not None:
+                worker.add_command(command_name, command_params)
+
+    def reset(self, port_names: list):
+        self.add_command(port_names, DeviceWorker.COMMAND_RESET)
+
+    def upload_firmware(self, port_names: list, path_to_firmware: str):
+        self.add_command(port_names, DeviceWorker.COMMAND_UPDATE_FIRMWARE, path_to_firmware)
+
+    def _capture_file(self, port_name: str):
+        # One capture per port, e.g. bench.dkcap -> bench-ttyACM0.dkcap
+        if not self.capture_file:
+            return None
+
+        base, ext = os.path.splitext(self.capture_file)
+        return '{}-{}{}'.format(base, re.sub(r'\W+', '_', os.path.basename(port_name)), ext)
+
+    def _find_owner(self, uid: bytes):
+        with self._lock:
+            workers = list(self.workers.values())
+
+        return next((worker for worker in workers if worker.uid == uid), None)
+
+    def _port_changed_slot(self, old_port_name: str, port_name: str):
+        # The worker that found the device on the new port has stopped, its row goes
+        with self._lock:
+            worker = self.workers.pop(old_port_name, None)
+            finder = self.workers.pop(port_name, None)
+            if worker is not None:
+                self.workers[port_name] = worker
+
+        if finder is not None and finder is not worker:
+            finder.stop()
+            self.signals().device_removed.emit(port_name)
+        if worker is not None:
+            self.signals().device_moved.emit(old_port_name, port_name)
+
+    def _on_port_event(self, event: str, port):
+        self.signals().port_event.emit(event, port.name)
+
+    def _port_event_slot(self, event: str, port_name: str):
+        if event == PortDiscovery.EVENT_ADD:
+            self.add_device(port_name)
@@ -0,0 +1,206 @@
+from PySide2 import QtCore
+from PySide2 import QtWidgets
+
+from app.device_manager import DeviceManager
+from app.device_widget import DeviceWidget
+from app.device_worker import DeviceWorker
+
+
+class DeviceRow(QtCore.QObject):
+    # Table row of one device, updated from its worker signals
+    def __init__(self, table: QtWidgets.QTableWidget, port_name: str, worker: DeviceWorker, *args, **kwargs):
+        super(DeviceRow, self).__init__(*args, **kwargs)
+        self.table = table
+        self.port_name = port_name
+
+        self.port_item = QtWidgets.QTableWidgetItem(port_name)
+        self.port_item.setFlags(QtCore.Qt.ItemIsEnabled | QtCore.Qt.ItemIsSelectable | QtCore.Qt.ItemIsUserCheckable)
+        self.port_item.setCheckState(QtCore.Qt.Unchecked)
+        self.progress_widget = QtWidgets.QProgressBar()
+
+        row = self.table.rowCount()
+        self.table.insertRow(row)
+        self.table.setItem(row, DeviceManagerWidget.COLUMN_PORT, self.port_item)
+        for column in (DeviceManagerWidget.COLUMN_NAME, DeviceManagerWidget.COLUMN_SOFTWARE,
+                       DeviceManagerWidget.COLUMN_STATUS, DeviceManagerWidget.COLUMN_MESSAGE):
+            item = QtWidgets.QTableWidgetItem('n/a' if column != DeviceManagerWidget.COLUMN_MESSAGE else '')
+            item.setFlags(QtCore.Qt.ItemIsEnabled | QtCore.Qt.ItemIsSelectable)
+            self.table.setItem(row, column, item)
+        self.table.setCellWidget(row, DeviceManagerWidget.COLUMN_PROGRESS, self.progress_widget)
+
+        worker.signals().status.connect(self._status_slot)
+        worker.signals().info.connect(self._info_slot)
+        worker.signals().disconnected.connect(self._disconnected_slot)
+        worker.signals().upload_firmware_progress.connect(self._progress_slot)
+        worker.signals().error_message.connect(self._error_message_slot)
+        worker.signals().info_message.connect(self._info_message_slot)
+
+    def is_checked(self) -> bool:
+        return self.port_item.checkState() == QtCore.Qt.Checked
+
+    def set_checked(self, checked: bool):
+        self.port_item.setCheckState(QtCore.Qt.Checked if checked else QtCore.Qt.Unchecked)
+
+    def set_port_name(self, port_name: str):
+        self.port_name = port_name
+        self.port_item.setText(port_name)
+
+    def remove(self):
+        self.table.removeRow(self.table.row(self.port_item))
+        # Deleting the row object disconnects it from the stopping worker
+        self.deleteLater()
+
+    def _set_text(self, column: int, text: str):
+        row = self.table.row(self.port_item)
+        if row >= 0:
+            self.table.item(row, column).setText(text)
+
+    def _status_slot(self, text):
+        self._set_text(DeviceManagerWidget.COLUMN_STATUS, text)
+
+    def _info_slot(self, info: dict):
+        self._set_text(DeviceManagerWidget.COLUMN_NAME, info.get('name', 'n/a'))
+        self._set_text(DeviceManagerWidget.COLUMN_SOFTWARE, info.get('soft_version', 'n/a'))
+
+    def _disconnected_slot(self):
+        self._set_text(DeviceManagerWidget.COLUMN_NAME, 'n/a')
+        self._set_text(DeviceManagerWidget.COLUMN_SOFTWARE, 'n/a')
+
+    def _progress_slot(self, text, percent):
+        self._set_text(DeviceManagerWidget.COLUMN_STATUS, text)
+        self.progress_widget.setValue(percent)
+
+    def _error_message_slot(self, text):
+        self._set_text(DeviceManagerWidget.COLUMN_MESSAGE, 'Error: {}'.format(text))
+
+    def _info_message_slot(self, text):
+        self._set_text(DeviceManagerWidget.COLUMN_MESSAGE, text)
+
+
+class DeviceManagerWidget(QtWidgets.QWidget):
+    COLUMN_PORT = 0
+    COLUMN_NAME = 1
+    COLUMN_SOFTWARE = 2
+    COLUMN_STATUS = 3
+    COLUMN_PROGRESS = 4
+    COLUMN_MESSAGE = 5
+
+    COLUMNS = ('Port', 'Name', 'Software', 'Status', 'Progress', 'Message')
+
+    def __init__(self, device_manager: DeviceManager, *args, **kwargs):
+        super(DeviceManagerWidget, self).__init__(*args, **kwargs)
+
+        self.manager = device_manager
+        self.rows = {}
+        self.device_widgets = {}
+
+        # Slots
+        self.manager.signals().device_added.connect(self._device_added_slot)
+        self.manager.signals().device_removed.connect(self._device_removed_slot)
+        self.manager.signals().device_moved.connect(self._device_moved_slot)
+
+        self.table = QtWidgets.QTableWidget(0, len(self.COLUMNS))
+        self.table.setHorizontalHeaderLabels(self.COLUMNS)
+        self.table.horizontalHeader().setStretchLastSection(True)
+        self.table.verticalHeader().setVisible(False)
+        self.table.setSelectionBehavior(QtWidgets.QAbstractItemView.SelectRows)
+
+        self.tabs = QtWidgets.QTabWidget()
+
+        self.select_all_check = QtWidgets.QCheckBox('Select all')
+        self.reset_button = QtWidgets.QPushButton('Reset selected')
+        self.firmware_button = QtWidgets.QPushButton('Upload firmware to selected...')
+        self.remove_button = QtWidgets.QPushButton('Remove selected')
+
+        self._make_widgets()
+
+        for port_name in self.manager.port_names():
+            self._device_added_slot(port_name)
+
+    def selected_ports(self) -> list:
+        return [port_name for port_name, row in self.rows.items() if row.is_checked()]
+
+    def _make_widgets(self):
+        self.command_layout = QtWidgets.QHBoxLayout()
+        self.command_layout.addWidget(self.select_all_check)
+        self.command_layout.addStretch(1)
+        self.command_layout.addWidget(self.reset_button)
+        self.command_layout.addWidget(self.firmware_button)
+        self.command_layout.addWidget(self.remove_button)
+
+        self.select_all_check.stateChanged.connect(self._select_all_click)
+        self.reset_button.clicked.connect(self._reset)
+        self.firmware_button.clicked.connect(self._firmware)
+        self.remove_button.clicked.connect(self._remove)
+        self.table.cellDoubleClicked.connect(self._show_device)
+
+        layout = QtWidgets.QVBoxLayout()
+        layout.addWidget(self.table, 1)
+        layout.addLayout(self.command_layout)
+        layout.addWidget(self.tabs, 1)
+
+        self.setLayout(layout)
+
+    def _selected_or_warn(self) -> list:
+        port_names = self.selected_ports()
+        if not port_names:
+            QtWidgets.QMessageBox.information(self, 'Info', 'No devices selected')
+        return port_names
+
+    def _select_all_click(self, state):
+        for row in self.rows.values():
+            row.set_checked(bool(state))
+
+    def _reset(self):
+        port_names = self._selected_or_warn()
+        if port_names:
+            self.manager.reset(port_names)
+
+    def _firmware(self):
+        port_names = self._selected_or_warn()
+        if not port_names:
+            return
+
+        path_to_firmware, _ = QtWidgets.QFileDialog.getOpenFileName(self, "Load Firmware", "~/", "DKF File (*.dkf)")
+        if path_to_firmware:
+            self.manager.upload_firmware(port_names, path_to_firmware)
+
+    def _remove(self):
+        for port_name in self._selected_or_warn():
+            self.manager.remove_device(port_name)
+
+    def _show_device(self, row, column):
+        port_name = self.table.item(row, self.COLUMN_PORT).text()
+        self.tabs.setCurrentWidget(self.device_widgets[port_name])
+
+    def _device_added_slot(self, port_name):
+        if port_name in self.rows:
+            return
+
+        worker = self.manager.worker(port_name)
+        self.rows[port_name] = DeviceRow(self.table, port_name, worker, self)
+
+        device_widget = DeviceWidget(worker, show_messages=False)
+        self.device_widgets[port_name] = device_widget
+        self.tabs.addTab(device_widget, port_name)
+
+    def _device_removed_slot(self, port_name):
+        row = self.rows.pop(port_name, None)
+        if row is not None:
+            row.remove()
+
+        device_widget = self.device_widgets.pop(port_name, None)
+        if device_widget is not None:
+            self.tabs.removeTab(self.tabs.indexOf(device_widget))
+            device_widget.deleteLater()
+
+    def _device_moved_slot(self, old_port_name, port_name):
+        row = self.rows.pop(old_port_name, None)
+        if row is not None:
+            row.set_port_name(port_name)
+            self.rows[port_name] = row
+
+        device_widget = self.device_widgets.pop(old_port_name, None)
+        if device_widget is not None:
+            self.device_widgets[port_name] = device_widget
+            self.tabs.setTabText(self.tabs.indexOf(device_widget), port_name)
@@ -93,10 +93,12 @@ class FirmwareWidget(QtWidgets.QWidget):
 
 
 class DeviceWidget(QtWidgets.QWidget):
-    def __init__(self, device_worker: DeviceWorker, *args, **kwargs):
+    def __init__(self, device_worker: DeviceWorker, *args, show_messages: bool = True, **kwargs):
         super(DeviceWidget, self).__init__(*args, **kwargs)
 
         self.worker = device_worker
+        # The device manager shows messages in its table instead of message boxes
+        self.show_messages = show_messages
 
         # Slots
         self.worker.signals().status.connect(self._status_slot)
@@ -170,7 +172,7 @@ class DeviceWidget(QtWidgets.QWidget):
         self.firmware_window.activate()
 
     def _activate_bootloader_click(self, state):
-        self.worker.activate_bootloader(bool(state))
+        self.worker.request_bootloader(bool(state))
 
     def _status_slot(self, text):
         self.status_label.setText(text)
@@ -199,8 +201,10 @@ class DeviceWidget(QtWidgets.QWidget):
         self.firmware_button.setEnabled(False)
 
     def _error_message_slot(self, text):
-        QtWidgets.QMessageBox.critical(self, 'Error', text)
+        if self.show_messages:
+            QtWidgets.QMessageBox.critical(self, 'Error', text)
 
     def _info_message_slot(self, text):
-        QtWidgets.QMessageBox.information(self, 'Info', text)
+        if self.show_messages:
+            QtWidgets.QMessageBox.information(self, 'Info', text)
 
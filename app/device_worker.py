@@ -7,6 +7,10 @@ from PySide2 import QtCore
 
 from connect import DKConnect, DKTankCommands, DKConnectError, DKConnectCommandsMismatch, DKConnectGotErrorCode, \
     DKConnectResponseTimoutError, DKBootloaderCommands, DEVICES_ESSENTIAL_LIST, build_commands, DEVICE_BOOTLOADER
+from connect.device_cache import DeviceInfoCache, DEFAULT_CACHE_FILE
+from connect.discovery import PortDiscovery
+from connect.interfaces.capture import RecordingSerial
+from connect.interfaces.qt_serial import QtSerial
 
 
 class DeviceWorkerSignals(QtCore.QObject):
@@ -14,6 +18,8 @@ class DeviceWorkerSignals(QtCore.QObject):
     info = QtCore.Signal(dict)
     connected = QtCore.Signal()
     disconnected = QtCore.Signal()
+    # Old and new port name of a device that enumerated again under another name
+    port_changed = QtCore.Signal(str, str)
 
     upload_firmware_progress = QtCore.Signal(str, int)
     upload_firmware_done = QtCore.Signal()
@@ -31,6 +37,7 @@ class DeviceWorker(QtCore.QRunnable):
     }
 
     COMMAND_RESET = 'reset'
+    COMMAND_ACTIVATE_BOOTLOADER = 'activate_bootloader'
     COMMAND_UPDATE_LICENSE_KEY = 'update_license_key'
     COMMAND_UPDATE_FIRMWARE = 'update_firmware'
 
@@ -40,23 +47,52 @@ class DeviceWorker(QtCore.QRunnable):
     PROGRESS_CHECK_FLASH = 'Check firmware...'
     PROGRESS_FIRMWARE_DONE = 'Upload done'
 
-    def __init__(self, *args, **kwargs):
+    PING_INTERVAL = 1.0
+    RECONNECT_INTERVAL = 1.0
+    REENUMERATE_TIMEOUT = 2.0
+
+    def __init__(self, *args, port_name: str = None, discovery: PortDiscovery = None, capture_file: str = None,
+                 info_cache: DeviceInfoCache = None, find_owner=None, **kwargs):
         super().__init__(*args, **kwargs)
         self._signals = DeviceWorkerSignals()
-
-        self.connect = DKConnect()
+        # With a port name the worker serves only this port, also after the device enumerates again.
+        # find_owner(uid) returns the worker of a device: a device that comes back under another
+        # port name, e.g. after the reset to the bootloader, is handed over to its worker.
+        self.port_name = port_name
+        self.find_owner = find_owner
+        self.uid = None
+
+        # Wire-level capture of the device traffic, for offline replay
+        self.capture = RecordingSerial(QtSerial(), capture_file) if capture_file else None
+        self.connect = DKConnect(self.capture or 'qt_serial')
+        # Workers of a device manager share its cache
+        self.connect.info_cache = info_cache or DeviceInfoCache(DEFAULT_CACHE_FILE)
+        # A discovery shared by several workers is started and stopped by its owner
+        self.is_own_discovery = discovery is None
+        self.discovery = discovery or PortDiscovery(self.connect.serial)
         self.is_activate_bootloader = False
         self.cmd = None
         self.queue = queue.Queue()
         self.ping_elapsed_time = 0
         self.is_stop = False
+        self.is_delta_upload = False
 
     def stop(self):
         self.is_stop = True
+        if self.is_own_discovery:
+            self.discovery.stop()
+        # Wake up the worker if it is waiting for commands
+        self.queue.put(None)
 
     def signals(self) -> DeviceWorkerSignals:
         return self._signals
 
+    def follow(self, port_name: str):
+        # Called from the thread of the worker that found the device on the new port
+        old_port_name, self.port_name = self.port_name, port_name
+        logging.info('Device moved from port {} to {}'.format(old_port_name, port_name))
+        self.signals().port_changed.emit(old_port_name, port_name)
+
     def activate_bootloader(self, activate: bool):
         self.is_activate_bootloader = activate
 
@@ -65,6 +101,11 @@ class DeviceWorker(QtCore.QRunnable):
 
         self._disconnected()
 
+    def request_bootloader(self, activate: bool):
+        # The port belongs to the worker thread, the reset is done there
+        self.is_activate_bootloader = activate
+        self.add_command(self.COMMAND_ACTIVATE_BOOTLOADER, activate)
+
     def is_bootloader(self) -> bool:
         return self.cmd.device_name() == DEVICE_BOOTLOADER
 
@@ -76,6 +117,9 @@ class DeviceWorker(QtCore.QRunnable):
 
     @QtCore.Slot()
     def run(self):
+        if self.is_own_discovery:
+            self.discovery.start()
+
         while True:
 
             try:
@@ -92,67 +136,90 @@ class DeviceWorker(QtCore.QRunnable):
             if self.is_stop:
                 break
 
+        if self.is_own_discovery:
+            self.discovery.stop()
         self.connect.disconnect()
+        if self.capture:
+            self.capture.stop()
 
     def _run_connected(self):
-        # Check that the device is connected
-        curr_time = time.time()
-        if curr_time - self.ping_elapsed_time > 1:
-            self.ping_elapsed_time = curr_time
-            self.cmd.ping()
-
-        # Run commands
-        if self.connect.is_connect() and not self.queue.empty():
-            self._run_command()
+        # Sleep until a command arrives, ping the device when idle
+        timeout = self.ping_elapsed_time + self.PING_INTERVAL - time.monotonic()
+        try:
+            command = self.queue.get(timeout=max(0.0, timeout))
+        except queue.Empty:
+            command = None
+        else:
+            self.queue.task_done()
 
-        time.sleep(0.1)
+        if command is not None:
+            self._run_command(command)
+        elif not self.is_stop:
+            self.ping_elapsed_time = time.monotonic()
+            self.cmd.ping()
 
     def _run_connecting(self):
         while True:
-            if self.connect.find_and_connect():
+            if self.discovery.find_and_connect(self.connect, self.port_name):
                 self.cmd = build_commands(self.connect)
+                if self._hand_over():
+                    return
 
                 if self.cmd.device_name() == DEVICE_BOOTLOADER:
 
                     if self.is_activate_bootloader:
                         self.cmd.confirm()
                     else:
+                        generation = self.discovery.generation()
                         self.cmd.go_to_app()
-                        time.sleep(2)
+                        self.discovery.wait_for_device(self.REENUMERATE_TIMEOUT, since=generation)
                         continue
 
                 self.signals().status.emit('Connected')
                 self.signals().connected.emit()
                 self._update_general_info()
+                self.ping_elapsed_time = time.monotonic()
                 return
 
             if self.is_stop:
                 return
 
             self.signals().status.emit('Wait for device...')
-            time.sleep(1)
+            self.discovery.wait_for_device(self.RECONNECT_INTERVAL)
+
+    def _hand_over(self) -> bool:
+        # The device of another worker is left to it before anything is sent, that worker
+        # may be uploading firmware to the bootloader
+        uid = self.cmd.get_uid()
+        owner = self.find_owner(uid) if self.find_owner else None
+        if owner is None or owner is self:
+            self.uid = uid
+            return False
+
+        self.connect.disconnect()
+        self.stop()
+        owner.follow(self.port_name)
+        return True
 
     def _update_general_info(self):
+        general_info = self.cmd.get_general_info()
         info = {
-            'name': self.cmd.get_name(),
-            'uid': self.cmd.get_uid().hex(),
-            'soft_version': '.'.join(str(x) for x in self.cmd.get_software_version()),
+            'name': general_info['name'],
+            'uid': general_info['uid'].hex(),
+            'soft_version': '.'.join(str(x) for x in general_info['software_version']),
         }
 
         if self.is_essential():
-            info['hard_version'] = '.'.join(str(x) for x in self.cmd.get_hardware_version())
-            info['uid'] = self.cmd.get_uid().hex()
-            info['key'] = self.cmd.get_license_key().hex()
-            info['license'] = self.LICENSE_LIST.get(self.cmd.get_access_level(), 'unknown')
+            info['hard_version'] = '.'.join(str(x) for x in general_info['hardware_version'])
+            info['key'] = general_info['license_key'].hex()
+            info['license'] = self.LICENSE_LIST.get(general_info['access_level'], 'unknown')
 
         self.signals().info.emit(info)
 
     def _disconnected(self):
         self.signals().disconnected.emit()
 
-    def _run_command(self):
-        command = self.queue.get(block=False, timeout=None)
-        self.queue.task_done()
+    def _run_command(self, command):
         command_name, command_params = command
 
         try:
@@ -160,6 +227,8 @@ class DeviceWorker(QtCore.QRunnable):
                 self.cmd.system_reset()
                 time.sleep(1)
                 self._disconnected()
+            elif command_name == self.COMMAND_ACTIVATE_BOOTLOADER:
+                self.activate_bootloader(command_params)
             elif command_name == self.COMMAND_UPDATE_LICENSE_KEY:
                 self._update_license(command_params)
             elif command_name == self.COMMAND_UPDATE_FIRMWARE:
@@ -187,26 +256,31 @@ class DeviceWorker(QtCore.QRunnable):
 
         if not self.is_bootloader():
             logging.info('Reset to bootloader')
+            generation = self.discovery.generation()
             self.cmd.system_reset()
             self._disconnected()
-
-            time.sleep(1)
             self.signals().upload_firmware_progress.emit(self.PROGRESS_ACTIVATE_BOOTLOADER, 33)
 
-            time.sleep(1)
+            # Continue as soon as the bootloader port appears
+            self.discovery.wait_for_device(self.REENUMERATE_TIMEOUT, since=generation)
             self.signals().upload_firmware_progress.emit(self.PROGRESS_ACTIVATE_BOOTLOADER, 66)
 
             self.activate_bootloader(True)
             logging.info('Connecting to bootloader')
             self._run_connecting()
 
-        logging.info('Erasing flash')
-        self.signals().upload_firmware_progress.emit(self.PROGRESS_ERASE_FLASH, 0)
-        self.cmd.flash_erase()
+        if self.is_delta_upload:
+            logging.info('Writing changed regions to flash')
+            self.signals().upload_firmware_progress.emit(self.PROGRESS_WRITE_FLASH, 0)
+            gen = self.cmd.flash_write_delta_async(path_to_firmware)
+        else:
+            logging.info('Erasing flash')
+            self.signals().upload_firmware_progress.emit(self.PROGRESS_ERASE_FLASH, 0)
+            self.cmd.flash_erase()
 
-        logging.info('Writing to flash')
-        self.signals().upload_firmware_progress.emit(self.PROGRESS_WRITE_FLASH, 0)
-        gen = self.cmd.flash_write_async(path_to_firmware)
+            logging.info('Writing to flash')
+            self.signals().upload_firmware_progress.emit(self.PROGRESS_WRITE_FLASH, 0)
+            gen = self.cmd.flash_write_async(path_to_firmware)
 
         try:
             while True:
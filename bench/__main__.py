@@ -0,0 +1,57 @@
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import logging
+import platform
+import sys
+
+from bench import protocol
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m bench', description='DK protocol benchmarks')
+    parser.add_argument('--latency', type=float, default=0.001, help='simulated link latency, seconds')
+    parser.add_argument('--bandwidth', type=float, default=None, help='simulated link bandwidth, bytes per second')
+    parser.add_argument('--output', default=None, help='JSON file, stdout when omitted')
+    parser.add_argument('--quick', action='store_true', help='smaller payloads and fewer iterations')
+    parser.add_argument('--capture', default=None, help='also decode the device traffic of a capture file')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+
+    transport = {'latency': args.latency, 'bandwidth': args.bandwidth}
+    scale = 8 if args.quick else 1
+
+    # Upload helpers print progress, keep stdout clean for JSON
+    with contextlib.redirect_stdout(io.StringIO()):
+        results = {
+            'crc': protocol.bench_crc(),
+            'frames': protocol.bench_frames(),
+            'round_trip': protocol.bench_round_trip(500 // scale, **transport),
+            'firmware_upload': protocol.bench_firmware_upload(64 * 1024 // scale, **transport),
+            'sound_upload': protocol.bench_sound_upload(128 * 1024 // scale, **transport),
+            'param_sweep': protocol.bench_param_sweep(**transport),
+        }
+        if args.capture:
+            results['capture'] = protocol.bench_capture(args.capture)
+
+    report = {
+        'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'transport': dict(transport, name='simulator'),
+        'results': results,
+    }
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(text)
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,182 @@
+import hashlib
+import os
+import tempfile
+import time
+
+from connect import DKConnect, build_commands
+from connect import crc
+from connect.frame import FrameCrcError, FrameDecoder, encode_frame
+from connect.interfaces.capture import DIRECTION_RX, read_capture
+from connect.interfaces.simulator import SimulatorSerial
+from connect.simulator import DeviceSimulator
+from connect.bootloader import DKBootloaderCommands
+
+
+def percentile(values: list, percent: float) -> float:
+    values = sorted(values)
+    if not values:
+        return 0.0
+
+    index = min(len(values) - 1, max(0, int(round(percent / 100 * (len(values) - 1)))))
+    return values[index]
+
+
+def latency_stats(latencies: list) -> dict:
+    return {
+        'count': len(latencies),
+        'min_ms': min(latencies) * 1000,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p90_ms': percentile(latencies, 90) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'max_ms': max(latencies) * 1000,
+    }
+
+
+def make_connect(device=None, **transport) -> DKConnect:
+    serial = SimulatorSerial([device or DeviceSimulator()], **transport)
+    connect = DKConnect(serial)
+    if not connect.find_and_connect():
+        raise RuntimeError('Simulator is not connected')
+    return connect
+
+
+def bench_crc(size=64 * 1024) -> dict:
+    data = os.urandom(size)
+    result = {}
+    for name, engine in crc.ENGINES.items():
+        # The reference implementation is too slow for the full buffer
+        sample = data if name != 'bitwise' else data[:1024]
+        start = time.perf_counter()
+        engine(sample)
+        elapsed = time.perf_counter() - start
+        result[name] = {'mb_per_s': len(sample) / elapsed / 1e6}
+
+    result['selected'] = crc.engine_name()
+    return result
+
+
+def bench_frames(count=2000, data_size=64) -> dict:
+    data = os.urandom(data_size)
+
+    start = time.perf_counter()
+    packages = [encode_frame(1, data) for _ in range(count)]
+    encode_time = time.perf_counter() - start
+
+    stream = b''.join(packages)
+    decoder = FrameDecoder()
+    start = time.perf_counter()
+    for pos in range(0, len(stream), 512):
+        decoder.feed(stream[pos:pos + 512])
+        for _ in decoder.frames():
+            pass
+    decode_time = time.perf_counter() - start
+
+    return {
+        'data_size': data_size,
+        'encode_frames_per_s': count / encode_time,
+        'decode_frames_per_s': count / decode_time,
+    }
+
+
+def bench_round_trip(count=500, **transport) -> dict:
+    connect = make_connect(**transport)
+    cmd = build_commands(connect)
+    latencies = []
+    for _ in range(count):
+        start = time.perf_counter()
+        cmd.ping()
+        latencies.append(time.perf_counter() - start)
+
+    return latency_stats(latencies)
+
+
+def bench_firmware_upload(image_size=64 * 1024, block_sizes=(16, 64, 256, 1024), windows=(1, 8), **transport) -> list:
+    image = os.urandom(image_size)
+    result = []
+    with tempfile.TemporaryDirectory() as temp_dir:
+        file_name = os.path.join(temp_dir, 'firmware.dkf')
+        with open(file_name, 'wb') as firmware_file:
+            firmware_file.write(len(image).to_bytes(4, byteorder='little'))
+            firmware_file.write(hashlib.md5(image).digest())
+            firmware_file.write(image)
+
+        for block_size in block_sizes:
+            for window in windows:
+                # Without position echo the upload keeps one frame in flight whatever the window
+                device = DeviceSimulator(DKBootloaderCommands.DEVICE_NAME, echo_position=True)
+                cmd = build_commands(make_connect(device, **transport))
+                cmd.flash_erase()
+
+                start = time.perf_counter()
+                for _ in cmd.flash_write_async(file_name, window=window, block_size=block_size):
+                    pass
+                elapsed = time.perf_counter() - start
+
+                result.append({
+                    'block_size': block_size,
+                    'window': window,
+                    'seconds': elapsed,
+                    'kb_per_s': image_size / elapsed / 1024,
+                    'verified': cmd.flash_check(file_name),
+                })
+
+    return result
+
+
+def bench_sound_upload(sound_size=128 * 1024, block_sizes=(32, 256, 1024), **transport) -> list:
+    result = []
+    with tempfile.TemporaryDirectory() as temp_dir:
+        file_name = os.path.join(temp_dir, 'sound.wav')
+        with open(file_name, 'wb') as sound_file:
+            sound_file.write(os.urandom(sound_size))
+
+        for block_size in block_sizes:
+            cmd = build_commands(make_connect(DeviceSimulator(echo_position=True), **transport))
+            start = time.perf_counter()
+            cmd.write_sound_file(0, file_name, 1, block_size=block_size)
+            elapsed = time.perf_counter() - start
+            result.append({'block_size': block_size, 'seconds': elapsed, 'kb_per_s': sound_size / elapsed / 1024})
+
+    return result
+
+
+def bench_param_sweep(count=32, **transport) -> dict:
+    cmd = build_commands(make_connect(**transport))
+    start = time.perf_counter()
+    for number in range(count):
+        cmd.get_param(number)
+    elapsed = time.perf_counter() - start
+    return {'params': count, 'seconds': elapsed}
+
+
+def bench_capture(file_name: str, repeat=10) -> dict:
+    # Decoder throughput on recorded device traffic, chunked as it was read
+    _, records = read_capture(file_name)
+    chunks = [record.data for record in records if record.direction == DIRECTION_RX]
+    size = sum(len(chunk) for chunk in chunks)
+
+    frames = 0
+    crc_errors = 0
+    start = time.perf_counter()
+    for _ in range(repeat):
+        decoder = FrameDecoder()
+        for chunk in chunks:
+            decoder.feed(chunk)
+            while True:
+                try:
+                    frame = decoder.next_frame()
+                except FrameCrcError:
+                    crc_errors += 1
+                    continue
+                if frame is None:
+                    break
+                frames += 1
+    decode_time = time.perf_counter() - start
+
+    return {
+        'rx_bytes': size,
+        'rx_frames': frames // repeat,
+        'crc_errors': crc_errors // repeat,
+        'decode_mb_per_s': size * repeat / decode_time / 1e6 if decode_time else 0.0,
+        'decode_frames_per_s': frames / decode_time if decode_time else 0.0,
+    }
@@ -1,4 +1,5 @@
-from .connect import DKConnect, DKConnectError, DKConnectResponseTimoutError, DKConnectCommandsMismatch, DKConnectGotErrorCode
+from .connect import DKConnect, DKConnectError, DKConnectResponseTimoutError, DKConnectCommandsMismatch, DKConnectGotErrorCode, \
+    DKConnectCrcError
 from .tank import DKTankCommands
 from .unit import DKUnitCommands
 from .bootloader import DKBootloaderCommands
@@ -0,0 +1,530 @@
+import asyncio
+import hashlib
+import logging
+from collections import deque
+from typing import Union
+
+from .bootloader import DKBootloaderCommands, FirmwareImage, ERASE_TIMEOUT, UPLOAD_ATTEMPTS, UPLOAD_WINDOW
+from .common import DKCommonCommands, SoundInfo
+from .commands import DKCommands, DKGeneralCommands
+from .connect import DKConnect, DKConnectError, DKConnectResponseTimoutError, DKConnectCommandsMismatch, \
+    DKConnectDisconnectedError, DKConnectGotErrorCode, DKConnectCrcError, make_serial
+from .frame import FrameCrcError, FrameDecoder, encode_frame
+from .tank import DKTankCommands
+from .unit import DKUnitCommands
+from .utils import bytes_to_uint, int32_to_bytes
+
+
+POLL_INTERVAL = 0.001
+
+
+class _Request:
+    # echo is the data the answer must carry, e.g. the echoed write position
+    def __init__(self, command: int, future: asyncio.Future, echo: bytes = None, is_resync: bool = False):
+        self.command = command
+        self.future = future
+        self.echo = echo
+        self.is_resync = is_resync
+
+
+class AsyncDKConnect:
+    # asyncio version of DKConnect. Requests may be issued concurrently: the
+    # device answers in order, so every response is matched to the oldest
+    # pending request with the same command. Requests skipped by a response
+    # can no longer be answered and fail with a timeout.
+    # A request that times out is removed and the link is resynced: until the echo
+    # of a fresh token comes, answers are matched only to the requests sent before
+    # it, so a late answer is never taken by a later request of its command.
+
+    COMMAND_ECHO = DKConnect.COMMAND_ECHO
+    COMMAND_GET_NAME = DKConnect.COMMAND_GET_NAME
+    COMMAND_ERROR = DKConnect.COMMAND_ERROR
+
+    DK_VID = DKConnect.DK_VID
+    DK_PID = DKConnect.DK_PID
+
+    def __init__(self, serial_class='py_serial', default_timeout=1.0):
+        self.serial = make_serial(serial_class)
+
+        self._is_connect = False
+        self._device_name = None
+        self._default_timeout = default_timeout
+        self._decoder = FrameDecoder()
+        self._pending = deque()
+        self._resync_token = 0
+        self._reader_fd = None
+        self._poll_task = None
+
+    def is_connect(self):
+        return self._is_connect
+
+    def device_name(self):
+        return self._device_name
+
+    async def find_and_connect(self) -> bool:
+        loop = asyncio.get_running_loop()
+        ports = await loop.run_in_executor(None, self.serial.get_devices)
+        for port in ports:
+            if not DKConnect.is_dk_port(port):
+                continue
+
+            if await self.connect_port(port):
+                return True
+
+        return False
+
+    async def connect_port(self, port) -> bool:
+        loop = asyncio.get_running_loop()
+        # Serial read timeout 0: reads never block the event loop
+        if not await loop.run_in_executor(None, self.serial.connect, port.port_obj, 0):
+            logging.info('Connecting error, vid({}), pid({})'.format(port.vid, port.pid))
+            return False
+
+        self._decoder.reset()
+        self._is_connect = True
+        self._start_reader()
+
+        try:
+            data = await self.exchange(self.COMMAND_GET_NAME, None)
+            self._device_name = data.decode('latin-1')
+        except DKConnectError:
+            logging.info('Get device name error, vid({}), pid({})'.format(port.vid, port.pid), exc_info=True)
+            await self.disconnect()
+            return False
+
+        logging.info('Connected, device_name({}), vid({}), pid({})'.format(self._device_name, port.vid, port.pid))
+        return True
+
+    async def disconnect(self):
+        logging.info('Disconnecting')
+        self._is_connect = False
+        self._stop_reader()
+        self._fail_pending(DKConnectDisconnectedError())
+        self.serial.close()
+
+    def send(self, command: int, data: Union[bytes, None], echo: bytes = None) -> asyncio.Future:
+        if not self.is_connect():
+            raise DKConnectDisconnectedError
+
+        future = asyncio.get_running_loop().create_future()
+        self._send_request(_Request(command, future, echo), data)
+        return future
+
+    async def receive(self, future: asyncio.Future, timeout: float = None) -> (int, bytes):
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), timeout or self._default_timeout)
+        except asyncio.TimeoutError:
+            self._abandon(future)
+            raise DKConnectResponseTimoutError
+        except asyncio.CancelledError:
+            self._abandon(future)
+            raise
+
+    async def exchange(self, command: int, data: Union[bytes, None] = None, retry=0, is_silent=False,
+                       timeout=None, echo: bytes = None) -> bytes:
+        if not self.is_connect():
+            raise DKConnectDisconnectedError
+
+        tries = 0
+        receive_command, receive_data = None, None
+        exchange_exception = None
+        while True:
+            tries += 1
+
+            if tries > retry + 1:
+                raise exchange_exception
+
+            if tries > 1:
+                logging.warning("Exchange error, repeat. Attempt number: {}".format(tries))
+
+            try:
+                future = self.send(command, data, echo)
+                receive_command, receive_data = await self.receive(future, timeout)
+            except DKConnectError as exc:
+                exchange_exception = exc
+                continue
+
+            break
+
+        if receive_command == self.COMMAND_ERROR:
+            logging.warning("Received error: {}".format(bytes_to_uint(receive_data)))
+
+            if not is_silent:
+                raise DKConnectGotErrorCode(bytes_to_uint(receive_data))
+
+            return None
+
+        if receive_command != command and not is_silent:
+            logging.warning("Mismatch commands. Expected: {}, received: {}".format(command, receive_command))
+            raise DKConnectCommandsMismatch(command, receive_command)
+
+        return receive_data
+
+    def _send_request(self, request: _Request, data):
+        self._pending.append(request)
+
+        try:
+            self.serial.write(encode_frame(request.command, data))
+        except OSError:
+            self._is_connect = False
+            self._stop_reader()
+            self._fail_pending(DKConnectError())
+            raise DKConnectError
+
+    def _abandon(self, future: asyncio.Future):
+        future.cancel()
+        for request in self._pending:
+            if request.future is future:
+                self._pending.remove(request)
+                self._resync()
+                return
+
+    def _resync(self):
+        if not self.is_connect():
+            return
+
+        loop = asyncio.get_running_loop()
+        self._resync_token = (self._resync_token + 1) & 0xFFFFFFFF
+        token = int32_to_bytes(self._resync_token)
+        request = _Request(self.COMMAND_ECHO, loop.create_future(), token, is_resync=True)
+        self._send_request(request, token)
+        loop.call_later(self._default_timeout, self._resync_expired, request)
+
+    def _resync_expired(self, request: _Request):
+        # The echo is due, a frame still waited on has a garbage size field.
+        # It is skipped and a new token is sent.
+        if request in self._pending:
+            self._pending.remove(request)
+            self._decoder.resync()
+            self._decode()
+            try:
+                self._resync()
+            except DKConnectError:
+                pass
+
+    def _start_reader(self):
+        loop = asyncio.get_running_loop()
+        try:
+            self._reader_fd = self.serial.fileno()
+            loop.add_reader(self._reader_fd, self._on_readable)
+        except (AttributeError, OSError, NotImplementedError, ValueError):
+            # No selectable handle (Windows, simulator): poll the driver buffer
+            self._reader_fd = None
+            self._poll_task = loop.create_task(self._poll())
+
+    def _stop_reader(self):
+        if self._reader_fd is not None:
+            asyncio.get_running_loop().remove_reader(self._reader_fd)
+            self._reader_fd = None
+
+        if self._poll_task:
+            self._poll_task.cancel()
+            self._poll_task = None
+
+    async def _poll(self):
+        while True:
+            self._on_readable()
+            await asyncio.sleep(POLL_INTERVAL)
+
+    def _on_readable(self):
+        try:
+            data = self.serial.read_nowait()
+        except (IOError, OSError):
+            self._is_connect = False
+            self._stop_reader()
+            self._fail_pending(DKConnectError())
+            return
+
+        if not data:
+            return
+
+        self._decoder.feed(data)
+        self._decode()
+
+    def _decode(self):
+        while True:
+            try:
+                frame = self._decoder.next_frame()
+            except FrameCrcError as exc:
+                logging.warning('CRC mismatch, command: {}'.format(exc.command))
+                self._resolve(exc.command, exception=DKConnectCrcError())
+                continue
+
+            if frame is None:
+                return
+
+            self._resolve(frame[0], frame)
+
+    def _resolve(self, command: int, frame=None, exception=None):
+        # An error response or a damaged frame belongs to the oldest request.
+        # Requests after a pending resync are answered after its echo.
+        pending = self._pending
+        end = next((i + 1 for i, request in enumerate(pending) if request.is_resync), len(pending))
+        if command == self.COMMAND_ERROR or exception:
+            index = 0 if end and not pending[0].is_resync else None
+        else:
+            index = next((i for i in range(end) if pending[i].command == command and
+                          (pending[i].echo is None or pending[i].echo == frame[1])), None)
+
+        if index is None:
+            logging.warning('Unexpected response, command: {}'.format(command))
+            return
+
+        for _ in range(index):
+            skipped = self._pending.popleft()
+            if not skipped.future.done():
+                skipped.future.set_exception(DKConnectResponseTimoutError())
+
+        request = self._pending.popleft()
+        if request.future.done():
+            return
+
+        if exception:
+            request.future.set_exception(exception)
+        else:
+            request.future.set_result(frame)
+
+    def _fail_pending(self, exception: Exception):
+        while self._pending:
+            request = self._pending.popleft()
+            if not request.future.done():
+                request.future.set_exception(exception)
+
+
+class AsyncDKCommands:
+    DEVICE_NAME = None
+    SCHEMA = DKCommands.SCHEMA
+
+    def __init__(self, connect: AsyncDKConnect):
+        self.connect = connect
+
+    def device_name(self) -> str:
+        return self.DEVICE_NAME
+
+    async def request(self, command: int, *values, payload=None, retry=0, is_silent=False, timeout=None,
+                      echo=None):
+        spec = self.SCHEMA[command]
+        data = spec.encode(*values)
+        if payload is not None:
+            data = (data, payload)
+        data = await self.connect.exchange(command, data, retry=retry, is_silent=is_silent, timeout=timeout,
+                                           echo=echo)
+        return spec.decode(data)
+
+
+class AsyncDKGeneralCommands(AsyncDKCommands):
+    COMMAND_ECHO = DKGeneralCommands.COMMAND_ECHO
+    COMMAND_GET_NAME = DKGeneralCommands.COMMAND_GET_NAME
+    COMMAND_GET_UID = DKGeneralCommands.COMMAND_GET_UID
+    COMMAND_GET_SOFTWARE_VERSION = DKGeneralCommands.COMMAND_GET_SOFTWARE_VERSION
+    COMMAND_GET_HARDWARE_VERSION = DKGeneralCommands.COMMAND_GET_HARDWARE_VERSION
+    COMMAND_SYSTEM_RESET = DKGeneralCommands.COMMAND_SYSTEM_RESET
+    COMMAND_BLOCK_MODE_BEGIN = DKGeneralCommands.COMMAND_BLOCK_MODE_BEGIN
+    COMMAND_BLOCK_MODE_END = DKGeneralCommands.COMMAND_BLOCK_MODE_END
+
+    SCHEMA = DKGeneralCommands.SCHEMA
+
+    async def ping(self) -> bool:
+        data = await self.request(self.COMMAND_ECHO, b'ping')
+        return data == b'ping'
+
+    async def get_name(self) -> str:
+        return DKGeneralCommands.parse_name(await self.request(self.COMMAND_GET_NAME))
+
+    async def get_uid(self) -> bytes:
+        return await self.request(self.COMMAND_GET_UID)
+
+    async def get_software_version(self) -> (int, int, int):
+        return await self.request(self.COMMAND_GET_SOFTWARE_VERSION)
+
+    async def get_hardware_version(self) -> (int, int, int, int):
+        return await self.request(self.COMMAND_GET_HARDWARE_VERSION)
+
+    async def system_reset(self):
+        self.connect.send(self.COMMAND_SYSTEM_RESET, None).cancel()
+        await self.connect.disconnect()
+
+    async def block_mode_begin(self) -> None:
+        await self.request(self.COMMAND_BLOCK_MODE_BEGIN)
+
+    async def block_mode_end(self) -> None:
+        await self.request(self.COMMAND_BLOCK_MODE_END)
+
+
+class AsyncDKCommonCommands(AsyncDKGeneralCommands):
+    COMMAND_GET_LICENSE_KEY = DKCommonCommands.COMMAND_GET_LICENSE_KEY
+    COMMAND_GET_ACCESS_LEVEL = DKCommonCommands.COMMAND_GET_ACCESS_LEVEL
+    COMMAND_GET_FREE_MEM = DKCommonCommands.COMMAND_GET_FREE_MEM
+    COMMAND_GET_VOLTAGE_BATTERY = DKCommonCommands.COMMAND_GET_VOLTAGE_BATTERY
+    COMMAND_GET_VOLTAGE_5V = DKCommonCommands.COMMAND_GET_VOLTAGE_5V
+    COMMAND_GET_RC_RECEIVER_VALUE = DKCommonCommands.COMMAND_GET_RC_RECEIVER_VALUE
+    COMMAND_GET_PLAYER_PERFORMANCE = DKCommonCommands.COMMAND_GET_PLAYER_PERFORMANCE
+    COMMAND_WRITE_LICENSE_KEY = DKCommonCommands.COMMAND_WRITE_LICENSE_KEY
+    COMMAND_GET_PARAM = DKCommonCommands.COMMAND_GET_PARAM
+    COMMAND_SET_PARAM = DKCommonCommands.COMMAND_SET_PARAM
+    COMMAND_SAVE_PARAMS = DKCommonCommands.COMMAND_SAVE_PARAMS
+    COMMAND_RESET_PARAMS = DKCommonCommands.COMMAND_RESET_PARAMS
+    COMMAND_GET_SOUND_INFO = DKCommonCommands.COMMAND_GET_SOUND_INFO
+    COMMAND_READ_FLASH = DKCommonCommands.COMMAND_READ_FLASH
+    COMMAND_GET_RDP_LEVEL = DKCommonCommands.COMMAND_GET_RDP_LEVEL
+
+    SCHEMA = DKCommonCommands.SCHEMA
+
+    async def get_license_key(self) -> bytes:
+        return await self.request(self.COMMAND_GET_LICENSE_KEY)
+
+    async def get_access_level(self) -> int:
+        return await self.request(self.COMMAND_GET_ACCESS_LEVEL)
+
+    async def get_free_mem(self) -> int:
+        return await self.request(self.COMMAND_GET_FREE_MEM)
+
+    async def get_voltage_battery(self) -> float:
+        return await self.request(self.COMMAND_GET_VOLTAGE_BATTERY)
+
+    async def get_voltage_5v(self) -> float:
+        return await self.request(self.COMMAND_GET_VOLTAGE_5V)
+
+    async def get_rc_receiver_value(self, channel: int) -> int:
+        return await self.request(self.COMMAND_GET_RC_RECEIVER_VALUE, channel)
+
+    async def get_player_performance(self):
+        return await self.request(self.COMMAND_GET_PLAYER_PERFORMANCE)
+
+    async def get_param(self, number: int) -> Union[int, float]:
+        return DKCommonCommands.decode_param(await self.request(self.COMMAND_GET_PARAM, number))
+
+    async def set_param(self, number: int, value: Union[int, float, bool], size: int = None):
+        await self.request(self.COMMAND_SET_PARAM, DKCommonCommands.encode_param(number, value, size))
+
+    async def save_params(self):
+        await self.request(self.COMMAND_SAVE_PARAMS)
+
+    async def reset_params(self):
+        await self.request(self.COMMAND_RESET_PARAMS)
+
+    async def write_license_key(self, key: bytes):
+        return await self.request(self.COMMAND_WRITE_LICENSE_KEY, key)
+
+    async def get_sound_info(self, number: int) -> Union[SoundInfo, None]:
+        values = await self.request(self.COMMAND_GET_SOUND_INFO, number, is_silent=True)
+        if values is None:
+            return None
+
+        return SoundInfo(*values)
+
+    async def read_flash(self, addr=0, length=256):
+        return await self.request(self.COMMAND_READ_FLASH, addr, length)
+
+    async def get_rdp_level(self) -> int:
+        return await self.request(self.COMMAND_GET_RDP_LEVEL)
+
+
+class AsyncDKTankCommands(AsyncDKCommonCommands):
+    DEVICE_NAME = DKTankCommands.DEVICE_NAME
+
+
+class AsyncDKUnitCommands(AsyncDKCommonCommands):
+    DEVICE_NAME = DKUnitCommands.DEVICE_NAME
+
+
+class AsyncDKBootloaderCommands(AsyncDKGeneralCommands):
+    DEVICE_NAME = DKBootloaderCommands.DEVICE_NAME
+
+    COMMAND_CONFIRM_BOOTLOADER = DKBootloaderCommands.COMMAND_CONFIRM_BOOTLOADER
+    COMMAND_GO_TO_APP = DKBootloaderCommands.COMMAND_GO_TO_APP
+    COMMAND_ERASE = DKBootloaderCommands.COMMAND_ERASE
+    COMMAND_WRITE = DKBootloaderCommands.COMMAND_WRITE
+    COMMAND_CALC_MD5 = DKBootloaderCommands.COMMAND_CALC_MD5
+    COMMAND_CALC_MD5_RANGE = DKBootloaderCommands.COMMAND_CALC_MD5_RANGE
+
+    SCHEMA = DKBootloaderCommands.SCHEMA
+
+    WRITE_BLOCK_SIZE = DKBootloaderCommands.WRITE_BLOCK_SIZE
+
+    async def confirm(self):
+        await self.request(self.COMMAND_CONFIRM_BOOTLOADER)
+
+    async def go_to_app(self):
+        self.connect.send(self.COMMAND_GO_TO_APP, None).cancel()
+        await self.connect.disconnect()
+
+    async def flash_erase(self) -> int:
+        return await self.request(self.COMMAND_ERASE, timeout=ERASE_TIMEOUT)
+
+    async def flash_write_part(self, pos: int, data: Union[bytes, memoryview], echo: bytes = None) -> bytes:
+        # echo: the answer must carry the position, the ack of another write is not taken
+        return await self.request(self.COMMAND_WRITE, pos, payload=data, retry=UPLOAD_ATTEMPTS, echo=echo)
+
+    async def flash_write(self, firmware: Union[str, FirmwareImage], window: int = UPLOAD_WINDOW,
+                          block_size: int = None, progress=None):
+        # One write is in flight until the device echoes the write position, the DK firmware
+        # does not. With the echo up to `window` writes are in flight, each one retried on its
+        # own and acked by its position. An error answer carries no position, it goes to the
+        # oldest write in flight: a refused write is done only when the ranged MD5 shows the
+        # block, otherwise it is sent again.
+        data = FirmwareImage.open(firmware).data
+        block_size = block_size or self.WRITE_BLOCK_SIZE
+        header = self.SCHEMA[self.COMMAND_WRITE].request
+        written = 0
+
+        async def write(pos, is_echo):
+            nonlocal written
+            block = data[pos:pos + block_size]
+            for attempt in range(UPLOAD_ATTEMPTS + 1):
+                try:
+                    answer = await self.flash_write_part(pos, block, header.pack(pos) if is_echo else None)
+                    break
+                except DKConnectGotErrorCode:
+                    if await self._is_block_written(pos, block):
+                        answer = None
+                        break
+                    if attempt == UPLOAD_ATTEMPTS:
+                        raise
+
+            written += len(block)
+            if progress:
+                progress(int(written / len(data) * 100))
+            return answer
+
+        if not data:
+            return
+
+        is_echo = await write(0, False) == header.pack(0)
+        semaphore = asyncio.Semaphore(window if is_echo else 1)
+
+        async def write_in_window(pos):
+            async with semaphore:
+                await write(pos, is_echo)
+
+        await asyncio.gather(*(write_in_window(pos) for pos in range(block_size, len(data), block_size)))
+
+    async def _is_block_written(self, pos: int, block: bytes) -> bool:
+        try:
+            md5 = await self.request(self.COMMAND_CALC_MD5_RANGE, pos, len(block), retry=UPLOAD_ATTEMPTS)
+        except DKConnectGotErrorCode:
+            return False
+
+        return md5 == hashlib.md5(block).digest()
+
+    async def flash_check(self, firmware: Union[str, FirmwareImage]) -> bool:
+        image = FirmwareImage.open(firmware)
+        flash_md5 = await self.calc_md5(image.size)
+        return image.md5 == flash_md5
+
+    async def calc_md5(self, flash_size: int) -> bytes:
+        return await self.request(self.COMMAND_CALC_MD5, flash_size, timeout=ERASE_TIMEOUT)
+
+    async def calc_md5_range(self, addr: int, length: int) -> bytes:
+        return await self.request(self.COMMAND_CALC_MD5_RANGE, addr, length)
+
+
+ASYNC_COMMANDS_MAP = {
+    AsyncDKBootloaderCommands.DEVICE_NAME: AsyncDKBootloaderCommands,
+    AsyncDKTankCommands.DEVICE_NAME: AsyncDKTankCommands,
+    AsyncDKUnitCommands.DEVICE_NAME: AsyncDKUnitCommands,
+}
+
+
+def build_async_commands(con: AsyncDKConnect):
+    return ASYNC_COMMANDS_MAP[con.device_name()](con)
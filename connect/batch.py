@@ -0,0 +1,63 @@
+from typing import Union
+
+
+class DKBatchNotExecuted(Exception):
+    pass
+
+
+class DKBatchResult:
+    def __init__(self, command: int, data: Union[bytes, None], parse=None):
+        self.command = command
+        self.data = data
+        self.parse = parse
+        self.is_done = False
+        self._value = None
+
+    def set_response(self, data: Union[bytes, None]):
+        self._value = self.parse(data) if self.parse and data is not None else data
+        self.is_done = True
+
+    def result(self):
+        if not self.is_done:
+            raise DKBatchNotExecuted
+
+        return self._value
+
+
+class DKBatch:
+    # Queues commands and runs them as one pipelined exchange:
+    #
+    #   with connect.batch() as batch:
+    #       name = batch.exchange(COMMAND_GET_NAME, parse=lambda data: data.decode('latin-1'))
+    #       uid = batch.exchange(COMMAND_GET_UID)
+    #   print(name.result(), uid.result())
+
+    def __init__(self, connect, retry=0, is_silent=False):
+        self.connect = connect
+        self.retry = retry
+        self.is_silent = is_silent
+        self.results = []
+
+    def __enter__(self) -> 'DKBatch':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.execute()
+
+    def exchange(self, command: int, data: Union[bytes, None] = None, parse=None) -> DKBatchResult:
+        result = DKBatchResult(command, data, parse)
+        self.results.append(result)
+        return result
+
+    def execute(self) -> list:
+        results = [result for result in self.results if not result.is_done]
+        if not results:
+            return []
+
+        packages = [(result.command, result.data) for result in results]
+        responses = self.connect.exchange_many(packages, retry=self.retry, is_silent=self.is_silent)
+        for result, data in zip(results, responses):
+            result.set_response(data)
+
+        return [result.result() for result in results]
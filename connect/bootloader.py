@@ -1,17 +1,61 @@
+import hashlib
 import logging
-import os
+from typing import Union
 
 from .commands import DKGeneralCommands
-from .utils import bytes_to_float, bytes_to_uint, int16_to_bytes, int32_to_bytes, float_to_bytes, int8_to_bytes
+from .connect import DKConnectGotErrorCode
+from .schema import UINT, CommandSpec, command_schema, compile_layout
+from .transfer import BLOCK_SIZES, TransferPart, negotiate_block_size, write_pipelined
+from .utils import map_file
 
 
 UPLOAD_ATTEMPTS = 5
+UPLOAD_WINDOW = 8
+DELTA_REGION_SIZE = 4096
+# Erasing a range erases the whole pages it touches. Changed regions are widened to this
+# size and written in full, it must be a multiple of the device erase page
+# (1-2K on STM32F0/F1, 16K sectors at the start of STM32F4 flash).
+ERASE_PAGE_SIZE = 16 * 1024
+ERASE_TIMEOUT = 30.0
+MD5_TIMEOUT = 5.0
 
 
 class DKBootloaderFirmwareNotAligned(Exception):
     pass
 
 
+class FirmwareImage:
+    # .dkf file: firmware size (4), firmware MD5 (16), firmware data.
+    # A loaded image keeps the file mapped, data is a memoryview into it.
+    HEADER = compile_layout('I16s')
+    HEADER_SIZE = HEADER.size
+    ALIGNMENT = 16
+
+    def __init__(self, size: int, md5: bytes, data: Union[bytes, memoryview]):
+        self.size = size
+        self.md5 = md5
+        self.data = data
+
+    @classmethod
+    def load(cls, file_name: str) -> 'FirmwareImage':
+        firmware_file = map_file(file_name)
+        size, md5 = cls.HEADER.unpack_from(firmware_file)
+        data = firmware_file[cls.HEADER_SIZE:]
+
+        if len(data) % cls.ALIGNMENT:
+            logging.error('File not aligned to {} bytes!'.format(cls.ALIGNMENT))
+            raise DKBootloaderFirmwareNotAligned
+
+        return cls(size, md5, data)
+
+    @classmethod
+    def open(cls, firmware: Union[str, 'FirmwareImage']) -> 'FirmwareImage':
+        if isinstance(firmware, FirmwareImage):
+            return firmware
+
+        return cls.load(firmware)
+
+
 class DKBootloaderCommands(DKGeneralCommands):
     DEVICE_NAME = 'DK Bootloader'
 
@@ -23,27 +67,62 @@ class DKBootloaderCommands(DKGeneralCommands):
     COMMAND_ERASE = 210
     COMMAND_WRITE = 211
     COMMAND_CALC_MD5 = 212
+    COMMAND_CALC_MD5_RANGE = 213
+    COMMAND_ERASE_RANGE = 214
 
     # Program external flash
     COMMAND_FLASH_PARAMS_ERASE = 220
     COMMAND_FLASH_SOUNDS_ERASE = 221
 
-    WRITE_BLOCK_SIZE = 16
+    COMMAND_TIMEOUTS = {
+        COMMAND_ERASE: ERASE_TIMEOUT,
+        COMMAND_ERASE_RANGE: ERASE_TIMEOUT,
+        COMMAND_CALC_MD5: MD5_TIMEOUT,
+        COMMAND_FLASH_PARAMS_ERASE: ERASE_TIMEOUT,
+        COMMAND_FLASH_SOUNDS_ERASE: ERASE_TIMEOUT,
+    }
+
+    SCHEMA = command_schema(
+        DKGeneralCommands.SCHEMA,
+        CommandSpec(COMMAND_CONFIRM_BOOTLOADER),
+        CommandSpec(COMMAND_GO_TO_APP),
+        CommandSpec(COMMAND_ERASE, response=UINT),
+        # position, then the block
+        CommandSpec(COMMAND_WRITE, request='I'),
+        CommandSpec(COMMAND_CALC_MD5, request='I'),
+        CommandSpec(COMMAND_CALC_MD5_RANGE, request='II'),
+        CommandSpec(COMMAND_ERASE_RANGE, request='II', response=UINT),
+        CommandSpec(COMMAND_FLASH_PARAMS_ERASE),
+        CommandSpec(COMMAND_FLASH_SOUNDS_ERASE),
+    )
+
+    WRITE_BLOCK_SIZE = FirmwareImage.ALIGNMENT
+    WRITE_BLOCK_SIZES = BLOCK_SIZES
     FIRMWARE_MD5_SIZE = 16
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.write_block_size = None
+
     def confirm(self):
-        self.connect.exchange(self.COMMAND_CONFIRM_BOOTLOADER, None)
+        self.request(self.COMMAND_CONFIRM_BOOTLOADER)
 
     def go_to_app(self):
         self.connect.send(self.COMMAND_GO_TO_APP, None)
         self.connect.disconnect()
 
-    def flash_update(self, file_name: str):
-        print('Erasing flash...')
-        self.flash_erase()
+    def flash_update(self, file_name: str, delta: bool = False):
+        image = FirmwareImage.load(file_name)
+
+        if delta:
+            print('Writing changed regions to flash...')
+            gen = self.flash_write_delta_async(image)
+        else:
+            print('Erasing flash...')
+            self.flash_erase()
 
-        print('Writing to flash...')
-        gen = self.flash_write_async(file_name)
+            print('Writing to flash...')
+            gen = self.flash_write_async(image)
 
         try:
             while True:
@@ -54,59 +133,171 @@ class DKBootloaderCommands(DKGeneralCommands):
 
         logging.info('Checking flash...')
 
-        if self.flash_check(file_name):
+        if self.flash_check(image):
             print('Firmware updated successfully.')
         else:
             print('ERROR! Firmware checksum mismatch!')
 
     def flash_erase(self) -> int:
-        self.connect.send(self.COMMAND_ERASE, None)
-        _, data = self.connect.receive_wait()
-        bad_blocks = bytes_to_uint(data)
+        self.invalidate_info_cache()
+        bad_blocks = self.request(self.COMMAND_ERASE)
+        return bad_blocks
+
+    def flash_erase_range(self, addr: int, length: int) -> int:
+        bad_blocks = self.request(self.COMMAND_ERASE_RANGE, addr, length)
         return bad_blocks
 
-    def flash_write_part(self, pos: int, data: bytes):
-        params = int32_to_bytes(pos) + data
-        self.connect.exchange(self.COMMAND_WRITE, params, retry=UPLOAD_ATTEMPTS)
+    def flash_write_part(self, pos: int, data: Union[bytes, memoryview]):
+        self.request(self.COMMAND_WRITE, pos, payload=data, retry=UPLOAD_ATTEMPTS)
+
+    def flash_write_async(self, firmware: Union[str, 'FirmwareImage'], window: int = UPLOAD_WINDOW,
+                          block_size: int = None):
+        image = FirmwareImage.open(firmware)
+        logging.info('Firmware size: {}'.format(len(image.data)))
+
+        regions = [(0, len(image.data))]
+        yield from self._progress(self._write_regions(image.data, regions, window, block_size), len(image.data))
+
+    def flash_write_delta_async(self, firmware: Union[str, 'FirmwareImage'], region_size: int = DELTA_REGION_SIZE,
+                                window: int = UPLOAD_WINDOW, block_size: int = None,
+                                page_size: int = ERASE_PAGE_SIZE):
+        # Erases and writes only the erase pages with regions whose MD5 differs from the image.
+        # Falls back to a full erase and write when the bootloader has no ranged commands,
+        # or when the result does not match, e.g. the device pages are larger than page_size.
+        image = FirmwareImage.open(firmware)
+
+        if self.calc_md5(image.size) == image.md5:
+            logging.info('Firmware is up to date')
+            yield 100
+            return
 
-    def flash_write_async(self, file_name: str):
-        file_size = os.path.getsize(file_name)
-        logging.info('Firmware file size: {}'.format(file_size))
+        try:
+            regions = self.flash_diff_regions(image.data, region_size)
+        except DKConnectGotErrorCode:
+            logging.info('Ranged MD5 is not supported, writing the whole firmware')
+            self.flash_erase()
+            yield from self.flash_write_async(image, window, block_size)
+            return
+
+        if not regions:
+            logging.info('No changed regions')
+            yield 100
+            return
+
+        pages = self.erase_page_spans(regions, page_size)
+        # Everything erased is written again, the image may end inside the last page
+        spans = [(addr, min(addr + length, len(image.data)) - addr) for addr, length in pages]
+        total_size = sum(length for _, length in spans)
+        logging.info('Changed regions: {}, bytes: {} of {}'.format(len(spans), total_size, len(image.data)))
+
+        self.invalidate_info_cache()
+        for addr, length in pages:
+            self.flash_erase_range(addr, length)
+
+        yield from self._progress(self._write_regions(image.data, spans, window, block_size), total_size)
+
+        if self.calc_md5(image.size) != image.md5:
+            logging.warning('Firmware mismatch after the delta upload, writing the whole firmware')
+            self.flash_erase()
+            yield from self.flash_write_async(image, window, block_size)
+
+    def flash_diff_regions(self, data: bytes, region_size: int = DELTA_REGION_SIZE) -> list:
+        regions = []
+        for addr in range(0, len(data), region_size):
+            region = data[addr:addr + region_size]
+            if self.calc_md5_range(addr, len(region)) == hashlib.md5(region).digest():
+                continue
+
+            # Merge adjacent regions so they are erased and written in one go
+            if regions and regions[-1][0] + regions[-1][1] == addr:
+                regions[-1] = (regions[-1][0], regions[-1][1] + len(region))
+            else:
+                regions.append((addr, len(region)))
+
+        return regions
+
+    @staticmethod
+    def erase_page_spans(regions: list, page_size: int = ERASE_PAGE_SIZE) -> list:
+        # Regions widened to whole erase pages, overlapping and adjacent ones are merged
+        spans = []
+        for addr, length in regions:
+            start = addr - addr % page_size
+            end = -(-(addr + length) // page_size) * page_size
+            if spans and spans[-1][1] >= start:
+                spans[-1] = (spans[-1][0], max(spans[-1][1], end))
+            else:
+                spans.append((start, end))
+
+        return [(start, end - start) for start, end in spans]
+
+    @staticmethod
+    def _progress(sizes, total_size: int):
         prev_percent = 0
+        curr_pos = 0
+        for size in sizes:
+            curr_pos += size
+            percent = int(curr_pos/total_size*100)
+            if percent != prev_percent:
+                prev_percent = percent
+                yield percent
 
-        with open(file_name, 'rb') as firmware_file:
-            curr_pos = 0
-            firmware_file.read(4)
-            firmware_file.read(self.FIRMWARE_MD5_SIZE)
+    def _write_regions(self, data: bytes, regions: list, window: int, block_size: int = None):
+        regions = [(addr, length) for addr, length in regions if length]
+        if not regions:
+            return
 
-            while True:
-                block = firmware_file.read(self.WRITE_BLOCK_SIZE)
-                if not block:
-                    return
+        block_size = block_size or self.write_block_size
+        if not block_size:
+            addr, length = regions[0]
 
-                if len(block) < self.WRITE_BLOCK_SIZE:
-                    logging.error('File not aligned to {}} bytes!'.format(self.WRITE_BLOCK_SIZE))
-                    raise DKBootloaderFirmwareNotAligned
+            def probe(size):
+                block = data[addr:addr + min(size, length)]
+                try:
+                    self.flash_write_part(addr, block)
+                except DKConnectGotErrorCode:
+                    # The error may answer a retry after a lost answer, a rejected size is not written
+                    if not self._is_part_written(data, TransferPart(addr, None, len(block))):
+                        raise
+                return len(block)
 
-                self.flash_write_part(curr_pos, block)
-                curr_pos += len(block)
-                percent = int(curr_pos/file_size*100)
-                if percent != prev_percent:
-                    prev_percent = percent
-                    yield percent
+            block_size, written = negotiate_block_size(probe, self.WRITE_BLOCK_SIZES)
+            self.write_block_size = block_size
+            yield written
 
-    def flash_check(self, file_name: str) -> bool:
+            regions = [(addr + written, length - written)] + regions[1:]
 
-        with open(file_name, 'rb') as firmware_file:
-            firmware_size = bytes_to_uint(firmware_file.read(4))
-            file_md5 = firmware_file.read(self.FIRMWARE_MD5_SIZE)
+        parts = self._image_parts(data, regions, block_size)
+        yield from write_pipelined(self.connect, self.COMMAND_WRITE, parts, window, UPLOAD_ATTEMPTS,
+                                   lambda part: self._is_part_written(data, part))
+
+    def _is_part_written(self, data: bytes, part: TransferPart) -> bool:
+        # Ranged MD5 of the block, bootloaders without ranged commands can not tell
+        try:
+            md5 = self.request(self.COMMAND_CALC_MD5_RANGE, part.pos, part.size, retry=UPLOAD_ATTEMPTS)
+        except DKConnectGotErrorCode:
+            return False
 
-        flash_md5 = self.calc_md5(firmware_size)
-        logging.info('File MD5: {}'.format(file_md5.hex()))
+        return md5 == hashlib.md5(data[part.pos:part.pos + part.size]).digest()
+
+    @classmethod
+    def _image_parts(cls, data: bytes, regions: list, block_size: int):
+        header = cls.SCHEMA[cls.COMMAND_WRITE].request
+        for addr, length in regions:
+            end = addr + length
+            for pos in range(addr, end, block_size):
+                block = data[pos:min(pos + block_size, end)]
+                yield TransferPart(pos, (header.pack(pos), block), len(block))
+
+    def flash_check(self, firmware: Union[str, 'FirmwareImage']) -> bool:
+        image = FirmwareImage.open(firmware)
+
+        flash_md5 = self.calc_md5(image.size)
+        logging.info('File MD5: {}'.format(image.md5.hex()))
         logging.info('Flash MD5: {}'.format(flash_md5.hex()))
-        return file_md5 == flash_md5
+        return image.md5 == flash_md5
 
     def calc_md5(self, flash_size: int) -> bytes:
-        params = int32_to_bytes(flash_size)
-        data = self.connect.exchange(self.COMMAND_CALC_MD5, params)
-        return data
+        return self.request(self.COMMAND_CALC_MD5, flash_size)
+
+    def calc_md5_range(self, addr: int, length: int) -> bytes:
+        return self.request(self.COMMAND_CALC_MD5_RANGE, addr, length)
@@ -0,0 +1,310 @@
+import argparse
+import contextlib
+import functools
+import json
+import logging
+import sys
+import time
+
+from .bootloader import UPLOAD_WINDOW
+from .connect import DKConnect, DKConnectError, DKConnectGotErrorCode, make_serial
+from .discovery import PortDiscovery
+from .device_cache import DeviceInfoCache, DEFAULT_CACHE_FILE
+from . import build_commands, DEVICE_BOOTLOADER
+
+
+# Heavy modules (numpy for sounds and telemetry) are imported by the commands that need them,
+# nothing here imports PySide2.
+
+EXIT_OK = 0
+EXIT_FAILED = 1
+EXIT_USAGE = 2
+EXIT_NO_DEVICE = 3
+EXIT_CONNECTION = 4
+
+POLL_INTERVAL = 0.5
+
+
+class DKCliError(Exception):
+    # result, when given, is reported along with the error, e.g. per device results
+    def __init__(self, message: str, exit_code: int = EXIT_FAILED, result=None):
+        super().__init__(message)
+        self.exit_code = exit_code
+        self.result = result
+
+
+def make_transport(args):
+    # One simulated device for the whole run. Every connection gets its own interface
+    # object (the fleet flasher connects from several threads), all talk to that device.
+    if args.serial == 'simulator':
+        from .interfaces.simulator import SimulatorSerial
+        from .simulator import DeviceSimulator
+        return functools.partial(SimulatorSerial, [DeviceSimulator()])
+
+    return args.serial
+
+
+@contextlib.contextmanager
+def open_device(args):
+    # Connects to the --port device or to the first DK device, waits up to --wait seconds
+    connect = DKConnect(args.transport)
+    if args.cache:
+        connect.info_cache = DeviceInfoCache(args.cache)
+
+    discovery = PortDiscovery(connect.serial)
+    deadline = time.monotonic() + args.wait
+    discovery.refresh()
+    while not discovery.find_and_connect(connect, args.port):
+        if time.monotonic() >= deadline:
+            raise DKCliError('Device not found: {}'.format(args.port or 'any DK port'), EXIT_NO_DEVICE)
+
+        time.sleep(POLL_INTERVAL)
+        discovery.refresh()
+
+    try:
+        yield build_commands(connect)
+    finally:
+        if connect.is_connect():
+            connect.disconnect()
+
+
+def require_app(cmd):
+    if cmd.device_name() == DEVICE_BOOTLOADER:
+        raise DKCliError('The device is in the bootloader, the command needs the main firmware')
+    return cmd
+
+
+def read_json(file_name: str):
+    if file_name == '-':
+        return json.load(sys.stdin)
+
+    with open(file_name) as json_file:
+        return json.load(json_file)
+
+
+def version_text(version) -> str:
+    return '.'.join(str(x) for x in version)
+
+
+def cmd_ports(args) -> dict:
+    ports = [port for port in make_serial(args.transport).get_devices() if DKConnect.is_dk_port(port)]
+    return {'ports': [port.name for port in ports]}
+
+
+def cmd_info(args) -> dict:
+    with open_device(args) as cmd:
+        info = cmd.get_general_info()
+        result = {
+            'device': cmd.device_name(),
+            'name': info['name'],
+            'uid': info['uid'].hex(),
+            'software_version': version_text(info['software_version']),
+        }
+
+        if 'hardware_version' in info:
+            result['hardware_version'] = version_text(info['hardware_version'])
+            result['license_key'] = info['license_key'].hex()
+            result['access_level'] = info['access_level']
+
+        if cmd.device_name() != DEVICE_BOOTLOADER:
+            result['free_mem'] = cmd.get_free_mem()
+            result['voltage_battery'] = cmd.get_voltage_battery()
+            result['voltage_5v'] = cmd.get_voltage_5v()
+
+    return result
+
+
+def cmd_flash(args) -> dict:
+    from .fleet import FleetFlasher
+
+    # The fleet flasher resets to the bootloader and reconnects by port name, also for one device
+    flasher = FleetFlasher(args.firmware, args.transport, delta=args.delta, window=args.window,
+                           go_to_app=not args.stay_in_bootloader)
+    ports = flasher.find_ports()
+    if not args.all:
+        ports = [port for port in ports if args.port is None or port.name == args.port][:1]
+    if not ports:
+        raise DKCliError('Device not found: {}'.format(args.port or 'any DK port'), EXIT_NO_DEVICE)
+
+    results = [result.to_dict() for result in flasher.run(ports)]
+    failed = [result['port'] for result in results if not result['success']]
+    if failed:
+        raise DKCliError('Firmware upload failed: {}'.format(', '.join(failed)), result={'devices': results})
+
+    return {'devices': results}
+
+
+def cmd_sounds(args) -> dict:
+    from .sounds import SoundBankSync, load_manifest
+
+    sounds = load_manifest(args.manifest)
+    with open_device(args) as cmd:
+        uploaded = SoundBankSync(require_app(cmd), sounds).run(force=args.force)
+
+    return {'uploaded': uploaded, 'total': len(sounds)}
+
+
+def cmd_params_export(args) -> dict:
+    from .params import ParamTable
+
+    with open_device(args) as cmd:
+        params = ParamTable(require_app(cmd)).load()
+
+    result = {'params': params.to_dict()}
+    if args.file:
+        with open(args.file, 'w') as params_file:
+            json.dump(result, params_file, indent=2)
+        return {'file': args.file, 'count': len(params)}
+
+    return result
+
+
+def cmd_params_import(args) -> dict:
+    from .params import ParamTable
+
+    # The file of `params export`: {"params": {"number": value}}, or the bare mapping
+    values = read_json(args.file)
+    values = values.get('params', values)
+
+    with open_device(args) as cmd:
+        params = ParamTable(require_app(cmd)).load()
+        unknown = [number for number in values if int(number) not in params]
+        params.update(values)
+        written = params.write() if args.no_save else params.save()
+
+    return {'written': written, 'saved': not args.no_save and written > 0, 'unknown': unknown}
+
+
+def cmd_license(args) -> dict:
+    try:
+        key = bytes.fromhex(args.key)
+    except ValueError:
+        raise DKCliError('Key format error', EXIT_USAGE)
+
+    with open_device(args) as cmd:
+        require_app(cmd).write_license_key(key)
+        return {'uid': cmd.get_uid().hex(), 'access_level': cmd.get_access_level()}
+
+
+def cmd_telemetry(args) -> dict:
+    from .telemetry import TelemetrySampler, default_channels
+
+    with open_device(args) as cmd:
+        sampler = TelemetrySampler(require_app(cmd), default_channels(args.rate, args.rc_rate))
+        sampler.run(args.duration)
+
+    if args.csv:
+        sampler.export_csv(args.csv)
+    if args.binary:
+        sampler.export_binary(args.binary)
+
+    channels = {}
+    for channel in sampler.channels:
+        _, values = sampler.channel(channel.name)
+        channels[channel.name] = {
+            'count': len(values),
+            'last': float(values[-1]) if len(values) else None,
+            'min': float(values.min()) if len(values) else None,
+            'max': float(values.max()) if len(values) else None,
+            'mean': float(values.mean()) if len(values) else None,
+        }
+
+    return {'duration': args.duration, 'errors': sampler.errors, 'channels': channels}
+
+
+def make_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog='python -m connect', description='DK device tool, JSON output')
+    parser.add_argument('--port', default=None, help='port name, the first DK port when omitted')
+    parser.add_argument('--serial', default='py_serial', choices=('py_serial', 'simulator'), help='transport')
+    parser.add_argument('--wait', type=float, default=0.0, help='seconds to wait for the device')
+    parser.add_argument('--cache', nargs='?', const=DEFAULT_CACHE_FILE, default=None,
+                        help='device info cache file')
+    parser.add_argument('--output', default=None, help='JSON file, stdout when omitted')
+    parser.add_argument('-v', '--verbose', action='store_true', help='log to stderr')
+    commands = parser.add_subparsers(dest='command', metavar='command')
+    commands.required = True
+
+    command = commands.add_parser('ports', help='list DK ports')
+    command.set_defaults(handler=cmd_ports)
+
+    command = commands.add_parser('info', help='device name, versions, license and voltages')
+    command.set_defaults(handler=cmd_info)
+
+    command = commands.add_parser('flash', help='upload firmware')
+    command.add_argument('firmware', help='.dkf file')
+    command.add_argument('--delta', action='store_true', help='write only the changed regions')
+    command.add_argument('--window', type=int, default=UPLOAD_WINDOW, help='blocks in flight')
+    command.add_argument('--all', action='store_true', help='flash every DK device in parallel')
+    command.add_argument('--stay-in-bootloader', action='store_true', help='do not start the firmware')
+    command.set_defaults(handler=cmd_flash)
+
+    command = commands.add_parser('sounds', help='sync sounds with a manifest')
+    command.add_argument('manifest', help='JSON manifest, see connect/sounds.py')
+    command.add_argument('--force', action='store_true', help='upload all sounds')
+    command.set_defaults(handler=cmd_sounds)
+
+    command = commands.add_parser('params', help='export or import params')
+    params_commands = command.add_subparsers(dest='params_command', metavar='action')
+    params_commands.required = True
+    command = params_commands.add_parser('export', help='read all params')
+    command.add_argument('file', nargs='?', default=None, help='JSON file, in the output when omitted')
+    command.set_defaults(handler=cmd_params_export)
+    command = params_commands.add_parser('import', help='write changed params and save them')
+    command.add_argument('file', help='JSON file of params export, - for stdin')
+    command.add_argument('--no-save', action='store_true', help='do not save params to flash')
+    command.set_defaults(handler=cmd_params_import)
+
+    command = commands.add_parser('license', help='write the license key')
+    command.add_argument('key', help='hex string')
+    command.set_defaults(handler=cmd_license)
+
+    command = commands.add_parser('telemetry', help='sample telemetry channels')
+    command.add_argument('--duration', type=float, default=5.0, help='seconds')
+    command.add_argument('--rate', type=float, default=10.0, help='samples per second')
+    command.add_argument('--rc-rate', type=float, default=50.0, help='RC channel samples per second')
+    command.add_argument('--csv', default=None, help='export samples to a CSV file')
+    command.add_argument('--binary', default=None, help='export samples to a binary file')
+    command.set_defaults(handler=cmd_telemetry)
+
+    return parser
+
+
+def main(argv: list = None) -> int:
+    args = make_parser().parse_args(argv)
+    # force: logging at import time (e.g. the CRC engine choice) has already set up the root logger
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.ERROR, stream=sys.stderr, force=True)
+
+    args.transport = make_transport(args)
+
+    report = {'command': ' '.join(filter(None, (args.command, getattr(args, 'params_command', None))))}
+    try:
+        # Upload helpers print progress, keep stdout for JSON
+        with contextlib.redirect_stdout(sys.stderr):
+            report['result'] = args.handler(args)
+        exit_code = EXIT_OK
+    except DKCliError as exc:
+        if exc.result is not None:
+            report['result'] = exc.result
+        report['error'] = str(exc)
+        exit_code = exc.exit_code
+    except DKConnectGotErrorCode as exc:
+        report['error'] = 'Received error from device, code: {}'.format(exc.error_code)
+        exit_code = EXIT_FAILED
+    except DKConnectError as exc:
+        logging.info('Connection error', exc_info=True)
+        report['error'] = repr(exc)
+        exit_code = EXIT_CONNECTION
+    except (OSError, ValueError) as exc:
+        # Missing or malformed input files
+        report['error'] = str(exc)
+        exit_code = EXIT_FAILED
+
+    report['ok'] = exit_code == EXIT_OK
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(text)
+    else:
+        print(text)
+
+    return exit_code
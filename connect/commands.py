@@ -1,16 +1,37 @@
 from .connect import DKConnect
-from .utils import bytes_to_uint, int32_to_bytes, int16_to_bytes
+from .schema import CommandSpec, command_schema
 
 
 class DKCommands:
     DEVICE_NAME = None
 
+    # Fixed response timeouts of slow commands, in seconds
+    COMMAND_TIMEOUTS = {}
+
+    # Command id -> CommandSpec, see schema.py
+    SCHEMA = {}
+
     def __init__(self, connect: DKConnect):
         self.connect = connect
+        self.connect.retry_policy.set_overrides(self.COMMAND_TIMEOUTS)
 
     def device_name(self) -> str:
         return self.DEVICE_NAME
 
+    def request(self, command: int, *values, payload=None, retry=0, is_silent=False, timeout=None):
+        # Exchange with the params encoded and the response decoded by the command schema,
+        # payload is sent after the encoded params
+        spec = self.SCHEMA[command]
+        data = spec.encode(*values)
+        if payload is not None:
+            data = (data, payload)
+        data = self.connect.exchange(command, data, retry=retry, is_silent=is_silent, timeout=timeout)
+        return spec.decode(data)
+
+    def batch_request(self, batch, command: int, *values, parse=None):
+        spec = self.SCHEMA[command]
+        return batch.exchange(command, spec.encode(*values), parse=parse or spec.decode)
+
 
 class DKGeneralCommands(DKCommands):
     COMMAND_ECHO = 0
@@ -22,32 +43,82 @@ class DKGeneralCommands(DKCommands):
     COMMAND_BLOCK_MODE_BEGIN = 6
     COMMAND_BLOCK_MODE_END = 7
 
+    SCHEMA = command_schema(
+        DKCommands.SCHEMA,
+        CommandSpec(COMMAND_ECHO),
+        CommandSpec(COMMAND_GET_NAME),
+        CommandSpec(COMMAND_GET_UID),
+        CommandSpec(COMMAND_GET_SOFTWARE_VERSION, response='BBH'),
+        CommandSpec(COMMAND_GET_HARDWARE_VERSION, response='HHHH'),
+        CommandSpec(COMMAND_SYSTEM_RESET),
+        CommandSpec(COMMAND_BLOCK_MODE_BEGIN),
+        CommandSpec(COMMAND_BLOCK_MODE_END),
+    )
+
     def ping(self) -> bool:
-        data = self.connect.exchange(self.COMMAND_ECHO, b'ping')
+        data = self.request(self.COMMAND_ECHO, b'ping')
         return data == b'ping'
 
     def get_name(self) -> str:
-        data = self.connect.exchange(self.COMMAND_GET_NAME, None)
-        return data.decode('latin-1')
+        return self.parse_name(self.request(self.COMMAND_GET_NAME))
 
     def get_uid(self) -> bytes:
-        data = self.connect.exchange(self.COMMAND_GET_UID, None)
-        return data
+        return self.request(self.COMMAND_GET_UID)
 
     def get_software_version(self) -> (int, int, int):
-        data = self.connect.exchange(self.COMMAND_GET_SOFTWARE_VERSION, None)
-        return data[0], data[1], bytes_to_uint(data[2:4])
+        return self.request(self.COMMAND_GET_SOFTWARE_VERSION)
 
     def get_hardware_version(self) -> (int, int, int, int):
-        data = self.connect.exchange(self.COMMAND_GET_HARDWARE_VERSION, None)
-        return bytes_to_uint(data[0:2]), bytes_to_uint(data[2:4]), bytes_to_uint(data[4:6]), bytes_to_uint(data[6:8])
+        return self.request(self.COMMAND_GET_HARDWARE_VERSION)
+
+    def get_general_info(self) -> dict:
+        # One round trip for everything shown on connect. With a device info cache
+        # only the identity is read when the cached software version still matches.
+        cache = self.connect.info_cache
+        with self.connect.batch() as batch:
+            results = self._identity_requests(batch)
+            if cache is None:
+                results.update(self._static_info_requests(batch))
+
+        info = {key: result.result() for key, result in results.items()}
+        if cache is None:
+            return info
+
+        cached_info = cache.get(info['uid'], info['name'])
+        if cached_info is not None and cached_info['software_version'] == info['software_version']:
+            return cached_info
+
+        with self.connect.batch() as batch:
+            results = self._static_info_requests(batch)
+
+        info.update({key: result.result() for key, result in results.items()})
+        cache.put(info)
+        return info
+
+    def invalidate_info_cache(self):
+        if self.connect.info_cache is not None:
+            self.connect.info_cache.invalidate(self.get_uid())
+
+    def _identity_requests(self, batch) -> dict:
+        return {
+            'name': self.batch_request(batch, self.COMMAND_GET_NAME, parse=self.parse_name),
+            'uid': self.batch_request(batch, self.COMMAND_GET_UID),
+            'software_version': self.batch_request(batch, self.COMMAND_GET_SOFTWARE_VERSION),
+        }
+
+    def _static_info_requests(self, batch) -> dict:
+        return {}
+
+    @staticmethod
+    def parse_name(data: bytes) -> str:
+        return data.decode('latin-1')
 
     def system_reset(self):
         self.connect.send(self.COMMAND_SYSTEM_RESET, None)
         self.connect.disconnect()
 
     def block_mode_begin(self) -> None:
-        self.connect.exchange(self.COMMAND_BLOCK_MODE_BEGIN, None)
+        self.request(self.COMMAND_BLOCK_MODE_BEGIN)
 
     def block_mode_end(self) -> None:
-        self.connect.exchange(self.COMMAND_BLOCK_MODE_END, None)
+        self.request(self.COMMAND_BLOCK_MODE_END)
@@ -1,12 +1,43 @@
+import logging
 import os
 import time
 from typing import Union
 
 from .commands import DKGeneralCommands
-from .utils import bytes_to_float, bytes_to_uint, int16_to_bytes, int32_to_bytes, float_to_bytes, int8_to_bytes
+from .connect import DKConnectError, DKConnectGotErrorCode
+from .schema import UINT, CommandSpec, command_schema, compile_layout
+from .transfer import TransferPart, negotiate_block_size, write_pipelined
+from .utils import file_md5, map_file
+
+
+SOUND_UPLOAD_ATTEMPTS = 3
+SOUND_INFO_CHUNK = 16
+# Used once the device echoes the write position, until then one block is in flight
+SOUND_UPLOAD_WINDOW = 8
+
+READ_FLASH_BLOCK_SIZE = 256
+READ_FLASH_WINDOW = 8
+READ_FLASH_ATTEMPTS = 3
+
+# The type of a param is known only from the size of its value: 4 float, 2 int, 1 bool
+PARAM_LAYOUTS = {
+    4: 'f',
+    2: 'H',
+    1: 'B',
+}
+# Without the size reported by the device a bool is sent as int16, as older hosts did
+PARAM_VALUE_SIZES = {
+    float: 4,
+    int: 2,
+    bool: 2,
+}
 
 
 class SoundInfo:
+    # Response of COMMAND_GET_SOUND_INFO: id, size, pos, model id, version major, minor.
+    # Older firmware sends only id, size and pos.
+
+    __slots__ = ('_id', 'size', 'pos', 'model_id', 'version_major', 'version_minor')
 
     def get_id(self):
         return self._id
@@ -21,14 +52,22 @@ class SoundInfo:
 
     @staticmethod
     def unpack(data: bytes):
-        return SoundInfo(
-            bytes_to_uint(data[0:2]),
-            bytes_to_uint(data[2:6]),
-            bytes_to_uint(data[6:10]),
-            bytes_to_uint(data[10:2]),
-            bytes_to_uint(data[12:13]),
-            bytes_to_uint(data[13:14]),
-            )
+        return SoundInfo(*DKCommonCommands.SCHEMA[DKCommonCommands.COMMAND_GET_SOUND_INFO].decode(data))
+
+
+class SoundFile:
+    # A sound file and the slot it is written to
+    def __init__(self, number: int, file_name: str, sound_id: int,
+                 model_id: int = 0, version_major: int = 0, version_minor: int = 0):
+        self.number = number
+        self.file_name = file_name
+        self.sound_id = sound_id
+        self.model_id = model_id
+        self.version_major = version_major
+        self.version_minor = version_minor
+
+    def size(self) -> int:
+        return os.path.getsize(self.file_name)
 
 
 class DKCommonCommands(DKGeneralCommands):
@@ -66,129 +105,305 @@ class DKCommonCommands(DKGeneralCommands):
 
     COMMAND_START_TESTS = 170
 
+    SCHEMA = command_schema(
+        DKGeneralCommands.SCHEMA,
+        CommandSpec(COMMAND_GET_LICENSE_KEY),
+        CommandSpec(COMMAND_GET_ACCESS_LEVEL, response=UINT),
+        CommandSpec(COMMAND_GET_FREE_MEM, response=UINT),
+        CommandSpec(COMMAND_GET_VOLTAGE_BATTERY, response='f'),
+        CommandSpec(COMMAND_GET_VOLTAGE_5V, response='f'),
+        CommandSpec(COMMAND_GET_RC_RECEIVER_VALUE, request='B', response=UINT),
+        CommandSpec(COMMAND_GET_PLAYER_PERFORMANCE, response=UINT),
+        CommandSpec(COMMAND_WRITE_LICENSE_KEY),
+        # The value layout depends on the param, see PARAM_LAYOUTS
+        CommandSpec(COMMAND_GET_PARAM, request='H'),
+        CommandSpec(COMMAND_SET_PARAM),
+        CommandSpec(COMMAND_SAVE_PARAMS),
+        CommandSpec(COMMAND_RESET_PARAMS),
+        # number, id, size, model id, version major, minor. The DK protocol has the
+        # first three, model and version are sent only to devices known to take them.
+        CommandSpec(COMMAND_WRITE_SOUND_INFO, request='HHIHBB', short_request='HHI'),
+        # number, position, then the block
+        CommandSpec(COMMAND_WRITE_SOUND_FILE, request='HI'),
+        # The fields of SoundInfo, older firmware sends id, size and pos only
+        CommandSpec(COMMAND_GET_SOUND_INFO, request='H', response='HIIHBB', short_response='HII'),
+        CommandSpec(COMMAND_RESET_SOUNDS),
+        CommandSpec(COMMAND_WRITE_HARDWARE_VERSION, request='HHHH'),
+        CommandSpec(COMMAND_READ_FLASH, request='IH'),
+        CommandSpec(COMMAND_JUMP_TO_STM_BOOTLOADER),
+        CommandSpec(COMMAND_GET_RDP_LEVEL, response=UINT),
+        CommandSpec(COMMAND_SET_RDP_LEVEL, request='B'),
+        CommandSpec(COMMAND_START_TESTS),
+    )
+
+    SOUND_BLOCK_SIZES = (1024, 512, 256, 128, 64, 32)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.sound_block_size = None
+        # Set when the firmware is known to take the model and version in the sound info
+        self.is_long_sound_info = False
+
+    def _static_info_requests(self, batch) -> dict:
+        requests = super()._static_info_requests(batch)
+        requests['hardware_version'] = self.batch_request(batch, self.COMMAND_GET_HARDWARE_VERSION)
+        requests['license_key'] = self.batch_request(batch, self.COMMAND_GET_LICENSE_KEY)
+        requests['access_level'] = self.batch_request(batch, self.COMMAND_GET_ACCESS_LEVEL)
+        return requests
+
     def get_license_key(self) -> bytes:
-        data = self.connect.exchange(self.COMMAND_GET_LICENSE_KEY, None)
-        return data
+        return self.request(self.COMMAND_GET_LICENSE_KEY)
 
     def get_access_level(self) -> int:
-        data = self.connect.exchange(self.COMMAND_GET_ACCESS_LEVEL, None)
-        return bytes_to_uint(data)
+        return self.request(self.COMMAND_GET_ACCESS_LEVEL)
 
     def get_free_mem(self) -> int:
-        data = self.connect.exchange(self.COMMAND_GET_FREE_MEM, None)
-        return bytes_to_uint(data)
+        return self.request(self.COMMAND_GET_FREE_MEM)
 
     def get_voltage_battery(self) -> float:
-        data = self.connect.exchange(self.COMMAND_GET_VOLTAGE_BATTERY, None)
-        return bytes_to_float(data)
+        return self.request(self.COMMAND_GET_VOLTAGE_BATTERY)
 
     def get_voltage_5v(self) -> float:
-        data = self.connect.exchange(self.COMMAND_GET_VOLTAGE_5V, None)
-        return bytes_to_float(data)
+        return self.request(self.COMMAND_GET_VOLTAGE_5V)
 
     def get_rc_receiver_value(self, channel: int) -> int:
-        params = int8_to_bytes(channel)
-        data = self.connect.exchange(self.COMMAND_GET_RC_RECEIVER_VALUE, params)
-        return bytes_to_uint(data)
+        return self.request(self.COMMAND_GET_RC_RECEIVER_VALUE, channel)
 
     def get_player_performance(self):
-        data = self.connect.exchange(self.COMMAND_GET_PLAYER_PERFORMANCE, None)
-        return bytes_to_uint(data)
+        return self.request(self.COMMAND_GET_PLAYER_PERFORMANCE)
 
     def get_param(self, number: int) -> Union[int, float]:
-        params = int16_to_bytes(number)
-        data = self.connect.exchange(self.COMMAND_GET_PARAM, params)
-        if len(data) == 4:
-            return bytes_to_float(data)
-        elif len(data) == 2:
-            return bytes_to_uint(data)
-        else:
+        return self.decode_param(self.request(self.COMMAND_GET_PARAM, number))
+
+    def set_param(self, number: int, value: Union[int, float, bool], size: int = None):
+        # size is the size of the param value on the device, by default it follows the value type
+        self.request(self.COMMAND_SET_PARAM, self.encode_param(number, value, size))
+
+    @staticmethod
+    def decode_param(data: bytes) -> Union[int, float]:
+        layout = PARAM_LAYOUTS.get(len(data))
+        if layout is None:
             return data[0]
 
-    def set_param(self, number: int, value: Union[int, float, bool]):
-        params = int16_to_bytes(number)
-        if isinstance(value, int):
-            params += int16_to_bytes(value)
-        elif isinstance(value, float):
-            params += float_to_bytes(value)
-        elif isinstance(value, bool):
-            params += int16_to_bytes(int(value))
+        return compile_layout(layout).unpack(data)[0]
 
-        self.connect.exchange(self.COMMAND_SET_PARAM, params)
+    @staticmethod
+    def encode_param(number: int, value: Union[int, float, bool], size: int = None) -> bytes:
+        size = size or PARAM_VALUE_SIZES[type(value)]
+        layout = PARAM_LAYOUTS[size]
+        value = float(value) if layout == 'f' else int(value)
+        return compile_layout('H' + layout).pack(number, value)
 
     def save_params(self):
-        self.connect.exchange(self.COMMAND_SAVE_PARAMS)
+        self.request(self.COMMAND_SAVE_PARAMS)
 
     def reset_params(self):
-        self.connect.exchange(self.COMMAND_RESET_PARAMS)
+        self.request(self.COMMAND_RESET_PARAMS)
 
     def write_license_key(self, key: bytes):
-        data = self.connect.exchange(self.COMMAND_WRITE_LICENSE_KEY, key)
+        data = self.request(self.COMMAND_WRITE_LICENSE_KEY, key)
+        self.invalidate_info_cache()
         return data
 
-    def write_sound_info(self, number: int, sound_id: int, size: int,):
-        print(number, sound_id, size)
-        params = int16_to_bytes(number) + int16_to_bytes(sound_id) + int32_to_bytes(size)
-        self.connect.exchange(self.COMMAND_WRITE_SOUND_INFO, params, retry=3)
+    def write_sound_info(self, number: int, sound_id: int, size: int,
+                         model_id: int = 0, version_major: int = 0, version_minor: int = 0):
+        logging.info('Write sound info: {}, id: {}, size: {}'.format(number, sound_id, size))
+        self.request(self.COMMAND_WRITE_SOUND_INFO,
+                     *self._sound_info_values(number, sound_id, size, model_id, version_major, version_minor),
+                     retry=SOUND_UPLOAD_ATTEMPTS)
 
-    def write_sound_file_part(self, number: int, pos: int, data: bytes):
-        params = int16_to_bytes(number) + int32_to_bytes(pos) + data
-        self.connect.exchange(self.COMMAND_WRITE_SOUND_FILE, params, retry=3)
+    def _sound_info_values(self, number: int, sound_id: int, size: int,
+                           model_id: int, version_major: int, version_minor: int) -> tuple:
+        if not self.is_long_sound_info:
+            return number, sound_id, size
 
-    def write_sound_file(self, number: int, file_name: str, sound_id: int,
-                         model_id: int = 0, version_major: int = 0, version_minor: int = 0):
-        file_size = os.path.getsize(file_name)
-        self.write_sound_info(number, sound_id, file_size)
+        return number, sound_id, size, model_id, version_major, version_minor
+
+    def write_sound_file_part(self, number: int, pos: int, data: Union[bytes, memoryview]):
+        self.request(self.COMMAND_WRITE_SOUND_FILE, number, pos, payload=data, retry=SOUND_UPLOAD_ATTEMPTS)
 
+    def write_sound_file(self, number: int, file_name: str, sound_id: int,
+                         model_id: int = 0, version_major: int = 0, version_minor: int = 0,
+                         block_size: int = None, window: int = 1):
+        sound = SoundFile(number, file_name, sound_id, model_id, version_major, version_minor)
+        self.write_sound_files([sound], block_size, window)
+
+    def write_sound_files(self, sounds: list, block_size: int = None, window: int = SOUND_UPLOAD_WINDOW):
+        # Sound infos are written first, then the data of all files is streamed
+        # back to back through one pipelined upload
+        sounds_data = [map_file(sound.file_name) for sound in sounds]
+        total_size = sum(len(sound_data) for sound_data in sounds_data)
+
+        spec = self.SCHEMA[self.COMMAND_WRITE_SOUND_INFO]
+        for pos in range(0, len(sounds), SOUND_INFO_CHUNK):
+            packages = [(self.COMMAND_WRITE_SOUND_INFO,
+                         spec.encode(*self._sound_info_values(sound.number, sound.sound_id, len(sound_data),
+                                                             sound.model_id, sound.version_major,
+                                                             sound.version_minor)))
+                        for sound, sound_data in zip(sounds[pos:pos + SOUND_INFO_CHUNK],
+                                                     sounds_data[pos:pos + SOUND_INFO_CHUNK])]
+            self.connect.exchange_many(packages, retry=SOUND_UPLOAD_ATTEMPTS)
+
+        curr_pos = 0
+        first_pos = 0
+        block_size = block_size or self.sound_block_size
+        if not block_size and total_size:
+            index = next(index for index, sound_data in enumerate(sounds_data) if sound_data)
+            block_size, first_pos = negotiate_block_size(
+                lambda size: self._write_sound_first(sounds[index].number, sounds_data[index], size),
+                self.SOUND_BLOCK_SIZES)
+            self.sound_block_size = block_size
+            curr_pos = first_pos
+
+        def parts():
+            start_pos = first_pos
+            for sound, sound_data in zip(sounds, sounds_data):
+                if start_pos >= len(sound_data):
+                    start_pos -= len(sound_data)
+                    continue
+                yield from self._sound_parts(sound.number, sound_data, block_size, start_pos)
+                start_pos = 0
+
+        streams = {sound.number: sound_data for sound, sound_data in zip(sounds, sounds_data)}
+        label = sounds[0].number if len(sounds) == 1 else 'sounds'
         prev_percent = 0
-        with open(file_name, 'rb') as sound_file:
-            curr_pos = 0
-            block_size = 32
-
-            while True:
-                block = sound_file.read(block_size)
-                if not block:
-                    return
-
-                self.write_sound_file_part(number, curr_pos, block)
-                curr_pos += len(block)
-                percent = int(curr_pos/file_size*100)
-                if percent != prev_percent:
-                    print("{}: {}%".format(number, percent))
-                    prev_percent = percent
+        for size in write_pipelined(self.connect, self.COMMAND_WRITE_SOUND_FILE, parts(), window,
+                                    SOUND_UPLOAD_ATTEMPTS, lambda part: self._is_sound_part_written(streams, part)):
+            curr_pos += size
+            percent = int(curr_pos/total_size*100)
+            if percent != prev_percent:
+                print("{}: {}%".format(label, percent))
+                prev_percent = percent
+
+    def _write_sound_first(self, number: int, sound_data: memoryview, block_size: int) -> int:
+        block = sound_data[:block_size]
+        if block:
+            try:
+                self.write_sound_file_part(number, 0, block)
+            except DKConnectGotErrorCode:
+                # The error may answer a retry after a lost answer, a rejected size is not written
+                if not self._is_sound_part_written({number: sound_data}, TransferPart(0, None, len(block), number)):
+                    raise
+        return len(block)
+
+    def _is_sound_part_written(self, streams: dict, part: TransferPart) -> bool:
+        # Reads the block back from the sound flash
+        try:
+            info = SoundInfo(*self.request(self.COMMAND_GET_SOUND_INFO, part.stream, retry=SOUND_UPLOAD_ATTEMPTS))
+            data = b''.join(data for _, data in self.read_flash_stream(info.pos + part.pos, part.size))
+        except DKConnectGotErrorCode:
+            return False
+
+        return data == streams[part.stream][part.pos:part.pos + part.size]
+
+    @classmethod
+    def _sound_parts(cls, number: int, sound_data: memoryview, block_size: int, curr_pos: int = 0):
+        header = cls.SCHEMA[cls.COMMAND_WRITE_SOUND_FILE].request
+        for pos in range(curr_pos, len(sound_data), block_size):
+            block = sound_data[pos:pos + block_size]
+            yield TransferPart(pos, (header.pack(number, pos), block), len(block), number)
 
     def get_sound_info(self, number: int, ) -> Union[SoundInfo, None]:
-        params = int16_to_bytes(number)
-        data = self.connect.exchange(self.COMMAND_GET_SOUND_INFO, params, is_silent=True)
-        if not data:
+        values = self.request(self.COMMAND_GET_SOUND_INFO, number, is_silent=True)
+        if values is None:
             return None
 
-        return SoundInfo.unpack(data)
+        return SoundInfo(*values)
 
     def reset_sounds(self):
-        self.connect.exchange(self.COMMAND_RESET_SOUNDS)
+        self.request(self.COMMAND_RESET_SOUNDS)
 
     def write_hardware_version(self, product: int, major: int, minor: int, patch: int):
-        version = int16_to_bytes(product) + int16_to_bytes(major) + int16_to_bytes(minor) + int16_to_bytes(patch)
-        data = self.connect.exchange(self.COMMAND_WRITE_HARDWARE_VERSION, version)
+        data = self.request(self.COMMAND_WRITE_HARDWARE_VERSION, product, major, minor, patch)
+        self.invalidate_info_cache()
         return data
 
     def read_flash(self, addr=0, length=256):
-        params = int32_to_bytes(addr) + int16_to_bytes(length)
-        data = self.connect.exchange(self.COMMAND_READ_FLASH, params)
-        return data
+        return self.request(self.COMMAND_READ_FLASH, addr, length)
+
+    def read_flash_stream(self, addr: int, length: int, block_size: int = READ_FLASH_BLOCK_SIZE,
+                          window: int = READ_FLASH_WINDOW):
+        # Yields (addr, data) chunks of the region, `window` reads are pipelined per round trip
+        pos = addr
+        end = addr + length
+        while pos < end:
+            blocks = []
+            while pos < end and len(blocks) < window:
+                size = min(block_size, end - pos)
+                blocks.append((pos, size))
+                pos += size
+
+            spec = self.SCHEMA[self.COMMAND_READ_FLASH]
+            packages = [(self.COMMAND_READ_FLASH, spec.encode(block_pos, size)) for block_pos, size in blocks]
+            responses = self.connect.exchange_many(packages, retry=READ_FLASH_ATTEMPTS)
+
+            for (block_pos, size), data in zip(blocks, responses):
+                if len(data) != size:
+                    raise DKConnectError('Short flash read at {}: {} of {}'.format(block_pos, len(data), size))
+
+                yield block_pos, data
+
+    def read_flash_into(self, buffer, addr: int, length: int = None, offset: int = 0, **kwargs) -> int:
+        # Reads into a writable buffer (bytearray, mmap), buffer[0] is flash[addr].
+        # offset resumes an interrupted read. Returns the number of bytes read.
+        view = memoryview(buffer)
+        length = len(view) if length is None else length
+        for pos, data in self.read_flash_stream(addr + offset, length - offset, **kwargs):
+            view[pos - addr:pos - addr + len(data)] = data
+
+        return length - offset
+
+    def read_flash_to_file(self, file_name: str, addr: int, length: int, md5: bytes = None,
+                           resume: bool = False, **kwargs) -> bytes:
+        # Dumps the region to a file and returns its MD5, a mismatch with `md5` raises.
+        # With resume an existing partial dump is continued from its end, e.g. after
+        # a disconnect. It is kept only when its last block matches the flash.
+        offset = 0
+        if resume and os.path.exists(file_name):
+            offset = self._dump_resume_offset(file_name, addr, length, kwargs.get('block_size', READ_FLASH_BLOCK_SIZE))
+
+        with open(file_name, 'r+b' if offset else 'wb') as dump_file:
+            dump_file.truncate(offset)
+            dump_file.seek(offset)
+            if offset:
+                logging.info('Resuming flash dump at {} of {}'.format(offset, length))
+
+            for _, data in self.read_flash_stream(addr + offset, length - offset, **kwargs):
+                dump_file.write(data)
+
+        digest = file_md5(file_name)
+        if md5 is not None and md5 != digest:
+            raise DKConnectError('Flash dump MD5 mismatch: {}, expected: {}'.format(digest.hex(), md5.hex()))
+
+        return digest
+
+    def _dump_resume_offset(self, file_name: str, addr: int, length: int, block_size: int) -> int:
+        # A file longer than the region or with a different last block is not a partial
+        # dump of this region, it is read again from the start
+        size = os.path.getsize(file_name)
+        if size == 0 or size > length:
+            return 0
+
+        check_size = min(block_size, size)
+        with open(file_name, 'rb') as dump_file:
+            dump_file.seek(size - check_size)
+            tail = dump_file.read(check_size)
+
+        if self.read_flash(addr + size - check_size, check_size) != tail:
+            logging.warning('Flash dump does not match the device, reading again: {}'.format(file_name))
+            return 0
+
+        return size
 
     def jump_to_stm_bootloader(self):
         self.connect.send(self.COMMAND_JUMP_TO_STM_BOOTLOADER, None)
         self.connect.disconnect()
 
     def get_rdp_level(self) -> int:
-        data = self.connect.exchange(self.COMMAND_GET_RDP_LEVEL)
-        return bytes_to_uint(data)
+        return self.request(self.COMMAND_GET_RDP_LEVEL)
 
     def set_rdp_level(self, level: int):
-        params = int8_to_bytes(level)
-        self.connect.exchange(self.COMMAND_SET_RDP_LEVEL, params)
+        self.request(self.COMMAND_SET_RDP_LEVEL, level)
 
     def start_tests(self):
-        self.connect.exchange(self.COMMAND_START_TESTS)
+        self.request(self.COMMAND_START_TESTS)
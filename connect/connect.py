@@ -1,8 +1,16 @@
+import functools
 import logging
 import time
 from typing import Union
 
-from .utils import bytes_to_uint
+from .batch import DKBatch
+from .frame import FRAME_OVERHEAD, FrameBuffer, FrameCrcError, FrameDecoder
+from .metrics import ERROR_CODE, ERROR_CRC, ERROR_DISCONNECT, ERROR_MISMATCH, ERROR_TIMEOUT
+from .retry import RetryPolicy, quantize_timeout
+from .utils import bytes_to_uint, int32_to_bytes
+
+
+RESYNC_ATTEMPTS = 3
 
 
 class DKConnectError(Exception):
@@ -24,12 +32,38 @@ class DKConnectDisconnectedError(DKConnectError):
     pass
 
 
+class DKConnectCrcError(DKConnectError):
+    pass
+
+
 class DKConnectGotErrorCode(Exception):
     def __init__(self, error_code, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.error_code = error_code
 
 
+def make_serial(serial_class='py_serial'):
+    logging.debug('Serial class: {}'.format(serial_class))
+
+    if serial_class == 'py_serial':
+        from .interfaces.py_serial import PySerial
+        return PySerial()
+    elif serial_class == 'qt_serial':
+        from .interfaces.qt_serial import QtSerial
+        return QtSerial()
+    elif serial_class == 'simulator':
+        from .interfaces.simulator import SimulatorSerial
+        return SimulatorSerial()
+    elif isinstance(serial_class, type) or isinstance(serial_class, functools.partial):
+        # Interface factory, each call gives a new interface object
+        return serial_class()
+    elif not isinstance(serial_class, str):
+        # Already configured interface object, e.g. SimulatorSerial(latency=0.002)
+        return serial_class
+    else:
+        raise NotImplementedError
+
+
 class DKConnect:
     COMMAND_ECHO = 0
     COMMAND_GET_NAME = 1
@@ -38,21 +72,20 @@ class DKConnect:
     DK_VID = 1155
     DK_PID = 22336
 
-    def __init__(self, serial_class='py_serial'):
-        logging.debug('Serial class: {}'.format(serial_class))
-
-        if serial_class == 'py_serial':
-            from .interfaces.py_serial import PySerial
-            self.serial = PySerial()
-        elif serial_class == 'qt_serial':
-            from .interfaces.qt_serial import QtSerial
-            self.serial = QtSerial()
-        else:
-            raise NotImplementedError
+    def __init__(self, serial_class='py_serial', retry_policy: RetryPolicy = None):
+        self.serial = make_serial(serial_class)
+        self.retry_policy = retry_policy or RetryPolicy()
 
         self._is_connect = False
         self._device_name = None
         self._default_timeout = 1
+        self._serial_timeout = None
+        self._late_responses = 0
+        self._resync_token = 0
+        self._decoder = FrameDecoder()
+        self._frame_buffer = FrameBuffer(4096)
+        self.info_cache = None
+        self.hooks = []
 
     def is_connect(self):
         return self._is_connect
@@ -63,99 +96,217 @@ class DKConnect:
     def find_and_connect(self) -> bool:
         ports = self.serial.get_devices()
         for port in ports:
-            if not (port.vid == self.DK_VID and port.pid == self.DK_PID):
+            if not self.is_dk_port(port):
                 continue
 
-            if not self.serial.connect(port.port_obj, self._default_timeout):
-                logging.info('Connecting error, vid({}), pid({})'.format(port.vid, port.pid))
-                continue
+            if self.connect_port(port):
+                return True
 
-            self._is_connect = True
+        return False
 
-            try:
-                self._device_name = self._get_device_name()
-            except DKConnectError as exc:
-                logging.info('Get device name error, vid({}), pid({})'.format(port.vid, port.pid), exc_info=True)
-                self.disconnect()
-                continue
+    @classmethod
+    def is_dk_port(cls, port) -> bool:
+        return port.vid == cls.DK_VID and port.pid == cls.DK_PID
 
-            # Если удалось получить имя устройства, считаем что это устройство DK
-            logging.info('Connected, device_name({}), vid({}), pid({})'.format(self._device_name, port.vid, port.pid))
-            return True
+    def connect_port(self, port) -> bool:
+        if not self.serial.connect(port.port_obj, self._default_timeout):
+            logging.info('Connecting error, vid({}), pid({})'.format(port.vid, port.pid))
+            return False
 
-        return False
+        self._decoder.reset()
+        self._serial_timeout = self._default_timeout
+        self._late_responses = 0
+
+        self._is_connect = True
+
+        try:
+            self._device_name = self._get_device_name()
+        except DKConnectError as exc:
+            logging.info('Get device name error, vid({}), pid({})'.format(port.vid, port.pid), exc_info=True)
+            self.disconnect()
+            return False
+
+        # Если удалось получить имя устройства, считаем что это устройство DK
+        logging.info('Connected, device_name({}), vid({}), pid({})'.format(self._device_name, port.vid, port.pid))
+        return True
 
     def disconnect(self):
         logging.info('Disconnecting')
         self._is_connect = False
         self.serial.close()
 
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+
+    def remove_hook(self, hook):
+        self.hooks.remove(hook)
+
+    def notify(self, event: str, *args):
+        for hook in self.hooks:
+            getattr(hook, event)(*args)
+
     def clear(self):
         self.serial.clear()
-
-    def send(self, command: int, data: Union[bytes, None]):
+        self._decoder.reset()
+        self._late_responses = 0
+
+    def add_late_responses(self, count: int = 1):
+        # Answers to requests that were given up may still arrive, the next exchange resyncs first
+        self._late_responses += count
+
+    def sync(self):
+        if self._late_responses:
+            self.resync()
+
+    def resync(self, attempts: int = RESYNC_ATTEMPTS):
+        # Frames carry no request id, a late answer would be taken for the answer to the
+        # next request of its command. The device answers in order: everything received
+        # before the echo of a fresh token is stale and dropped.
+        for attempt in range(1, attempts + 1):
+            self._resync_token = (self._resync_token + 1) & 0xFFFFFFFF
+            token = int32_to_bytes(self._resync_token)
+            self.send(self.COMMAND_ECHO, token)
+
+            deadline = time.monotonic() + self.retry_policy.timeout(self.COMMAND_ECHO, attempt)
+            while True:
+                try:
+                    receive_command, receive_data = self.receive(deadline - time.monotonic())
+                except DKConnectCrcError:
+                    continue
+                except DKConnectResponseTimoutError:
+                    # The echo is due, a frame still waited on has a garbage size field
+                    self._decoder.resync()
+                    break
+
+                if receive_command == self.COMMAND_ECHO and receive_data == token:
+                    self._late_responses = 0
+                    return
+
+                logging.info('Skipped late response, command: {}'.format(receive_command))
+
+        raise DKConnectResponseTimoutError
+
+    def send(self, command: int, data: Union[bytes, tuple, None]):
+        self.send_many([(command, data)])
+
+    def send_many(self, packages):
+        # Several frames in one buffered write, for pipelined transfers.
+        # Frames are built in a reused buffer, data may be a tuple of chunks.
         if not self.is_connect():
             raise DKConnectDisconnectedError
 
-        command_size = 2
-        data_size = len(data) if data else 0
-        crc_size = 4
-        package_size = (command_size + data_size + crc_size).to_bytes(2, byteorder='little')
-        package_command = command.to_bytes(2, byteorder='little')
-        package_data = data or b''
+        frame_buffer = self._frame_buffer
+        frame_buffer.clear()
+        for command, data in packages:
+            length = frame_buffer.length
+            frame_buffer.append(command, data)
+            if self.hooks:
+                self.notify('on_send', command, frame_buffer.length - length)
 
-        package_crc = self._crc_stm32(package_size + package_command + package_data)
-        package_crc = package_crc.to_bytes(4, byteorder='little')
+        if not frame_buffer.length:
+            return
 
-        package = package_size + package_command + package_data + package_crc
         try:
-            self.serial.write(package)
+            self.serial.write(frame_buffer.view())
         except OSError:
             self._is_connect = False
+            self.notify('on_error', None, ERROR_DISCONNECT)
             raise DKConnectError
 
-    def receive(self) -> (int, bytes):
+    def receive(self, timeout: float = None) -> (int, bytes):
+        # Waits for one frame until the deadline, sleeping in the serial read
         if not self.is_connect():
             raise DKConnectDisconnectedError
 
-        package_size = self.read(2)
-        if not package_size:
-            raise DKConnectResponseTimoutError
+        deadline = time.monotonic() + (timeout if timeout is not None else self._default_timeout)
+        is_stalled = True
+        while True:
+            try:
+                frame = self._decoder.next_frame()
+            except FrameCrcError as exc:
+                logging.warning('CRC mismatch, command: {}'.format(exc.command))
+                self.notify('on_error', exc.command, ERROR_CRC)
+                raise DKConnectCrcError
+
+            if frame:
+                if self.hooks:
+                    self.notify('on_receive', frame[0], FRAME_OVERHEAD + len(frame[1]))
+                return frame
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                # A frame that is still arriving is kept, a stalled one is garbage
+                if is_stalled:
+                    self._decoder.resync()
+                raise DKConnectResponseTimoutError
 
-        package_size = package_size[1] * 256 + package_size[0]
+            self._set_timeout(remaining)
+            data = self.read_available()
+            if data:
+                is_stalled = False
+                self._decoder.feed(data)
 
-        package_command = self.read(2)
-        package_command = package_command[1] * 256 + package_command[0]
+    def receive_wait(self, timeout=30.0) -> (int, bytes):
+        return self.receive(timeout)
 
-        package_data = self.read(package_size - 2 - 4)
+    def exchange(self, command: int, data: Union[bytes, None] = None, retry=0, is_silent=False, timeout=None):
+        # timeout replaces the retry policy timeout of the command for this call
+        if not self.is_connect():
+            raise DKConnectDisconnectedError
 
-        package_crc = self.read(4)
+        tries = 0
+        receive_command, receive_data = None, None
+        exchange_exception = None
+        while True:
+            tries += 1
 
-        return package_command, package_data
+            if tries > retry + 1:
+                raise exchange_exception
 
-    def receive_wait(self, timeout=30.0) -> (int, bytes):
-        start_time = time.time()
-        while True:
+            if tries > 1:
+                logging.warning("Exchange error, repeat. Attempt number: {}".format(tries))
+                self.notify('on_retry', command, tries)
+
+            attempt_timeout = self.retry_policy.timeout(command, tries, timeout)
             try:
-                receive_command, receive_data = self.receive()
-                return receive_command, receive_data
-            except DKConnectResponseTimoutError:
-                pass
+                if tries == 1:
+                    first_start_time = time.monotonic()
+                self.sync()
+                start_time = time.monotonic()
+                self.send(command, data)
+                receive_command, receive_data = self.receive(attempt_timeout)
+            except DKConnectResponseTimoutError as exc:
+                # The device may still answer, that answer is dropped by the next resync
+                self.add_late_responses()
+                self.notify('on_error', command, ERROR_TIMEOUT)
+                exchange_exception = exc
+                continue
+            except DKConnectError as exc:
+                if self.is_connect():
+                    self.add_late_responses()
+                exchange_exception = exc
+                continue
 
-            if time.time() - start_time > timeout:
-                raise DKConnectResponseTimoutError
+            if tries == 1:
+                self.retry_policy.observe(command, time.monotonic() - start_time)
+
+            break
 
-            time.sleep(0.01)
+        if self.hooks:
+            self.notify('on_exchange', command, time.monotonic() - first_start_time, tries)
 
-    def exchange(self, command: int, data: Union[bytes, None] = None, retry=0, is_silent=False, timeout=None):
+        return self._check_response(command, receive_command, receive_data, is_silent)
+
+    def exchange_many(self, packages, retry=0, is_silent=False) -> list:
+        # Pipelined exchange: all requests go out in one write, then the responses
+        # are collected in order. The whole batch is repeated on error, so the
+        # requests must be safe to repeat.
         if not self.is_connect():
             raise DKConnectDisconnectedError
 
-        # if timeout:
-        #     self.serial.set_timeout(timeout)
-
+        packages = list(packages)
         tries = 0
-        receive_command, receive_data = None, None
+        responses = []
         exchange_exception = None
         while True:
             tries += 1
@@ -165,22 +316,50 @@ class DKConnect:
 
             if tries > 1:
                 logging.warning("Exchange error, repeat. Attempt number: {}".format(tries))
+                for command, _ in packages:
+                    self.notify('on_retry', command, tries)
 
             try:
-                self.send(command, data)
-                receive_command, receive_data = self.receive()
-                # receive_command, receive_data = self.receive_wait(0.2)
+                self.sync()
+                start_time = time.monotonic()
+                self.send_many(packages)
+                responses = []
+                for command, _ in packages:
+                    try:
+                        responses.append(self.receive(self.retry_policy.timeout(command, tries)))
+                    except DKConnectResponseTimoutError:
+                        self.notify('on_error', command, ERROR_TIMEOUT)
+                        raise
+
+                    if tries == 1 and len(responses) == 1:
+                        self.retry_policy.observe(command, time.monotonic() - start_time)
+                    if self.hooks:
+                        self.notify('on_exchange', command, time.monotonic() - start_time, tries)
             except DKConnectError as exc:
                 exchange_exception = exc
+                if self.is_connect():
+                    # The rest of the batch may still be answered
+                    self.add_late_responses(len(packages) - len(responses))
                 continue
 
             break
 
-        # if timeout:
-        #     self.serial.set_timeout(self._default_timeout)
+        return [self._check_response(command, receive_command, receive_data, is_silent)
+                for (command, _), (receive_command, receive_data) in zip(packages, responses)]
+
+    def batch(self, retry=0, is_silent=False) -> DKBatch:
+        return DKBatch(self, retry=retry, is_silent=is_silent)
+
+    def _set_timeout(self, timeout: float):
+        timeout = quantize_timeout(timeout)
+        if timeout != self._serial_timeout:
+            self._serial_timeout = timeout
+            self.serial.set_timeout(timeout)
 
+    def _check_response(self, command: int, receive_command: int, receive_data: bytes, is_silent: bool):
         if receive_command == self.COMMAND_ERROR:
             logging.warning("Received error: {}".format(bytes_to_uint(receive_data)))
+            self.notify('on_error', command, ERROR_CODE, bytes_to_uint(receive_data))
 
             if not is_silent:
                 raise DKConnectGotErrorCode(bytes_to_uint(receive_data))
@@ -189,6 +368,7 @@ class DKConnect:
 
         if receive_command != command and not is_silent:
             logging.warning("Mismatch commands. Expected: {}, received: {}".format(command, receive_command))
+            self.notify('on_error', command, ERROR_MISMATCH)
 
             if not is_silent:
                 raise DKConnectCommandsMismatch(command, receive_command)
@@ -204,6 +384,15 @@ class DKConnect:
             return self.serial.read(size)
         except (IOError, OSError):
             self._is_connect = False
+            self.notify('on_error', None, ERROR_DISCONNECT)
+            raise DKConnectError
+
+    def read_available(self) -> bytes:
+        try:
+            return self.serial.read_available()
+        except (IOError, OSError):
+            self._is_connect = False
+            self.notify('on_error', None, ERROR_DISCONNECT)
             raise DKConnectError
 
     def readline(self) -> bytes:
@@ -211,18 +400,5 @@ class DKConnect:
             return self.serial.readline()
         except (IOError, OSError):
             self._is_connect = False
+            self.notify('on_error', None, ERROR_DISCONNECT)
             raise DKConnectError
-
-    def _crc_stm32(self, data):
-        # Computes CRC checksum using CRC-32 polynomial
-        crc = 0xFFFFFFFF
-
-        for d in data:
-            crc ^= d
-            for i in range(32):
-                if crc & 0x80000000:
-                    crc = (crc << 1) ^ 0x04C11DB7  # Polynomial used in STM32
-                else:
-                    crc = (crc << 1)
-
-        return crc & 0xFFFFFFFF
@@ -0,0 +1,161 @@
+import logging
+
+try:
+    import zlib
+except ImportError:
+    zlib = None
+
+
+# STM32 hardware CRC unit: CRC-32 polynomial, MSB first, no reflection, no final xor.
+# The device feeds every byte of a frame as a separate 32-bit word, so each byte
+# is xored into the low bits of the register and then shifted 32 times.
+CRC_POLYNOMIAL = 0x04C11DB7
+CRC_INIT = 0xFFFFFFFF
+
+
+def _make_table():
+    table = []
+    for i in range(256):
+        crc = i << 24
+        for _ in range(8):
+            if crc & 0x80000000:
+                crc = ((crc << 1) ^ CRC_POLYNOMIAL) & 0xFFFFFFFF
+            else:
+                crc = (crc << 1) & 0xFFFFFFFF
+        table.append(crc)
+    return table
+
+
+def _make_slicing_tables(table):
+    # Shifting a 32-bit word 32 times is linear, so it can be split into four
+    # independent lookups, one per byte position of the word.
+    tables = [table]
+    for _ in range(3):
+        prev = tables[-1]
+        tables.append([((prev[i] << 8) & 0xFFFFFFFF) ^ table[prev[i] >> 24] for i in range(256)])
+    return tables[0], tables[1], tables[2], tables[3]
+
+
+_TABLE = _make_table()
+_SLICE_0, _SLICE_1, _SLICE_2, _SLICE_3 = _make_slicing_tables(_TABLE)
+_BIT_REVERSE = bytes(int('{:08b}'.format(i)[::-1], 2) for i in range(256))
+
+
+def crc_stm32_bitwise(data, crc=CRC_INIT) -> int:
+    # Reference implementation, kept for self-test
+    for d in data:
+        crc ^= d
+        for i in range(32):
+            if crc & 0x80000000:
+                crc = (crc << 1) ^ CRC_POLYNOMIAL
+            else:
+                crc = (crc << 1)
+
+    return crc & 0xFFFFFFFF
+
+
+def crc_stm32_table(data, crc=CRC_INIT) -> int:
+    table = _TABLE
+    for d in data:
+        crc ^= d
+        crc = ((crc << 8) & 0xFFFFFFFF) ^ table[crc >> 24]
+        crc = ((crc << 8) & 0xFFFFFFFF) ^ table[crc >> 24]
+        crc = ((crc << 8) & 0xFFFFFFFF) ^ table[crc >> 24]
+        crc = ((crc << 8) & 0xFFFFFFFF) ^ table[crc >> 24]
+
+    return crc
+
+
+def crc_stm32_slicing(data, crc=CRC_INIT) -> int:
+    t0, t1, t2, t3 = _SLICE_0, _SLICE_1, _SLICE_2, _SLICE_3
+    for d in data:
+        crc ^= d
+        crc = t0[crc & 0xFF] ^ t1[(crc >> 8) & 0xFF] ^ t2[(crc >> 16) & 0xFF] ^ t3[crc >> 24]
+
+    return crc
+
+
+def _reflect32(value: int) -> int:
+    return int.from_bytes(value.to_bytes(4, byteorder='big').translate(_BIT_REVERSE), byteorder='little')
+
+
+def crc_stm32_zlib(data, crc=CRC_INIT) -> int:
+    # Each byte fed as a word is the byte stream 00 00 00 dd, and a non-reflected
+    # CRC equals the reflected zlib CRC-32 of bit-reversed input, so the whole
+    # computation runs in C. Zero bytes stay zero when reversed, so only the
+    # data bytes are translated. data may be any buffer, e.g. a memoryview.
+    words = bytearray(len(data) * 4)
+    words[3::4] = bytes(data).translate(_BIT_REVERSE)
+    value = zlib.crc32(words, _reflect32(crc) ^ 0xFFFFFFFF)
+    return _reflect32(value ^ 0xFFFFFFFF)
+
+
+ENGINES = {
+    'bitwise': crc_stm32_bitwise,
+    'table': crc_stm32_table,
+    'slicing': crc_stm32_slicing,
+}
+
+if zlib is not None:
+    ENGINES['zlib'] = crc_stm32_zlib
+
+ENGINES_PRIORITY = ['zlib', 'slicing', 'table', 'bitwise']
+
+_SELF_TEST_VECTORS = [b'', b'\x00', b'\xff', b'ping', bytes(range(256)), bytes((i * 37 + 11) & 0xFF for i in range(61))]
+
+
+def self_test(engine) -> bool:
+    for vector in _SELF_TEST_VECTORS:
+        if engine(vector) != crc_stm32_bitwise(vector):
+            return False
+
+        if engine(memoryview(vector)) != crc_stm32_bitwise(vector):
+            return False
+
+        # Chained computation must match the one-shot result
+        half = len(vector) // 2
+        if engine(vector[half:], engine(vector[:half])) != crc_stm32_bitwise(vector):
+            return False
+
+    return True
+
+
+_engine = crc_stm32_bitwise
+_engine_name = 'bitwise'
+
+
+def engine_name() -> str:
+    return _engine_name
+
+
+def set_engine(name: str):
+    global _engine, _engine_name
+
+    engine = ENGINES[name]
+    if not self_test(engine):
+        raise ValueError('CRC engine {} failed self-test'.format(name))
+
+    _engine = engine
+    _engine_name = name
+    logging.debug('CRC engine: {}'.format(name))
+
+
+def select_engine() -> str:
+    for name in ENGINES_PRIORITY:
+        if name not in ENGINES:
+            continue
+
+        try:
+            set_engine(name)
+        except ValueError:
+            logging.warning('CRC engine {} failed self-test, skipping'.format(name))
+            continue
+
+        return name
+
+
+def crc_stm32(data, crc=CRC_INIT) -> int:
+    return _engine(data, crc)
+
+
+select_engine()
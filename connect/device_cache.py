@@ -0,0 +1,88 @@
+import json
+import logging
+import os
+import threading
+
+
+DEFAULT_CACHE_FILE = os.path.join(os.path.expanduser('~'), '.dk_device_cache.json')
+
+
+class DeviceInfoCache:
+    # Slow-changing device info (versions, license) keyed by UID and device name,
+    # so the bootloader and the app of one device have separate entries.
+    # Saved to a JSON file when file_name is set, otherwise kept in memory only.
+    # One cache may be shared by the connections of several threads.
+
+    BYTES_KEYS = ('uid', 'license_key')
+    TUPLE_KEYS = ('software_version', 'hardware_version')
+
+    def __init__(self, file_name: str = None):
+        self.file_name = file_name
+        self.devices = {}
+        self._lock = threading.Lock()
+
+        if file_name:
+            self.load()
+
+    def load(self):
+        try:
+            with open(self.file_name) as cache_file:
+                self.devices = json.load(cache_file)
+        except FileNotFoundError:
+            self.devices = {}
+        except (OSError, ValueError):
+            logging.warning('Device cache is broken, starting empty: {}'.format(self.file_name), exc_info=True)
+            self.devices = {}
+
+    def save(self):
+        if not self.file_name:
+            return
+
+        # The temporary file is shared, one thread writes it at a time
+        with self._lock:
+            data = json.dumps(self.devices, indent=2, sort_keys=True)
+
+            tmp_file_name = self.file_name + '.tmp'
+            try:
+                with open(tmp_file_name, 'w') as cache_file:
+                    cache_file.write(data)
+                os.replace(tmp_file_name, self.file_name)
+            except OSError:
+                logging.warning('Device cache is not saved: {}'.format(self.file_name), exc_info=True)
+
+    def get(self, uid: bytes, name: str) -> dict:
+        with self._lock:
+            info = self.devices.get(uid.hex(), {}).get(name)
+
+        return self._decode(info) if info is not None else None
+
+    def put(self, info: dict):
+        with self._lock:
+            self.devices.setdefault(info['uid'].hex(), {})[info['name']] = self._encode(info)
+
+        self.save()
+
+    def invalidate(self, uid: bytes):
+        with self._lock:
+            if self.devices.pop(uid.hex(), None) is None:
+                return
+
+        logging.info('Device cache invalidated: {}'.format(uid.hex()))
+        self.save()
+
+    def _encode(self, info: dict) -> dict:
+        info = dict(info)
+        for key in self.BYTES_KEYS:
+            if key in info:
+                info[key] = info[key].hex()
+        return info
+
+    def _decode(self, info: dict) -> dict:
+        info = dict(info)
+        for key in self.BYTES_KEYS:
+            if key in info:
+                info[key] = bytes.fromhex(info[key])
+        for key in self.TUPLE_KEYS:
+            if key in info:
+                info[key] = tuple(info[key])
+        return info
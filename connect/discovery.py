@@ -0,0 +1,167 @@
+import logging
+import threading
+import time
+
+from .connect import DKConnect
+
+try:
+    import pyudev
+except ImportError:
+    pyudev = None
+
+
+POLL_INTERVAL = 0.5
+FAILED_RETRY_INTERVAL = 5.0
+
+
+class PortDiscovery:
+    # Keeps the list of serial ports up to date in a background thread.
+    # On Linux udev events trigger a new enumeration, elsewhere ports are polled.
+    # Only the port list is read, DK ports are probed by the caller. Ports that
+    # are not DK devices are remembered by name and not checked again, ports that
+    # failed probing are skipped until they are plugged again or FAILED_RETRY_INTERVAL passes.
+    # listener(event, port) is called from the discovery thread, event is 'add' or 'remove'.
+
+    EVENT_ADD = 'add'
+    EVENT_REMOVE = 'remove'
+
+    def __init__(self, serial, poll_interval: float = POLL_INTERVAL, use_udev: bool = True):
+        self.serial = serial
+        self.poll_interval = poll_interval
+        self.use_udev = use_udev and pyudev is not None
+
+        self.ports = {}
+        self.foreign_ports = set()
+        self.failed_ports = {}
+        self.listeners = []
+
+        self._lock = threading.Lock()
+        self._generation = 0
+        self._changed = threading.Condition()
+        self._thread = None
+        self._observer = None
+        self._is_running = False
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def start(self):
+        if self._is_running:
+            return
+
+        self._is_running = True
+        self.refresh()
+
+        if self.use_udev:
+            try:
+                self._start_udev()
+                return
+            except (OSError, ImportError):
+                logging.info('udev monitor is not available, polling ports', exc_info=True)
+
+        self._thread = threading.Thread(target=self._poll, name='dk-port-discovery', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._is_running = False
+        if self._observer:
+            self._observer.send_stop()
+            self._observer = None
+
+        with self._changed:
+            self._changed.notify_all()
+
+    def is_running(self) -> bool:
+        return self._is_running
+
+    def generation(self) -> int:
+        return self._generation
+
+    def refresh(self):
+        ports = {port.name: port for port in self.serial.get_devices()}
+
+        with self._lock:
+            added = [port for name, port in ports.items() if name not in self.ports]
+            removed = [port for name, port in self.ports.items() if name not in ports]
+            self.ports = ports
+
+            for port in removed:
+                self.foreign_ports.discard(port.name)
+                self.failed_ports.pop(port.name, None)
+
+            for port in added:
+                if not DKConnect.is_dk_port(port):
+                    self.foreign_ports.add(port.name)
+
+            dk_added = [port for port in added if port.name not in self.foreign_ports]
+
+        if dk_added:
+            logging.info('DK ports found: {}'.format(', '.join(port.name for port in dk_added)))
+            with self._changed:
+                self._generation += 1
+                self._changed.notify_all()
+
+        for port in removed:
+            self._notify(self.EVENT_REMOVE, port)
+        for port in dk_added:
+            self._notify(self.EVENT_ADD, port)
+
+    def candidates(self, port_name: str = None) -> list:
+        # DK ports worth probing right now, port_name limits them to one port
+        now = time.monotonic()
+        with self._lock:
+            return [port for name, port in self.ports.items()
+                    if name not in self.foreign_ports and self.failed_ports.get(name, 0) <= now and
+                    (port_name is None or name == port_name)]
+
+    def find_and_connect(self, connect: DKConnect, port_name: str = None) -> bool:
+        for port in self.candidates(port_name):
+            if connect.connect_port(port):
+                return True
+
+            with self._lock:
+                self.failed_ports[port.name] = time.monotonic() + FAILED_RETRY_INTERVAL
+
+        return False
+
+    def wait_for_device(self, timeout: float = None, since: int = None) -> bool:
+        # Waits until a DK port appears after the `since` generation, False on timeout or stop
+        if since is None:
+            since = self._generation
+
+        if not self._is_running:
+            self.refresh()
+            return self._generation != since
+
+        with self._changed:
+            self._changed.wait_for(lambda: self._generation != since or not self._is_running, timeout)
+            return self._generation != since
+
+    def _notify(self, event: str, port):
+        for listener in self.listeners:
+            try:
+                listener(event, port)
+            except Exception:
+                logging.warning('Port discovery listener error', exc_info=True)
+
+    def _poll(self):
+        while self._is_running:
+            try:
+                self.refresh()
+            except OSError:
+                logging.debug('Port enumeration error', exc_info=True)
+
+            with self._changed:
+                self._changed.wait_for(lambda: not self._is_running, self.poll_interval)
+
+    def _start_udev(self):
+        context = pyudev.Context()
+        monitor = pyudev.Monitor.from_netlink(context)
+        monitor.filter_by(subsystem='tty')
+        self._observer = pyudev.MonitorObserver(monitor, callback=self._on_udev_event, name='dk-port-discovery')
+        self._observer.daemon = True
+        self._observer.start()
+
+    def _on_udev_event(self, device):
+        if device.action in ('add', 'remove'):
+            self.refresh()
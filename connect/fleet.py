@@ -0,0 +1,201 @@
+import functools
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Union
+
+from .bootloader import DKBootloaderCommands, FirmwareImage, UPLOAD_WINDOW
+from .connect import DKConnect, DKConnectError, DKConnectGotErrorCode, make_serial
+from . import build_commands, DEVICE_BOOTLOADER
+
+
+RECONNECT_TIMEOUT = 10.0
+RECONNECT_INTERVAL = 0.5
+
+
+class DKFleetError(Exception):
+    pass
+
+
+class FleetDeviceResult:
+    STAGE_WAIT = 'wait'
+    STAGE_CONNECT = 'connect'
+    STAGE_BOOTLOADER = 'bootloader'
+    STAGE_ERASE = 'erase'
+    STAGE_WRITE = 'write'
+    STAGE_CHECK = 'check'
+    STAGE_DONE = 'done'
+    STAGE_ERROR = 'error'
+
+    def __init__(self, port_name: str):
+        self.port_name = port_name
+        self.device_name = None
+        self.uid = None
+        self.stage = self.STAGE_WAIT
+        self.percent = 0
+        self.success = False
+        self.error = None
+        self.seconds = 0.0
+
+    def to_dict(self) -> dict:
+        return {
+            'port': self.port_name,
+            'device_name': self.device_name,
+            'uid': self.uid,
+            'stage': self.stage,
+            'percent': self.percent,
+            'success': self.success,
+            'error': self.error,
+            'seconds': self.seconds,
+        }
+
+
+class FleetFlasher:
+    # Flashes every connected DK device in parallel, one worker thread per port.
+    # The firmware image is loaded once and shared by all workers.
+    # progress(result) is called from worker threads on every stage or percent change.
+    # hooks are added to every connection, e.g. one MetricsCollector for the whole station.
+    # serial_class is a name, a class or a functools.partial: every worker builds its own
+    # transport, an interface object would be shared by all threads.
+
+    def __init__(self, firmware: Union[str, FirmwareImage], serial_class='py_serial', delta: bool = False,
+                 window: int = UPLOAD_WINDOW, max_workers: int = None, progress=None, go_to_app: bool = True,
+                 hooks: list = ()):
+        if not isinstance(serial_class, (str, type, functools.partial)):
+            raise TypeError('serial_class must be a name, a class or a functools.partial, not {}'.format(
+                type(serial_class).__name__))
+
+        self.image = FirmwareImage.open(firmware)
+        self.serial_class = serial_class
+        self.delta = delta
+        self.window = window
+        self.max_workers = max_workers
+        self.progress = progress
+        self.go_to_app = go_to_app
+        self.hooks = list(hooks)
+
+        self.results = {}
+        self._lock = threading.Lock()
+
+    def find_ports(self) -> list:
+        ports = make_serial(self.serial_class).get_devices()
+        return [port for port in ports if DKConnect.is_dk_port(port)]
+
+    def run(self, ports: list = None) -> list:
+        if ports is None:
+            ports = self.find_ports()
+
+        logging.info('Fleet flashing, devices: {}'.format(len(ports)))
+
+        for port in ports:
+            self.results[port.name] = FleetDeviceResult(port.name)
+
+        with ThreadPoolExecutor(max_workers=self.max_workers or max(1, len(ports))) as executor:
+            futures = {executor.submit(self._flash_port, port): port for port in ports}
+            for future in as_completed(futures):
+                self._check_worker(future, futures[future])
+
+        return [self.results[port.name] for port in ports]
+
+    def snapshot(self) -> list:
+        with self._lock:
+            return [result.to_dict() for result in self.results.values()]
+
+    def _update(self, result: FleetDeviceResult, stage: str = None, percent: int = 0):
+        with self._lock:
+            if stage:
+                result.stage = stage
+            result.percent = percent
+
+        if self.progress:
+            self.progress(result)
+
+    def _check_worker(self, future, port):
+        # An unexpected error fails its device only, the other workers go on
+        try:
+            future.result()
+        except Exception as exc:
+            logging.error('Fleet worker error, port: {}'.format(port.name), exc_info=True)
+            result = self.results[port.name]
+            result.error = repr(exc)
+            self._update(result, result.STAGE_ERROR)
+
+    def _flash_port(self, port):
+        result = self.results[port.name]
+        start_time = time.time()
+        connect = DKConnect(self.serial_class)
+        for hook in self.hooks:
+            connect.add_hook(hook)
+
+        try:
+            self._update(result, result.STAGE_CONNECT)
+            cmd = self._connect_bootloader(connect, port, result)
+            self._flash(cmd, result)
+        except (DKConnectError, DKConnectGotErrorCode, DKFleetError, OSError) as exc:
+            logging.warning('Fleet flashing error, port: {}'.format(port.name), exc_info=True)
+            result.error = repr(exc)
+            self._update(result, result.STAGE_ERROR)
+        finally:
+            result.seconds = time.time() - start_time
+            if connect.is_connect():
+                connect.disconnect()
+
+    def _connect_bootloader(self, connect: DKConnect, port, result: FleetDeviceResult) -> DKBootloaderCommands:
+        if not connect.connect_port(port):
+            raise DKFleetError('Device is not responding')
+
+        cmd = build_commands(connect)
+        result.uid = cmd.get_uid().hex()
+
+        if cmd.device_name() != DEVICE_BOOTLOADER:
+            self._update(result, result.STAGE_BOOTLOADER)
+            cmd.system_reset()
+            cmd = self._reconnect(connect, port.name)
+
+        result.device_name = cmd.device_name()
+        cmd.confirm()
+        return cmd
+
+    def _reconnect(self, connect: DKConnect, port_name: str) -> DKBootloaderCommands:
+        # After reset the device enumerates again, find it by its port name
+        deadline = time.time() + RECONNECT_TIMEOUT
+        while time.time() < deadline:
+            time.sleep(RECONNECT_INTERVAL)
+            for port in connect.serial.get_devices():
+                if port.name != port_name or not DKConnect.is_dk_port(port):
+                    continue
+
+                if connect.connect_port(port) and connect.device_name() == DEVICE_BOOTLOADER:
+                    return build_commands(connect)
+
+                if connect.is_connect():
+                    connect.disconnect()
+
+        raise DKFleetError('Bootloader did not appear on {}'.format(port_name))
+
+    def _flash(self, cmd: DKBootloaderCommands, result: FleetDeviceResult):
+        if self.delta:
+            gen = cmd.flash_write_delta_async(self.image, window=self.window)
+        else:
+            self._update(result, result.STAGE_ERASE)
+            cmd.flash_erase()
+            gen = cmd.flash_write_async(self.image, window=self.window)
+
+        self._update(result, result.STAGE_WRITE)
+        for percent in gen:
+            self._update(result, percent=percent)
+
+        self._update(result, result.STAGE_CHECK)
+        if not cmd.flash_check(self.image):
+            raise DKFleetError('Firmware checksum mismatch')
+
+        result.success = True
+        self._update(result, result.STAGE_DONE, 100)
+
+        if self.go_to_app:
+            cmd.go_to_app()
+
+
+def flash_fleet(firmware: Union[str, FirmwareImage], serial_class='py_serial', **kwargs) -> list:
+    return FleetFlasher(firmware, serial_class, **kwargs).run()
@@ -0,0 +1,171 @@
+import struct
+from typing import Union
+
+from .crc import crc_stm32
+
+
+# Frame layout: size(2) | command(2) | data(N) | crc(4), little endian.
+# The size field counts command, data and crc, but not itself.
+SIZE_SIZE = 2
+COMMAND_SIZE = 2
+CRC_SIZE = 4
+
+MIN_PACKAGE_SIZE = COMMAND_SIZE + CRC_SIZE
+FRAME_OVERHEAD = SIZE_SIZE + MIN_PACKAGE_SIZE
+MAX_PACKAGE_SIZE = 0xFFFF
+
+_HEADER = struct.Struct('<HH')
+_CRC = struct.Struct('<I')
+
+
+class FrameCrcError(Exception):
+    def __init__(self, command, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.command = command
+
+
+def encode_frame(command: int, data: Union[bytes, tuple, None]) -> bytes:
+    # data is a bytes-like object or a tuple of chunks sent back to back
+    frame = FrameBuffer()
+    frame.append(command, data)
+    return bytes(frame.buffer[:frame.length])
+
+
+class FrameBuffer:
+    # Reusable output buffer: frames are assembled in place, payload chunks
+    # (e.g. memoryview slices of a mapped file) are copied straight into it.
+
+    def __init__(self, size: int = 0):
+        self.buffer = bytearray(size)
+        self.length = 0
+
+    def clear(self):
+        self.length = 0
+
+    def append(self, command: int, data: Union[bytes, tuple, None]):
+        chunks = data if isinstance(data, tuple) else (data or b'',)
+        data_size = sum(len(chunk) for chunk in chunks)
+        start = self.length
+        end = start + SIZE_SIZE + COMMAND_SIZE + data_size + CRC_SIZE
+        if end > len(self.buffer):
+            self._grow(end)
+
+        buffer = self.buffer
+        _HEADER.pack_into(buffer, start, COMMAND_SIZE + data_size + CRC_SIZE, command)
+        pos = start + SIZE_SIZE + COMMAND_SIZE
+        for chunk in chunks:
+            buffer[pos:pos + len(chunk)] = chunk
+            pos += len(chunk)
+
+        _CRC.pack_into(buffer, pos, crc_stm32(memoryview(buffer)[start:pos]))
+
+        self.length = end
+
+    def view(self) -> memoryview:
+        return memoryview(self.buffer)[:self.length]
+
+    def _grow(self, size: int):
+        # A new object, so views of the old buffer held by a caller stay valid
+        buffer = bytearray(max(size, len(self.buffer) * 2))
+        buffer[:self.length] = self.buffer[:self.length]
+        self.buffer = buffer
+
+
+class FrameDecoder:
+    STATE_SIZE = 0
+    STATE_BODY = 1
+
+    def __init__(self, max_package_size=MAX_PACKAGE_SIZE):
+        self.max_package_size = max_package_size
+        self._buffer = bytearray()
+        self._state = self.STATE_SIZE
+        self._frame_size = 0
+
+        self.crc_errors = 0
+        self.dropped_bytes = 0
+
+    def reset(self):
+        self._buffer.clear()
+        self._state = self.STATE_SIZE
+        self._frame_size = 0
+
+    def pending(self) -> int:
+        return len(self._buffer)
+
+    def feed(self, data: bytes):
+        self._buffer += data
+
+    def resync(self):
+        # Called when the stream stalls inside a frame: the size field we are
+        # waiting on is probably garbage, so skip to the next valid frame.
+        if not self._buffer:
+            return
+
+        pos = self._find_frame(1, len(self._buffer))
+        self._drop(pos if pos is not None else len(self._buffer))
+
+    def frames(self):
+        while True:
+            frame = self.next_frame()
+            if frame is None:
+                return
+            yield frame
+
+    def next_frame(self) -> Union[tuple, None]:
+        buffer = self._buffer
+
+        while True:
+            if self._state == self.STATE_SIZE:
+                if len(buffer) < SIZE_SIZE:
+                    return None
+
+                package_size = buffer[0] | (buffer[1] << 8)
+                if package_size < MIN_PACKAGE_SIZE or package_size > self.max_package_size:
+                    self._drop(1)
+                    continue
+
+                self._frame_size = SIZE_SIZE + package_size
+                self._state = self.STATE_BODY
+
+            if len(buffer) < self._frame_size:
+                return None
+
+            frame_size = self._frame_size
+            crc_pos = frame_size - CRC_SIZE
+            command = buffer[2] | (buffer[3] << 8)
+            package_crc = int.from_bytes(buffer[crc_pos:frame_size], byteorder='little')
+
+            if crc_stm32(buffer[:crc_pos]) != package_crc:
+                # Either the payload or the size field is corrupted: resume at a
+                # valid frame inside the claimed span, or skip the span entirely.
+                self.crc_errors += 1
+                pos = self._find_frame(1, frame_size)
+                self._drop(pos if pos is not None else frame_size)
+                raise FrameCrcError(command)
+
+            data = bytes(buffer[SIZE_SIZE + COMMAND_SIZE:crc_pos])
+            del buffer[:frame_size]
+            self._state = self.STATE_SIZE
+            return command, data
+
+    def _find_frame(self, start: int, end: int) -> Union[int, None]:
+        buffer = self._buffer
+        for pos in range(start, min(end, len(buffer) - SIZE_SIZE)):
+            package_size = buffer[pos] | (buffer[pos + 1] << 8)
+            if package_size < MIN_PACKAGE_SIZE or package_size > self.max_package_size:
+                continue
+
+            frame_end = pos + SIZE_SIZE + package_size
+            if frame_end > len(buffer):
+                continue
+
+            crc_pos = frame_end - CRC_SIZE
+            if crc_stm32(buffer[pos:crc_pos]) == int.from_bytes(buffer[crc_pos:frame_end], byteorder='little'):
+                return pos
+
+        return None
+
+    def _drop(self, size: int):
+        del self._buffer[:size]
+        self.dropped_bytes += size
+        self._state = self.STATE_SIZE
@@ -0,0 +1,309 @@
+import logging
+import struct
+import threading
+import time
+
+from ..connect import DKConnect
+from .common import PortInfo, ScheduledSerial
+
+
+# Capture file: header, then records until the end of the file.
+# Header: magic, version, start time (unix seconds).
+# Record: time from the start (seconds), direction, data size, data.
+CAPTURE_MAGIC = b'DKCP'
+CAPTURE_VERSION = 1
+
+DIRECTION_TX = 0
+DIRECTION_RX = 1
+# Transport events, CONNECT data is vid, pid and the port name
+DIRECTION_CONNECT = 2
+DIRECTION_CLEAR = 3
+DIRECTION_CLOSE = 4
+
+DIRECTION_NAMES = {
+    DIRECTION_TX: 'tx',
+    DIRECTION_RX: 'rx',
+    DIRECTION_CONNECT: 'connect',
+    DIRECTION_CLEAR: 'clear',
+    DIRECTION_CLOSE: 'close',
+}
+
+_HEADER = struct.Struct('<4sHd')
+_RECORD = struct.Struct('<dBI')
+_PORT = struct.Struct('<HH')
+
+
+class CaptureRecord:
+    def __init__(self, timestamp: float, direction: int, data: bytes):
+        self.time = timestamp
+        self.direction = direction
+        self.data = data
+
+    def port_info(self) -> (int, int, str):
+        vid, pid = _PORT.unpack_from(self.data)
+        return vid, pid, self.data[_PORT.size:].decode('utf-8')
+
+
+class CaptureWriter:
+    def __init__(self, file_name: str):
+        self.file_name = file_name
+        self.start_time = time.time()
+        self.records = 0
+
+        self._start = time.monotonic()
+        self._lock = threading.Lock()
+        self._file = open(file_name, 'wb')
+        self._file.write(_HEADER.pack(CAPTURE_MAGIC, CAPTURE_VERSION, self.start_time))
+
+        logging.info('Capture started: {}'.format(file_name))
+
+    def write(self, direction: int, data: bytes = b''):
+        with self._lock:
+            if self._file is None:
+                return
+
+            self._file.write(_RECORD.pack(time.monotonic() - self._start, direction, len(data)))
+            self._file.write(data)
+            self.records += 1
+
+    def flush(self):
+        with self._lock:
+            if self._file:
+                self._file.flush()
+
+    def close(self):
+        with self._lock:
+            if self._file:
+                self._file.close()
+                self._file = None
+
+        logging.info('Capture saved: {}, records: {}'.format(self.file_name, self.records))
+
+
+def read_capture(file_name: str) -> (float, list):
+    # Returns the capture start time and its records
+    with open(file_name, 'rb') as file:
+        header = file.read(_HEADER.size)
+        if len(header) < _HEADER.size:
+            raise ValueError('Not a capture file')
+
+        magic, version, start_time = _HEADER.unpack(header)
+        if magic != CAPTURE_MAGIC:
+            raise ValueError('Not a capture file')
+        if version != CAPTURE_VERSION:
+            raise ValueError('Unsupported capture version: {}'.format(version))
+
+        records = []
+        while True:
+            head = file.read(_RECORD.size)
+            if len(head) < _RECORD.size:
+                # A capture of a crashed app may end with a partial record
+                break
+
+            timestamp, direction, size = _RECORD.unpack(head)
+            data = file.read(size)
+            if len(data) < size:
+                break
+
+            records.append(CaptureRecord(timestamp, direction, data))
+
+    return start_time, records
+
+
+class RecordingSerial:
+    # Wraps any transport and records the byte stream in both directions.
+    # The capture stays open across reconnects, stop() closes it.
+
+    def __init__(self, serial, file_name: str):
+        self.serial = serial
+        self.capture = CaptureWriter(file_name)
+        self._ports = []
+
+    def __getattr__(self, name):
+        # fileno, port_info, etc. of the wrapped transport
+        return getattr(self.serial, name)
+
+    def get_devices(self):
+        self._ports = self.serial.get_devices()
+        return self._ports
+
+    def set_timeout(self, timeout: float):
+        self.serial.set_timeout(timeout)
+
+    def connect(self, port_obj, timeout):
+        is_connect = self.serial.connect(port_obj, timeout)
+        if is_connect:
+            # The ports may have been listed by another interface object, e.g. port discovery
+            name = self.serial.port_name(port_obj) or ''
+            port = _find_port(self._ports, name)
+            vid = (port.vid or 0) if port else 0
+            pid = (port.pid or 0) if port else 0
+            self.capture.write(DIRECTION_CONNECT, _PORT.pack(vid, pid) + name.encode('utf-8'))
+
+        return is_connect
+
+    def close(self):
+        self.serial.close()
+        self.capture.write(DIRECTION_CLOSE)
+        self.capture.flush()
+
+    def stop(self):
+        self.capture.close()
+
+    def clear(self):
+        self.serial.clear()
+        self.capture.write(DIRECTION_CLEAR)
+
+    def read(self, size: int) -> bytes:
+        return self._received(self.serial.read(size))
+
+    def read_available(self) -> bytes:
+        return self._received(self.serial.read_available())
+
+    def read_nowait(self) -> bytes:
+        return self._received(self.serial.read_nowait())
+
+    def readline(self) -> bytes:
+        return self._received(self.serial.readline())
+
+    def write(self, data: bytes):
+        self.capture.write(DIRECTION_TX, bytes(data))
+        self.serial.write(data)
+
+    def _received(self, data: bytes) -> bytes:
+        if data:
+            self.capture.write(DIRECTION_RX, data)
+        return data
+
+
+class ReplaySerial(ScheduledSerial):
+    # Plays a capture back as a device. Every write is matched with the next TX
+    # records, the RX records that followed them are delivered with their original
+    # delays divided by `speed`; speed 0 delivers them at once.
+    # Writes that differ from the capture are counted in `mismatches`.
+
+    def __init__(self, file_name: str, speed: float = 1.0):
+        super().__init__()
+        self.file_name = file_name
+        self.speed = speed
+        self.start_time, self.records = read_capture(file_name)
+        self.mismatches = 0
+
+        self._pos = 0
+        self._tx = bytearray()
+        self._is_connect = False
+
+    def get_devices(self):
+        ports = []
+        for record in self.records:
+            if record.direction == DIRECTION_CONNECT:
+                vid, pid, name = record.port_info()
+                if not any(port.name == name for port in ports):
+                    ports.append(PortInfo(name, vid or DKConnect.DK_VID, pid or DKConnect.DK_PID, name))
+
+        return ports
+
+    @staticmethod
+    def port_name(port_obj) -> str:
+        return port_obj
+
+    def is_finished(self) -> bool:
+        return self._pos >= len(self.records) and not self._responses and not self._rx
+
+    def set_timeout(self, timeout: float):
+        self.timeout = timeout
+
+    def connect(self, port_obj, timeout):
+        logging.info('Replaying capture: {}, port: {}'.format(self.file_name, port_obj))
+        # Continue from the next connect to this port
+        for pos in range(self._pos, len(self.records)):
+            record = self.records[pos]
+            if record.direction == DIRECTION_CONNECT and record.port_info()[2] == port_obj:
+                self._pos = pos + 1
+                break
+        else:
+            logging.debug('Port is not in the capture: {}'.format(port_obj))
+            return False
+
+        self.timeout = timeout
+        self._is_connect = True
+        self._tx.clear()
+        self._responses.clear()
+        self._rx.clear()
+        self._schedule(time.monotonic(), record.time)
+        return True
+
+    def close(self):
+        self._is_connect = False
+
+    def clear(self):
+        # Drops what has arrived, answers still on the way are delivered later
+        self._collect()
+        self._rx.clear()
+
+    def write(self, data: bytes):
+        if not self._is_connect:
+            raise OSError('Replay is not connected')
+
+        now = time.monotonic()
+        self._tx += data
+        # Recorded writes may be split or joined differently, compare the streams
+        while self._tx:
+            record = self._next_record(DIRECTION_TX)
+            if record is None:
+                logging.warning('Replay: write past the end of the capture')
+                self.mismatches += 1
+                self._tx.clear()
+                return
+
+            if len(record.data) > len(self._tx):
+                if not record.data.startswith(self._tx):
+                    self._mismatch(record)
+                return
+
+            if not self._tx.startswith(record.data):
+                self._mismatch(record)
+
+            del self._tx[:len(record.data)]
+            self._pos += 1
+            self._schedule(now, record.time)
+
+    def _next_record(self, direction: int):
+        # Skips transport events, stops at the next connect
+        while self._pos < len(self.records):
+            record = self.records[self._pos]
+            if record.direction == direction:
+                return record
+            if record.direction == DIRECTION_CONNECT:
+                return None
+            self._pos += 1
+
+        return None
+
+    def _schedule(self, now: float, anchor_time: float):
+        # RX records up to the next write are answers to the one just matched.
+        # They were recorded when the host read them, so delays include its reading latency.
+        while self._pos < len(self.records):
+            record = self.records[self._pos]
+            if record.direction in (DIRECTION_TX, DIRECTION_CONNECT):
+                break
+            if record.direction != DIRECTION_RX:
+                self._pos += 1
+                continue
+
+            delay = (record.time - anchor_time) / self.speed if self.speed else 0.0
+            ready_time = max(now + delay, self._responses[-1][0] if self._responses else 0.0)
+            self._responses.append((ready_time, record.data))
+            self._pos += 1
+
+    def _mismatch(self, record: CaptureRecord):
+        self.mismatches += 1
+        logging.warning('Replay: write differs from the capture at {:.6f}s'.format(record.time))
+
+
+def _find_port(ports: list, name: str):
+    for port in ports:
+        if port.name == name:
+            return port
+
+    return None
@@ -1,7 +1,94 @@
+import time
+from collections import deque
 
 
 class PortInfo:
-    def __init__(self, port_obj, vid, pid):
+    def __init__(self, port_obj, vid, pid, name=None):
         self.port_obj = port_obj
         self.vid = vid
         self.pid = pid
+        self.name = name
+
+
+class BufferedSerial:
+    # Reads of the transports that keep received data in a buffer.
+    # _collect() moves the data that has arrived into the buffer without blocking,
+    # _wait(deadline) waits until more arrives, False on timeout. No deadline waits forever.
+
+    def __init__(self):
+        self.timeout = None
+
+        self._rx = bytearray()
+
+    def read(self, size: int) -> bytes:
+        deadline = self._deadline()
+        while len(self._rx) < size:
+            if not self._wait(deadline):
+                break
+
+        return self._take(size)
+
+    def read_available(self) -> bytes:
+        # Blocks until at least one byte arrives, then takes everything buffered
+        self._collect()
+        if not self._rx:
+            self._wait(self._deadline())
+
+        return self._take(len(self._rx))
+
+    def read_nowait(self) -> bytes:
+        self._collect()
+        return self._take(len(self._rx))
+
+    def readline(self) -> bytes:
+        deadline = self._deadline()
+        while b'\n' not in self._rx:
+            if not self._wait(deadline):
+                return self._take(len(self._rx))
+
+        return self._take(self._rx.index(b'\n') + 1)
+
+    def _take(self, size: int) -> bytes:
+        data = bytes(self._rx[:size])
+        del self._rx[:size]
+        return data
+
+    def _deadline(self):
+        return time.monotonic() + self.timeout if self.timeout is not None else None
+
+    def _collect(self):
+        raise NotImplementedError
+
+    def _wait(self, deadline) -> bool:
+        raise NotImplementedError
+
+
+class ScheduledSerial(BufferedSerial):
+    # Buffered reads of data that is delivered at a known time, e.g. simulated answers.
+    # _responses holds (ready time, data) in the order of the ready times.
+
+    def __init__(self):
+        super().__init__()
+
+        self._responses = deque()
+
+    def _collect(self):
+        now = time.monotonic()
+        while self._responses and self._responses[0][0] <= now:
+            self._rx += self._responses.popleft()[1]
+
+    def _wait(self, deadline) -> bool:
+        # Sleeps until the next response is delivered, False on timeout
+        now = time.monotonic()
+        ready_time = self._responses[0][0] if self._responses else None
+
+        if ready_time is None or (deadline is not None and ready_time > deadline):
+            if deadline is not None and deadline > now:
+                time.sleep(deadline - now)
+            return False
+
+        if ready_time > now:
+            time.sleep(ready_time - now)
+
+        self._collect()
+        return True
@@ -16,13 +16,18 @@ class PySerial:
     def get_devices():
         ports_info = []
         for port in list_ports.comports():
-            port_info = PortInfo(port, port.vid, port.pid)
+            port_info = PortInfo(port, port.vid, port.pid, PySerial.port_name(port))
             ports_info.append(port_info)
 
         return ports_info
 
+    @staticmethod
+    def port_name(port_obj) -> str:
+        return port_obj.device
+
     def set_timeout(self, timeout: float):
-        self.serial.timeout = timeout
+        if self.pyserial:
+            self.pyserial.timeout = timeout
 
     def connect(self, port_obj, timeout):
         logging.info('Connecting to port: {}'.format(port_obj.usb_info()))
@@ -48,6 +53,17 @@ class PySerial:
     def read(self, size: int) -> bytes:
         return self.pyserial.read(size)
 
+    def read_available(self) -> bytes:
+        # Blocks until at least one byte arrives, then takes everything buffered
+        return self.pyserial.read(self.pyserial.in_waiting or 1)
+
+    def read_nowait(self) -> bytes:
+        return self.pyserial.read(self.pyserial.in_waiting)
+
+    def fileno(self) -> int:
+        # POSIX only, lets asyncio wait for data without a thread per port
+        return self.pyserial.fileno()
+
     def readline(self) -> bytes:
         return self.pyserial.readline()
 
@@ -1,15 +1,22 @@
 import logging
-import serial
+import time
+
 from PySide2.QtCore import QIODevice
 from PySide2.QtSerialPort import QSerialPort, QSerialPortInfo
 
-from .common import PortInfo
+from .common import BufferedSerial, PortInfo
+
+
+class QtSerial(BufferedSerial):
+    # QSerialPort transport. Incoming data is collected by the readyRead handler,
+    # blocking reads sleep in waitForReadyRead, so no event loop is needed in the
+    # calling thread. The port must be used from the thread that connected it.
 
+    WRITE_TIMEOUT = 1.0
 
-class QtSerial:
     def __init__(self):
+        super().__init__()
         self.serial = None
-        self.pyserial = None
         self.port_info = None
 
     @staticmethod
@@ -18,48 +25,71 @@ class QtSerial:
         ports = info_list.availablePorts()
         ports_info = []
         for port in ports:
-            port_info = PortInfo(port, port.vendorIdentifier(), port.productIdentifier())
+            port_info = PortInfo(port, port.vendorIdentifier(), port.productIdentifier(), QtSerial.port_name(port))
             ports_info.append(port_info)
 
         return ports_info
 
+    @staticmethod
+    def port_name(port_obj) -> str:
+        return port_obj.systemLocation()
+
+    def set_timeout(self, timeout: float):
+        self.timeout = timeout
+
     def connect(self, port_obj, timeout):
-        # didn't work
-        # self.serial = QSerialPort(port_obj)
-        # self.serial.setBaudRate(QSerialPort.Baud115200)
-        # return self.serial.open(QIODevice.ReadWrite):
-
-        logging.info('Connecting to port:', port_obj.systemLocation())
-        try:
-            self.pyserial = serial.Serial(port_obj.systemLocation(), baudrate=115200, timeout=timeout)
-        except (FileNotFoundError, OSError) as exc:
-            logging.debug('Connecting error', exc_info=True)
+        logging.info('Connecting to port: {}'.format(port_obj.systemLocation()))
+        self.close()
+
+        self.serial = QSerialPort(port_obj)
+        self.serial.setBaudRate(QSerialPort.Baud115200)
+        self.serial.readyRead.connect(self._collect)
+        self.timeout = timeout
+        self._rx.clear()
+
+        if not self.serial.open(QIODevice.ReadWrite):
+            logging.debug('Connecting error: {}'.format(self.serial.errorString()))
+            self.serial = None
             return False
 
-        return bool(self.pyserial)
+        return True
 
     def close(self):
-        if self.pyserial:
-            self.pyserial.close()
+        if self.serial:
+            self.serial.readyRead.disconnect(self._collect)
+            self.serial.close()
+            self.serial = None
 
     def clear(self):
-        if not self.pyserial:
+        if not self.serial:
             return
 
-        self.pyserial.reset_input_buffer()
-        self.pyserial.reset_output_buffer()
+        self.serial.clear(QSerialPort.AllDirections)
+        self._rx.clear()
 
-    def read(self, size: int) -> bytes:
-        # didn't work
-        # data = bytes()
-        # data = self.serial.readData(size)
-        # return data
+    def write(self, data: bytes):
+        if not self.serial:
+            raise OSError('Port is not open')
 
-        return self.pyserial.read(size)
+        self.serial.write(bytes(data))
+        while self.serial.bytesToWrite():
+            if not self.serial.waitForBytesWritten(int(self.WRITE_TIMEOUT * 1000)):
+                raise OSError('Write error: {}'.format(self.serial.errorString()))
 
-    def write(self, data: bytes):
-        # didn't work
-        # self.serial.writeData(data, len(data))
+    def _collect(self):
+        if self.serial:
+            self._rx += self.serial.readAll().data()
+
+    def _wait(self, deadline) -> bool:
+        # readyRead is emitted from inside waitForReadyRead, False on timeout
+        if not self.serial:
+            return False
+
+        if deadline is None:
+            return self.serial.waitForReadyRead(-1)
 
-        self.pyserial.write(data)
+        msecs = int((deadline - time.monotonic()) * 1000)
+        if msecs <= 0:
+            return False
 
+        return self.serial.waitForReadyRead(msecs)
@@ -0,0 +1,92 @@
+import logging
+import random
+import time
+
+from ..connect import DKConnect
+from ..frame import FrameCrcError, FrameDecoder, encode_frame
+from ..simulator import DeviceSimulator
+from .common import PortInfo, ScheduledSerial
+
+
+class SimulatorSerial(ScheduledSerial):
+    # In-process transport talking to DeviceSimulator objects instead of a port.
+    # latency: seconds from the end of a request to the start of its response
+    # bandwidth: bytes per second in each direction, None for unlimited
+    # drop_rate: probability that a request is lost and never answered
+    # corrupt_rate: probability that a response has a damaged byte
+
+    def __init__(self, devices=None, latency=0.0, bandwidth=None, drop_rate=0.0, corrupt_rate=0.0, seed=None):
+        super().__init__()
+        self.devices = devices if devices is not None else [DeviceSimulator()]
+        self.device = None
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.drop_rate = drop_rate
+        self.corrupt_rate = corrupt_rate
+        self.random = random.Random(seed)
+
+        self._decoder = FrameDecoder()
+        self._tx_time = 0.0
+        self._rx_time = 0.0
+
+    def get_devices(self):
+        return [PortInfo(device, DKConnect.DK_VID, DKConnect.DK_PID, self.port_name(device)) for device in self.devices]
+
+    @staticmethod
+    def port_name(port_obj) -> str:
+        return port_obj.port_name
+
+    def set_timeout(self, timeout: float):
+        self.timeout = timeout
+
+    def connect(self, port_obj, timeout):
+        logging.info('Connecting to simulator: {}'.format(port_obj.device_name))
+        self.device = port_obj
+        self.device.power_on()
+        self.timeout = timeout
+        self.clear()
+        return True
+
+    def close(self):
+        self.device = None
+
+    def clear(self):
+        self._decoder.reset()
+        self._responses.clear()
+        self._rx.clear()
+
+    def write(self, data: bytes):
+        if not self.device:
+            raise OSError('Simulator is not connected')
+
+        now = time.monotonic()
+        self._tx_time = max(now, self._tx_time) + self._transfer_time(len(data))
+        self._decoder.feed(data)
+
+        while True:
+            try:
+                frame = self._decoder.next_frame()
+            except FrameCrcError:
+                continue
+
+            if frame is None:
+                break
+
+            if self.random.random() < self.drop_rate:
+                continue
+
+            response = self.device.handle(*frame)
+            if response is None:
+                continue
+
+            package = encode_frame(*response)
+            if self.random.random() < self.corrupt_rate:
+                package = bytearray(package)
+                package[self.random.randrange(len(package))] ^= 1 << self.random.randrange(8)
+                package = bytes(package)
+
+            self._rx_time = max(self._tx_time + self.latency, self._rx_time) + self._transfer_time(len(package))
+            self._responses.append((self._rx_time, package))
+
+    def _transfer_time(self, size: int) -> float:
+        return size / self.bandwidth if self.bandwidth else 0.0
@@ -0,0 +1,209 @@
+import threading
+import time
+
+
+ERROR_TIMEOUT = 'timeout'
+ERROR_CRC = 'crc'
+ERROR_MISMATCH = 'mismatch'
+ERROR_CODE = 'error_code'
+ERROR_DISCONNECT = 'disconnect'
+
+# Upper bounds in seconds, the last bucket is +Inf
+LATENCY_BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0, 30.0)
+
+
+class ConnectHook:
+    # Base of DKConnect instrumentation hooks, override the events you need.
+    # command is None when the frame is not known, e.g. a write error.
+
+    def on_send(self, command: int, size: int):
+        pass
+
+    def on_receive(self, command: int, size: int):
+        pass
+
+    def on_exchange(self, command: int, seconds: float, attempts: int):
+        pass
+
+    def on_retry(self, command: int, attempt: int):
+        pass
+
+    def on_error(self, command: int, kind: str, error_code: int = None):
+        pass
+
+
+class CommandStats:
+    def __init__(self):
+        self.count = 0
+        self.attempts = 0
+        self.retries = 0
+        self.frames_sent = 0
+        self.frames_received = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.latency_sum = 0.0
+        self.latency_max = 0.0
+        self.latency_buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.errors = {}
+        self.error_codes = {}
+
+    def observe_latency(self, seconds: float):
+        self.latency_sum += seconds
+        self.latency_max = max(self.latency_max, seconds)
+        for index, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                self.latency_buckets[index] += 1
+                return
+
+        self.latency_buckets[-1] += 1
+
+    def latency_percentile(self, percent: float) -> float:
+        # Upper bound of the bucket holding the percentile
+        rank = self.count * percent / 100
+        total = 0
+        for index, count in enumerate(self.latency_buckets):
+            total += count
+            if count and total >= rank:
+                return LATENCY_BUCKETS[index] if index < len(LATENCY_BUCKETS) else self.latency_max
+
+        return 0.0
+
+    def to_dict(self) -> dict:
+        return {
+            'count': self.count,
+            'retries': self.retries,
+            'frames_sent': self.frames_sent,
+            'frames_received': self.frames_received,
+            'bytes_sent': self.bytes_sent,
+            'bytes_received': self.bytes_received,
+            'latency_avg_ms': self.latency_sum / self.count * 1000 if self.count else 0.0,
+            'latency_p50_ms': self.latency_percentile(50) * 1000,
+            'latency_p99_ms': self.latency_percentile(99) * 1000,
+            'latency_max_ms': self.latency_max * 1000,
+            'latency_buckets': dict(zip([str(bound) for bound in LATENCY_BUCKETS] + ['+Inf'], self.latency_buckets)),
+            'errors': dict(self.errors),
+            'error_codes': {str(code): count for code, count in self.error_codes.items()},
+        }
+
+
+class MetricsCollector(ConnectHook):
+    # Built-in hook: per command counters and latency histograms.
+    # One collector may be shared by several connections, e.g. all ports of a station.
+    # names maps command ids to names for the export, see command_names().
+
+    def __init__(self, names: dict = None, labels: dict = None):
+        self.names = names or {}
+        self.labels = labels or {}
+        self.commands = {}
+        self.start_time = time.time()
+        self._lock = threading.Lock()
+
+    def reset(self):
+        with self._lock:
+            self.commands = {}
+            self.start_time = time.time()
+
+    def on_send(self, command: int, size: int):
+        with self._lock:
+            stats = self._stats(command)
+            stats.frames_sent += 1
+            stats.bytes_sent += size
+
+    def on_receive(self, command: int, size: int):
+        with self._lock:
+            stats = self._stats(command)
+            stats.frames_received += 1
+            stats.bytes_received += size
+
+    def on_exchange(self, command: int, seconds: float, attempts: int):
+        with self._lock:
+            stats = self._stats(command)
+            stats.count += 1
+            stats.attempts += attempts
+            stats.observe_latency(seconds)
+
+    def on_retry(self, command: int, attempt: int):
+        with self._lock:
+            self._stats(command).retries += 1
+
+    def on_error(self, command: int, kind: str, error_code: int = None):
+        with self._lock:
+            stats = self._stats(command)
+            stats.errors[kind] = stats.errors.get(kind, 0) + 1
+            if error_code is not None:
+                stats.error_codes[error_code] = stats.error_codes.get(error_code, 0) + 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                'uptime_s': time.time() - self.start_time,
+                'labels': dict(self.labels),
+                'commands': {self._name(command): stats.to_dict() for command, stats in self.commands.items()},
+            }
+
+    def prometheus_text(self, prefix: str = 'dk') -> str:
+        # Prometheus text exposition format, version 0.0.4
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append('# HELP {}_{} {}'.format(prefix, name, help_text))
+            lines.append('# TYPE {}_{} {}'.format(prefix, name, kind))
+            for suffix, labels, value in samples:
+                lines.append('{}_{}{}{{{}}} {}'.format(prefix, name, suffix, self._labels(labels), value))
+
+        with self._lock:
+            commands = sorted(self.commands.items(), key=lambda item: -1 if item[0] is None else item[0])
+
+            metric('command_exchanges_total', 'counter', 'Completed exchanges',
+                   [('', {'command': self._name(c)}, s.count) for c, s in commands])
+            metric('command_retries_total', 'counter', 'Repeated requests',
+                   [('', {'command': self._name(c)}, s.retries) for c, s in commands])
+            metric('command_sent_bytes_total', 'counter', 'Bytes of sent frames',
+                   [('', {'command': self._name(c)}, s.bytes_sent) for c, s in commands])
+            metric('command_received_bytes_total', 'counter', 'Bytes of received frames',
+                   [('', {'command': self._name(c)}, s.bytes_received) for c, s in commands])
+            metric('command_errors_total', 'counter', 'Transport and protocol errors',
+                   [('', {'command': self._name(c), 'kind': kind}, count)
+                    for c, s in commands for kind, count in sorted(s.errors.items())])
+            metric('command_error_codes_total', 'counter', 'Error codes returned by the device',
+                   [('', {'command': self._name(c), 'code': code}, count)
+                    for c, s in commands for code, count in sorted(s.error_codes.items())])
+
+            samples = []
+            for c, s in commands:
+                total = 0
+                for bound, count in zip(list(LATENCY_BUCKETS) + ['+Inf'], s.latency_buckets):
+                    total += count
+                    samples.append(('_bucket', {'command': self._name(c), 'le': bound}, total))
+                samples.append(('_sum', {'command': self._name(c)}, s.latency_sum))
+                samples.append(('_count', {'command': self._name(c)}, s.count))
+            metric('command_latency_seconds', 'histogram', 'Exchange latency', samples)
+
+        return '\n'.join(lines) + '\n'
+
+    def _stats(self, command: int) -> CommandStats:
+        stats = self.commands.get(command)
+        if stats is None:
+            stats = self.commands[command] = CommandStats()
+        return stats
+
+    def _name(self, command: int) -> str:
+        if command is None:
+            return 'unknown'
+        return self.names.get(command, str(command))
+
+    def _labels(self, labels: dict) -> str:
+        labels = dict(self.labels, **labels)
+        return ','.join('{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                        for key, value in labels.items())
+
+
+def command_names(*command_classes) -> dict:
+    # {command id: name} from the COMMAND_* attributes, e.g. command_names(DKTankCommands)
+    names = {}
+    for command_class in command_classes:
+        for attr in dir(command_class):
+            value = getattr(command_class, attr)
+            if attr.startswith('COMMAND_') and isinstance(value, int):
+                names.setdefault(value, attr[len('COMMAND_'):].lower())
+    return names
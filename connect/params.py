@@ -0,0 +1,129 @@
+import logging
+from typing import Union
+
+from .common import DKCommonCommands
+
+
+SWEEP_CHUNK = 16
+MAX_PARAMS = 1024
+WRITE_ATTEMPTS = 2
+
+
+class Param:
+    TYPE_FLOAT = 'float'
+    TYPE_INT = 'int'
+    TYPE_BOOL = 'bool'
+
+    SIZE_TYPES = {
+        4: TYPE_FLOAT,
+        2: TYPE_INT,
+        1: TYPE_BOOL,
+    }
+
+    def __init__(self, number: int, value: Union[int, float], size: int):
+        self.number = number
+        self.value = value
+        self.size = size
+        self.is_dirty = False
+
+    def type(self) -> str:
+        return self.SIZE_TYPES.get(self.size, self.TYPE_INT)
+
+    def coerce(self, value: Union[int, float, bool]) -> Union[int, float]:
+        if self.type() == self.TYPE_FLOAT:
+            return float(value)
+        elif self.type() == self.TYPE_BOOL:
+            return int(bool(value))
+        return int(value)
+
+
+class ParamTable:
+    # Local copy of all device params. Reads are done in one sweep of pipelined
+    # requests, changed values are tracked and written back together.
+
+    def __init__(self, cmd: DKCommonCommands):
+        self.cmd = cmd
+        self.params = {}
+
+    def __len__(self):
+        return len(self.params)
+
+    def __contains__(self, number: int):
+        return number in self.params
+
+    def __iter__(self):
+        return iter(sorted(self.params))
+
+    def __getitem__(self, number: int) -> Union[int, float]:
+        return self.params[number].value
+
+    def __setitem__(self, number: int, value: Union[int, float, bool]):
+        param = self.params[number]
+        value = param.coerce(value)
+        if value != param.value:
+            param.value = value
+            param.is_dirty = True
+
+    def items(self):
+        return [(number, self.params[number].value) for number in self]
+
+    def param(self, number: int) -> Param:
+        return self.params[number]
+
+    def load(self, count: int = None) -> 'ParamTable':
+        # Without count, params are read until the device rejects a number
+        self.params = {}
+        last = count if count is not None else MAX_PARAMS
+        number = 0
+        while number < last:
+            numbers = list(range(number, min(number + SWEEP_CHUNK, last)))
+            spec = self.cmd.SCHEMA[self.cmd.COMMAND_GET_PARAM]
+            packages = [(self.cmd.COMMAND_GET_PARAM, spec.encode(n)) for n in numbers]
+            responses = self.cmd.connect.exchange_many(packages, is_silent=count is None)
+
+            for n, data in zip(numbers, responses):
+                if data is None:
+                    logging.info('Params loaded: {}'.format(len(self.params)))
+                    return self
+
+                self.params[n] = Param(n, self.cmd.decode_param(data), len(data))
+
+            number += SWEEP_CHUNK
+
+        logging.info('Params loaded: {}'.format(len(self.params)))
+        return self
+
+    def dirty(self) -> list:
+        return [number for number in self if self.params[number].is_dirty]
+
+    def write(self) -> int:
+        numbers = self.dirty()
+        for pos in range(0, len(numbers), SWEEP_CHUNK):
+            chunk = numbers[pos:pos + SWEEP_CHUNK]
+            packages = [(self.cmd.COMMAND_SET_PARAM, self.cmd.encode_param(n, self.params[n].value, self.params[n].size))
+                        for n in chunk]
+            self.cmd.connect.exchange_many(packages, retry=WRITE_ATTEMPTS)
+
+            for number in chunk:
+                self.params[number].is_dirty = False
+
+        logging.info('Params written: {}'.format(len(numbers)))
+        return len(numbers)
+
+    def save(self) -> int:
+        written = self.write()
+        if written:
+            self.cmd.save_params()
+        return written
+
+    def to_dict(self) -> dict:
+        return {str(number): self.params[number].value for number in self}
+
+    def update(self, values: dict):
+        for number, value in values.items():
+            number = int(number)
+            if number not in self.params:
+                logging.warning('Unknown param: {}'.format(number))
+                continue
+
+            self[number] = value
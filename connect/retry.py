@@ -0,0 +1,95 @@
+import math
+import threading
+
+
+MIN_TIMEOUT = 0.3
+INITIAL_TIMEOUT = 1.0
+MAX_TIMEOUT = 2.0
+BACKOFF = 2.0
+
+
+class RttEstimator:
+    # Smoothed round trip time and its variance, as in TCP (RFC 6298).
+    # The variance term is at least half of the RTT: very regular samples
+    # (e.g. a bandwidth-bound upload window) would give a deadline right at the RTT.
+    ALPHA = 1 / 8
+    BETA = 1 / 4
+    K = 4
+    MIN_VARIANCE_RATIO = 0.5
+
+    def __init__(self):
+        self.srtt = None
+        self.rttvar = None
+        self.samples = 0
+
+    def observe(self, rtt: float):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = (1 - self.BETA) * self.rttvar + self.BETA * abs(self.srtt - rtt)
+            self.srtt = (1 - self.ALPHA) * self.srtt + self.ALPHA * rtt
+
+        self.samples += 1
+
+    def timeout(self) -> float:
+        return self.srtt + max(self.K * self.rttvar, self.MIN_VARIANCE_RATIO * self.srtt)
+
+
+class RetryPolicy:
+    # Per-command response deadlines. A command gets its override when it has one,
+    # otherwise a timeout from its measured round trips, or initial_timeout before
+    # the first sample. Every retry multiplies the timeout by `backoff`.
+    # Only first attempts are measured, the response to a retry may belong to
+    # the lost request (Karn's algorithm).
+
+    def __init__(self, min_timeout: float = MIN_TIMEOUT, initial_timeout: float = INITIAL_TIMEOUT,
+                 max_timeout: float = MAX_TIMEOUT, backoff: float = BACKOFF, overrides: dict = None):
+        self.min_timeout = min_timeout
+        self.initial_timeout = initial_timeout
+        self.max_timeout = max_timeout
+        self.backoff = backoff
+        self.overrides = dict(overrides or {})
+        self.estimators = {}
+        self._lock = threading.Lock()
+
+    def set_override(self, command: int, timeout: float):
+        self.overrides[command] = timeout
+
+    def set_overrides(self, overrides: dict):
+        self.overrides.update(overrides)
+
+    def observe(self, command: int, rtt: float):
+        with self._lock:
+            estimator = self.estimators.get(command)
+            if estimator is None:
+                estimator = self.estimators[command] = RttEstimator()
+            estimator.observe(rtt)
+
+    def base_timeout(self, command: int) -> float:
+        if command in self.overrides:
+            return self.overrides[command]
+
+        estimator = self.estimators.get(command)
+        if estimator is None:
+            return self.initial_timeout
+
+        return min(max(estimator.timeout(), self.min_timeout), self.max_timeout)
+
+    def timeout(self, command: int, attempt: int = 1, timeout: float = None) -> float:
+        # timeout, when given, replaces the base timeout of this call
+        base = timeout if timeout is not None else self.base_timeout(command)
+        return min(base * self.backoff ** (attempt - 1), max(base, self.max_timeout))
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {command: {'srtt_ms': estimator.srtt * 1000,
+                              'rttvar_ms': estimator.rttvar * 1000,
+                              'timeout_ms': self.base_timeout(command) * 1000,
+                              'samples': estimator.samples}
+                    for command, estimator in self.estimators.items()}
+
+
+def quantize_timeout(timeout: float, step: float = 0.005) -> float:
+    # Serial timeouts are reconfigured only when the rounded value changes
+    return math.ceil(timeout / step) * step
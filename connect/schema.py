@@ -0,0 +1,68 @@
+import struct
+from functools import lru_cache
+from typing import Union
+
+
+# Response that is an unsigned integer of the whole payload. The firmware does not
+# fix the width of these replies, so they are not given a struct layout.
+UINT = 'uint'
+
+
+@lru_cache(maxsize=None)
+def compile_layout(layout: str) -> struct.Struct:
+    # Layouts are struct formats without the byte order, the protocol is little endian
+    return struct.Struct('<' + layout)
+
+
+class CommandSpec:
+    # Request and response layout of one command.
+    # Without a request layout the data is sent as given (raw bytes or nothing),
+    # without a response layout the response data is returned as is.
+    # A request layout followed by a payload, e.g. a write position and the block,
+    # is encoded as the header only, the payload is sent as the next chunk.
+    # Short layouts are the leading fields older firmware knows: the other request
+    # fields are sent only when set, a short response is padded with zeros.
+
+    __slots__ = ('command', 'request', 'response', 'short_request', 'short_response', 'short_count')
+
+    def __init__(self, command: int, request: str = None, response: str = None,
+                 short_request: str = None, short_response: str = None):
+        self.command = command
+        self.request = compile_layout(request) if request else None
+        self.response = compile_layout(response) if response and response != UINT else response
+        self.short_request = compile_layout(short_request) if short_request else None
+        self.short_response = compile_layout(short_response) if short_response else None
+        # Number of the fields in the short request
+        self.short_count = len(self.short_request.unpack(bytes(self.short_request.size))) if short_request else 0
+
+    def encode(self, *values) -> Union[bytes, None]:
+        if self.request is None:
+            return values[0] if values else None
+
+        if self.short_request is not None:
+            if not any(values[self.short_count:]):
+                return self.short_request.pack(*values[:self.short_count])
+
+        return self.request.pack(*values)
+
+    def decode(self, data: Union[bytes, None]):
+        # A single field is returned as a value, several as a tuple
+        if data is None or self.response is None:
+            return data
+
+        if self.response == UINT:
+            return int.from_bytes(data, byteorder='little', signed=False)
+
+        if self.short_response is not None and len(data) < self.response.size:
+            data = bytes(data).ljust(self.response.size, b'\0')
+
+        values = self.response.unpack_from(data)
+        return values[0] if len(values) == 1 else values
+
+
+def command_schema(base: dict = None, *specs) -> dict:
+    # Command id -> CommandSpec, specs of a subclass extend the base schema
+    schema = dict(base or {})
+    for spec in specs:
+        schema[spec.command] = spec
+    return schema
@@ -0,0 +1,399 @@
+import hashlib
+import logging
+
+from .bootloader import DKBootloaderCommands
+from .common import DKCommonCommands
+from .connect import DKConnect
+from .tank import DKTankCommands
+from .utils import bytes_to_float, bytes_to_uint, float_to_bytes, int16_to_bytes, int32_to_bytes, int8_to_bytes
+
+
+# Error codes are simulator specific, the real firmware may use other values
+ERROR_UNKNOWN_COMMAND = 1
+ERROR_BAD_PARAMS = 2
+ERROR_FLASH = 3
+ERROR_NOT_FOUND = 4
+
+RC_CHANNELS = 8
+
+
+class DKSimulatorError(Exception):
+    def __init__(self, error_code, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.error_code = error_code
+
+
+class FlashSimulator:
+    ERASED = 0xFF
+
+    def __init__(self, size=256 * 1024, page_size=2048):
+        self.size = size
+        self.page_size = page_size
+        self.memory = bytearray([self.ERASED]) * size
+
+        self.erased_bytes = 0
+        self.written_bytes = 0
+
+    def erase(self, addr=0, length=None):
+        if length is None:
+            length = self.size - addr
+
+        start = addr - addr % self.page_size
+        end = min(-(-(addr + length) // self.page_size) * self.page_size, self.size)
+        self.memory[start:end] = bytes([self.ERASED]) * (end - start)
+        self.erased_bytes += end - start
+
+    def write(self, addr: int, data: bytes):
+        end = addr + len(data)
+        if end > self.size:
+            raise DKSimulatorError(ERROR_BAD_PARAMS)
+
+        # Flash can be programmed only after erase
+        if self.memory[addr:end].count(self.ERASED) != len(data):
+            raise DKSimulatorError(ERROR_FLASH)
+
+        self.memory[addr:end] = data
+        self.written_bytes += len(data)
+
+    def read(self, addr: int, length: int) -> bytes:
+        return bytes(self.memory[addr:addr + length])
+
+    def md5(self, addr: int, length: int) -> bytes:
+        return hashlib.md5(self.memory[addr:addr + length]).digest()
+
+
+class SoundSlot:
+    def __init__(self, sound_id, size, pos, model_id=0, version_major=0, version_minor=0):
+        self.sound_id = sound_id
+        self.size = size
+        self.pos = pos
+        self.model_id = model_id
+        self.version_major = version_major
+        self.version_minor = version_minor
+
+    def pack(self) -> bytes:
+        return (int16_to_bytes(self.sound_id) + int32_to_bytes(self.size) + int32_to_bytes(self.pos) +
+                int16_to_bytes(self.model_id) + int8_to_bytes(self.version_major) +
+                int8_to_bytes(self.version_minor))
+
+
+def default_params() -> dict:
+    # Param number -> raw value. The size of the value defines its type
+    # the same way DKCommonCommands.get_param does: 4 float, 2 int, 1 bool.
+    params = {}
+    for number in range(32):
+        if number % 3 == 0:
+            params[number] = float_to_bytes(number / 4)
+        elif number % 3 == 1:
+            params[number] = int16_to_bytes(number * 10)
+        else:
+            params[number] = int8_to_bytes(number % 2)
+    return params
+
+
+class DeviceSimulator:
+    # Command handler of a simulated DK device: takes a request frame content,
+    # returns the response command and data. `device_name` selects the command
+    # set: bootloader or the common commands of the application firmware.
+    # echo_position: flash write acks carry the written position.
+
+    def __init__(self, device_name=DKTankCommands.DEVICE_NAME, uid=bytes(range(12)),
+                 max_block_size=1024, flash=None, external_flash=None, echo_position=False):
+        self.app_name = device_name if device_name != DKBootloaderCommands.DEVICE_NAME else DKTankCommands.DEVICE_NAME
+        self.device_name = device_name
+        self.uid = uid
+        self.port_name = 'SIM-{}'.format(uid.hex())
+        self.max_block_size = max_block_size
+        self.echo_position = echo_position
+        self.flash = flash or FlashSimulator()
+        self.external_flash = external_flash or FlashSimulator(size=1024 * 1024, page_size=4096)
+
+        self.software_version = (1, 0, 0)
+        self.hardware_version = (1, 0, 0, 0)
+        self.license_key = bytes(32)
+        self.rdp_level = 0
+        self.free_mem = 16 * 1024
+        self.voltage_battery = 7.4
+        self.voltage_5v = 5.0
+        self.rc_receiver_values = [1500] * RC_CHANNELS
+        self.player_performance = 0
+
+        self.saved_params = default_params()
+        self.params = dict(self.saved_params)
+        self.sounds = {}
+        self.is_block_mode = False
+        self.is_running = True
+
+        self._general_handlers = {
+            DKCommonCommands.COMMAND_ECHO: self._echo,
+            DKCommonCommands.COMMAND_GET_NAME: self._get_name,
+            DKCommonCommands.COMMAND_GET_UID: self._get_uid,
+            DKCommonCommands.COMMAND_GET_SOFTWARE_VERSION: self._get_software_version,
+            DKCommonCommands.COMMAND_GET_HARDWARE_VERSION: self._get_hardware_version,
+            DKCommonCommands.COMMAND_SYSTEM_RESET: self._system_reset,
+            DKCommonCommands.COMMAND_BLOCK_MODE_BEGIN: self._block_mode_begin,
+            DKCommonCommands.COMMAND_BLOCK_MODE_END: self._block_mode_end,
+        }
+
+        self._bootloader_handlers = {
+            DKBootloaderCommands.COMMAND_CONFIRM_BOOTLOADER: self._ack,
+            DKBootloaderCommands.COMMAND_GO_TO_APP: self._go_to_app,
+            DKBootloaderCommands.COMMAND_ERASE: self._erase,
+            DKBootloaderCommands.COMMAND_WRITE: self._write,
+            DKBootloaderCommands.COMMAND_CALC_MD5: self._calc_md5,
+            DKBootloaderCommands.COMMAND_CALC_MD5_RANGE: self._calc_md5_range,
+            DKBootloaderCommands.COMMAND_ERASE_RANGE: self._erase_range,
+        }
+
+        self._common_handlers = {
+            DKCommonCommands.COMMAND_GET_LICENSE_KEY: self._get_license_key,
+            DKCommonCommands.COMMAND_GET_ACCESS_LEVEL: self._get_access_level,
+            DKCommonCommands.COMMAND_GET_FREE_MEM: self._get_free_mem,
+            DKCommonCommands.COMMAND_GET_VOLTAGE_BATTERY: self._get_voltage_battery,
+            DKCommonCommands.COMMAND_GET_VOLTAGE_5V: self._get_voltage_5v,
+            DKCommonCommands.COMMAND_GET_RC_RECEIVER_VALUE: self._get_rc_receiver_value,
+            DKCommonCommands.COMMAND_GET_PLAYER_PERFORMANCE: self._get_player_performance,
+            DKCommonCommands.COMMAND_WRITE_LICENSE_KEY: self._write_license_key,
+            DKCommonCommands.COMMAND_GET_PARAM: self._get_param,
+            DKCommonCommands.COMMAND_SET_PARAM: self._set_param,
+            DKCommonCommands.COMMAND_SAVE_PARAMS: self._save_params,
+            DKCommonCommands.COMMAND_RESET_PARAMS: self._reset_params,
+            DKCommonCommands.COMMAND_WRITE_SOUND_INFO: self._write_sound_info,
+            DKCommonCommands.COMMAND_WRITE_SOUND_FILE: self._write_sound_file,
+            DKCommonCommands.COMMAND_GET_SOUND_INFO: self._get_sound_info,
+            DKCommonCommands.COMMAND_RESET_SOUNDS: self._reset_sounds,
+            DKCommonCommands.COMMAND_WRITE_HARDWARE_VERSION: self._write_hardware_version,
+            DKCommonCommands.COMMAND_READ_FLASH: self._read_flash,
+            DKCommonCommands.COMMAND_JUMP_TO_STM_BOOTLOADER: self._system_reset,
+            DKCommonCommands.COMMAND_GET_RDP_LEVEL: self._get_rdp_level,
+            DKCommonCommands.COMMAND_SET_RDP_LEVEL: self._set_rdp_level,
+            DKCommonCommands.COMMAND_START_TESTS: self._ack,
+        }
+
+    def is_bootloader(self) -> bool:
+        return self.device_name == DKBootloaderCommands.DEVICE_NAME
+
+    def handle(self, command: int, data: bytes) -> (int, bytes):
+        # Returns None for commands without response (reset, jump to app)
+        if not self.is_running:
+            return None
+
+        handler = self._general_handlers.get(command)
+        if not handler:
+            if self.is_bootloader():
+                handler = self._bootloader_handlers.get(command)
+            else:
+                handler = self._common_handlers.get(command)
+
+        if not handler:
+            logging.debug('Simulator: unknown command {}'.format(command))
+            return DKConnect.COMMAND_ERROR, int16_to_bytes(ERROR_UNKNOWN_COMMAND)
+
+        try:
+            response = handler(data)
+        except DKSimulatorError as exc:
+            return DKConnect.COMMAND_ERROR, int16_to_bytes(exc.error_code)
+        except (IndexError, ValueError, KeyError):
+            return DKConnect.COMMAND_ERROR, int16_to_bytes(ERROR_BAD_PARAMS)
+
+        if not self.is_running:
+            return None
+
+        return command, response or b''
+
+    def power_on(self):
+        self.is_running = True
+
+    # General
+
+    def _ack(self, data: bytes):
+        return None
+
+    def _echo(self, data: bytes):
+        return data
+
+    def _get_name(self, data: bytes):
+        return self.device_name.encode('latin-1')
+
+    def _get_uid(self, data: bytes):
+        return self.uid
+
+    def _get_software_version(self, data: bytes):
+        major, minor, patch = self.software_version
+        return bytes([major, minor]) + int16_to_bytes(patch)
+
+    def _get_hardware_version(self, data: bytes):
+        return b''.join(int16_to_bytes(x) for x in self.hardware_version)
+
+    def _system_reset(self, data: bytes):
+        # The device restarts into the bootloader and waits for confirm or jump to app
+        self.device_name = DKBootloaderCommands.DEVICE_NAME
+        self.is_running = False
+
+    def _block_mode_begin(self, data: bytes):
+        self.is_block_mode = True
+
+    def _block_mode_end(self, data: bytes):
+        self.is_block_mode = False
+
+    # Bootloader
+
+    def _go_to_app(self, data: bytes):
+        self.device_name = self.app_name
+        self.is_running = False
+
+    def _erase(self, data: bytes):
+        self.flash.erase()
+        return int32_to_bytes(0)
+
+    def _erase_range(self, data: bytes):
+        self.flash.erase(bytes_to_uint(data[0:4]), bytes_to_uint(data[4:8]))
+        return int32_to_bytes(0)
+
+    def _write(self, data: bytes):
+        block = data[4:]
+        if len(block) > self.max_block_size:
+            raise DKSimulatorError(ERROR_BAD_PARAMS)
+
+        self.flash.write(bytes_to_uint(data[0:4]), block)
+        return data[0:4] if self.echo_position else None
+
+    def _calc_md5(self, data: bytes):
+        return self.flash.md5(0, bytes_to_uint(data[0:4]))
+
+    def _calc_md5_range(self, data: bytes):
+        return self.flash.md5(bytes_to_uint(data[0:4]), bytes_to_uint(data[4:8]))
+
+    # Info
+
+    def _get_license_key(self, data: bytes):
+        return self.license_key
+
+    def _get_access_level(self, data: bytes):
+        return int8_to_bytes(0 if not any(self.license_key) else 2)
+
+    def _get_free_mem(self, data: bytes):
+        return int32_to_bytes(self.free_mem)
+
+    def _get_voltage_battery(self, data: bytes):
+        return float_to_bytes(self.voltage_battery)
+
+    def _get_voltage_5v(self, data: bytes):
+        return float_to_bytes(self.voltage_5v)
+
+    def _get_rc_receiver_value(self, data: bytes):
+        return int16_to_bytes(self.rc_receiver_values[data[0]])
+
+    def _get_player_performance(self, data: bytes):
+        return int16_to_bytes(self.player_performance)
+
+    def _write_license_key(self, data: bytes):
+        if len(data) != 32:
+            raise DKSimulatorError(ERROR_BAD_PARAMS)
+
+        self.license_key = bytes(data)
+
+    # Params
+
+    def _get_param(self, data: bytes):
+        number = bytes_to_uint(data[0:2])
+        if number not in self.params:
+            raise DKSimulatorError(ERROR_NOT_FOUND)
+
+        return self.params[number]
+
+    def _set_param(self, data: bytes):
+        number = bytes_to_uint(data[0:2])
+        value = data[2:]
+        if number not in self.params:
+            raise DKSimulatorError(ERROR_NOT_FOUND)
+
+        size = len(self.params[number])
+        if size == 4:
+            if len(value) != 4:
+                raise DKSimulatorError(ERROR_BAD_PARAMS)
+            bytes_to_float(value)
+        elif size == 1:
+            value = value[0:1]
+        elif len(value) != size:
+            raise DKSimulatorError(ERROR_BAD_PARAMS)
+
+        self.params[number] = bytes(value)
+
+    def _save_params(self, data: bytes):
+        self.saved_params = dict(self.params)
+
+    def _reset_params(self, data: bytes):
+        self.params = default_params()
+
+    # Sounds
+
+    def _write_sound_info(self, data: bytes):
+        number = bytes_to_uint(data[0:2])
+        sound_id = bytes_to_uint(data[2:4])
+        size = bytes_to_uint(data[4:8])
+        pos = self._allocate_sound(number, size)
+
+        slot = SoundSlot(sound_id, size, pos)
+        if len(data) >= 12:
+            slot.model_id = bytes_to_uint(data[8:10])
+            slot.version_major = data[10]
+            slot.version_minor = data[11]
+
+        self.external_flash.erase(pos, size)
+        self.sounds[number] = slot
+
+    def _allocate_sound(self, number: int, size: int) -> int:
+        page_size = self.external_flash.page_size
+        pos = 0
+        for other_number, slot in sorted(self.sounds.items(), key=lambda item: item[1].pos):
+            if other_number == number:
+                continue
+            if pos + size <= slot.pos:
+                break
+            pos = max(pos, -(-(slot.pos + slot.size) // page_size) * page_size)
+
+        if pos + size > self.external_flash.size:
+            raise DKSimulatorError(ERROR_FLASH)
+
+        return pos
+
+    def _write_sound_file(self, data: bytes):
+        number = bytes_to_uint(data[0:2])
+        pos = bytes_to_uint(data[2:6])
+        block = data[6:]
+        slot = self.sounds.get(number)
+        if not slot or pos + len(block) > slot.size:
+            raise DKSimulatorError(ERROR_BAD_PARAMS)
+
+        if len(block) > self.max_block_size:
+            raise DKSimulatorError(ERROR_BAD_PARAMS)
+
+        self.external_flash.write(slot.pos + pos, block)
+        return data[2:6] if self.echo_position else None
+
+    def _get_sound_info(self, data: bytes):
+        slot = self.sounds.get(bytes_to_uint(data[0:2]))
+        if not slot:
+            raise DKSimulatorError(ERROR_NOT_FOUND)
+
+        return slot.pack()
+
+    def _reset_sounds(self, data: bytes):
+        self.sounds = {}
+
+    # System
+
+    def _write_hardware_version(self, data: bytes):
+        self.hardware_version = tuple(bytes_to_uint(data[i:i + 2]) for i in range(0, 8, 2))
+
+    def _read_flash(self, data: bytes):
+        addr = bytes_to_uint(data[0:4])
+        length = bytes_to_uint(data[4:6])
+        return self.external_flash.read(addr, length)
+
+    def _get_rdp_level(self, data: bytes):
+        return int8_to_bytes(self.rdp_level)
+
+    def _set_rdp_level(self, data: bytes):
+        self.rdp_level = data[0]
@@ -0,0 +1,187 @@
+import json
+import logging
+import os
+
+import numpy
+
+from .common import DKCommonCommands, SoundFile, SoundInfo
+
+
+SWEEP_CHUNK = 16
+READ_ATTEMPTS = 2
+DEFAULT_SOUND_SLOTS = 256
+SOUND_PAGE_SIZE = 4096
+
+# The GET_SOUND_INFO response layout of the command schema, in SoundInfo field order
+SOUND_INFO_FIELDS = ('id', 'size', 'pos', 'model_id', 'version_major', 'version_minor')
+SOUND_INFO_DTYPE = numpy.dtype([
+    (name, '<' + code) for name, code in zip(
+        SOUND_INFO_FIELDS, DKCommonCommands.SCHEMA[DKCommonCommands.COMMAND_GET_SOUND_INFO].response.format[1:])
+])
+
+SOUND_TABLE_DTYPE = numpy.dtype([('number', '<u2')] +
+                                [(name, SOUND_INFO_DTYPE[name]) for name in SOUND_INFO_DTYPE.names])
+
+
+def load_manifest(file_name: str) -> list:
+    # JSON manifest, file names are relative to the manifest:
+    #   {"sounds": [{"slot": 0, "file": "engine.wav", "id": 1, "model": 2, "version": [1, 0]}]}
+    with open(file_name) as manifest_file:
+        manifest = json.load(manifest_file)
+
+    base_dir = os.path.dirname(os.path.abspath(file_name))
+    sounds = []
+    for entry in manifest['sounds']:
+        version = entry.get('version', (0, 0))
+        sounds.append(SoundFile(int(entry['slot']), os.path.join(base_dir, entry['file']), int(entry['id']),
+                                int(entry.get('model', 0)), int(version[0]), int(version[1])))
+
+    numbers = [sound.number for sound in sounds]
+    if len(set(numbers)) != len(numbers):
+        raise ValueError('Duplicate sound slots in manifest: {}'.format(file_name))
+
+    return sounds
+
+
+class SoundTable:
+    # Sound slots of a device, one row per used slot, sorted by slot number.
+    # Slots are read in sweeps of pipelined requests, all responses are
+    # unpacked at once.
+
+    def __init__(self, sounds: numpy.ndarray = None):
+        self.sounds = sounds if sounds is not None else numpy.zeros(0, dtype=SOUND_TABLE_DTYPE)
+
+    @classmethod
+    def load(cls, cmd: DKCommonCommands, count: int = DEFAULT_SOUND_SLOTS) -> 'SoundTable':
+        return cls.read(cmd, range(count))
+
+    @classmethod
+    def read(cls, cmd: DKCommonCommands, numbers) -> 'SoundTable':
+        # Empty slots are answered with an error code, they are left out
+        numbers = list(numbers)
+        responses = []
+        for pos in range(0, len(numbers), SWEEP_CHUNK):
+            chunk = numbers[pos:pos + SWEEP_CHUNK]
+            spec = cmd.SCHEMA[cmd.COMMAND_GET_SOUND_INFO]
+            packages = [(cmd.COMMAND_GET_SOUND_INFO, spec.encode(number)) for number in chunk]
+            responses += cmd.connect.exchange_many(packages, retry=READ_ATTEMPTS, is_silent=True)
+
+        table = cls.unpack(numbers, responses)
+        logging.info('Sound slots loaded: {} of {}'.format(len(table), len(numbers)))
+        return table
+
+    @classmethod
+    def unpack(cls, numbers: list, responses: list) -> 'SoundTable':
+        size = SOUND_INFO_DTYPE.itemsize
+        used = [(number, data) for number, data in zip(numbers, responses) if data]
+        # Short responses of older firmware have no model and version
+        data = b''.join(bytes(data[:size]).ljust(size, b'\0') for _, data in used)
+        infos = numpy.frombuffer(data, dtype=SOUND_INFO_DTYPE)
+
+        sounds = numpy.zeros(len(used), dtype=SOUND_TABLE_DTYPE)
+        sounds['number'] = [number for number, _ in used]
+        for name in SOUND_INFO_DTYPE.names:
+            sounds[name] = infos[name]
+
+        return cls(numpy.sort(sounds, order='number'))
+
+    def __len__(self):
+        return len(self.sounds)
+
+    def __contains__(self, number: int):
+        return self._index(number) is not None
+
+    def numbers(self) -> list:
+        return self.sounds['number'].tolist()
+
+    def info(self, number: int) -> SoundInfo:
+        index = self._index(number)
+        if index is None:
+            return None
+
+        sound = self.sounds[index]
+        return SoundInfo(*(int(sound[name]) for name in SOUND_INFO_DTYPE.names))
+
+    def find(self, sound_id: int) -> list:
+        # Slot numbers holding the sound id
+        return self.sounds['number'][self.sounds['id'] == sound_id].tolist()
+
+    def used_space(self, page_size: int = SOUND_PAGE_SIZE) -> int:
+        # Sounds are placed on page boundaries
+        sizes = self.sounds['size'].astype(numpy.int64)
+        return int((-(-sizes // page_size) * page_size).sum())
+
+    def free_ranges(self, flash_size: int, page_size: int = SOUND_PAGE_SIZE) -> list:
+        # (pos, size) of the gaps between sounds, in flash order
+        sounds = numpy.sort(self.sounds[self.sounds['size'] > 0], order='pos')
+        starts = sounds['pos'].astype(numpy.int64)
+        ends = -(-(starts + sounds['size']) // page_size) * page_size
+        # Overlapping sounds must not move the end backwards
+        ends = numpy.maximum.accumulate(ends) if len(ends) else ends
+
+        gap_starts = numpy.concatenate(([0], ends))
+        gap_ends = numpy.concatenate((starts, [flash_size]))
+        sizes = gap_ends - gap_starts
+        return [(int(pos), int(size)) for pos, size in zip(gap_starts[sizes > 0], sizes[sizes > 0])]
+
+    def free_space(self, flash_size: int, page_size: int = SOUND_PAGE_SIZE) -> int:
+        return sum(size for _, size in self.free_ranges(flash_size, page_size))
+
+    def largest_free(self, flash_size: int, page_size: int = SOUND_PAGE_SIZE) -> int:
+        # The largest sound that fits without moving others
+        return max((size for _, size in self.free_ranges(flash_size, page_size)), default=0)
+
+    def to_list(self) -> list:
+        return [dict(zip(SOUND_TABLE_DTYPE.names, sound)) for sound in self.sounds.tolist()]
+
+    def _index(self, number: int):
+        index = numpy.searchsorted(self.sounds['number'], number)
+        if index < len(self.sounds) and self.sounds['number'][index] == number:
+            return int(index)
+        return None
+
+
+class SoundBankSync:
+    # Brings the device sounds to a manifest: the slots are read in one sweep of
+    # pipelined requests, only the sounds that differ in id, size, model or
+    # version are uploaded, all of them in one pipelined session.
+
+    def __init__(self, cmd: DKCommonCommands, sounds: list):
+        self.cmd = cmd
+        self.sounds = sounds
+        self.device_sounds = SoundTable()
+
+    def read_device(self) -> SoundTable:
+        self.device_sounds = SoundTable.read(self.cmd, [sound.number for sound in self.sounds])
+        return self.device_sounds
+
+    def changed(self) -> list:
+        return [sound for sound in self.sounds if not self.is_present(sound)]
+
+    def is_present(self, sound: SoundFile) -> bool:
+        info = self.device_sounds.info(sound.number)
+        if info is None or info.get_id() != sound.sound_id or info.size != sound.size():
+            return False
+
+        # Model and version are written only to firmware that takes the long sound info
+        return (not self.cmd.is_long_sound_info or
+                info.model_id == sound.model_id and
+                (info.version_major, info.version_minor) == (sound.version_major, sound.version_minor))
+
+    def run(self, force: bool = False, **kwargs) -> list:
+        # Returns the uploaded slot numbers, kwargs go to write_sound_files
+        if force:
+            sounds = list(self.sounds)
+        else:
+            self.read_device()
+            sounds = self.changed()
+
+        logging.info('Sound bank: {} of {} sounds to upload'.format(len(sounds), len(self.sounds)))
+        if sounds:
+            self.cmd.write_sound_files(sounds, **kwargs)
+
+        return [sound.number for sound in sounds]
+
+
+def sync_sound_bank(cmd: DKCommonCommands, manifest_file: str, force: bool = False, **kwargs) -> list:
+    return SoundBankSync(cmd, load_manifest(manifest_file)).run(force, **kwargs)
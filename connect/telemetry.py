@@ -0,0 +1,253 @@
+import csv
+import logging
+import struct
+import threading
+import time
+
+import numpy
+
+from .common import DKCommonCommands
+from .connect import DKConnectDisconnectedError, DKConnectError
+
+
+RING_CAPACITY = 1 << 16
+RC_CHANNELS = 8
+
+BINARY_MAGIC = b'DKTL'
+BINARY_VERSION = 1
+
+SAMPLE_DTYPE = numpy.dtype([
+    ('time', '<f8'),
+    ('channel', '<u2'),
+    ('value', '<f8'),
+])
+
+
+class TelemetryChannel:
+    # The response is decoded by the command schema unless parse is given
+
+    def __init__(self, name: str, command: int, params: bytes = None, parse=None, rate: float = 10.0):
+        self.name = name
+        self.command = command
+        self.params = params
+        self.parse = parse or DKCommonCommands.SCHEMA[command].decode
+        self.rate = rate
+        self.next_time = 0.0
+
+
+def default_channels(rate: float = 10.0, rc_rate: float = 50.0, rc_channels: int = RC_CHANNELS) -> list:
+    channels = [
+        TelemetryChannel('voltage_battery', DKCommonCommands.COMMAND_GET_VOLTAGE_BATTERY, rate=rate),
+        TelemetryChannel('voltage_5v', DKCommonCommands.COMMAND_GET_VOLTAGE_5V, rate=rate),
+        TelemetryChannel('free_mem', DKCommonCommands.COMMAND_GET_FREE_MEM, rate=rate),
+        TelemetryChannel('player_performance', DKCommonCommands.COMMAND_GET_PLAYER_PERFORMANCE, rate=rate),
+    ]
+
+    rc_spec = DKCommonCommands.SCHEMA[DKCommonCommands.COMMAND_GET_RC_RECEIVER_VALUE]
+    for channel in range(rc_channels):
+        channels.append(TelemetryChannel('rc_{}'.format(channel), DKCommonCommands.COMMAND_GET_RC_RECEIVER_VALUE,
+                                         rc_spec.encode(channel), rate=rc_rate))
+
+    return channels
+
+
+class TelemetryRingBuffer:
+    # Fixed-size sample store, the oldest samples are overwritten when full.
+    # Each sample is (time, channel index, value).
+
+    def __init__(self, capacity: int = RING_CAPACITY):
+        self.capacity = capacity
+        self.samples = numpy.zeros(capacity, dtype=SAMPLE_DTYPE)
+        self.total = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return min(self.total, self.capacity)
+
+    def dropped(self) -> int:
+        return self.total - len(self)
+
+    def clear(self):
+        with self._lock:
+            self.total = 0
+
+    def append(self, timestamp: float, channel: int, value: float):
+        with self._lock:
+            self.samples[self.total % self.capacity] = (timestamp, channel, value)
+            self.total += 1
+
+    def extend(self, samples: numpy.ndarray):
+        samples = samples[-self.capacity:]
+        with self._lock:
+            pos = self.total % self.capacity
+            head = min(len(samples), self.capacity - pos)
+            self.samples[pos:pos + head] = samples[:head]
+            self.samples[:len(samples) - head] = samples[head:]
+            self.total += len(samples)
+
+    def array(self) -> numpy.ndarray:
+        # Ordered copy, oldest sample first
+        with self._lock:
+            if self.total <= self.capacity:
+                return self.samples[:self.total].copy()
+
+            pos = self.total % self.capacity
+            return numpy.concatenate((self.samples[pos:], self.samples[:pos]))
+
+    def channel(self, channel: int) -> (numpy.ndarray, numpy.ndarray):
+        samples = self.array()
+        samples = samples[samples['channel'] == channel]
+        return samples['time'], samples['value']
+
+
+class TelemetrySampler:
+    # Polls telemetry channels, each at its own rate. All reads that are due are sent
+    # as one pipelined batch, the batch receive time is the timestamp of its samples.
+    # Times are seconds from start().
+
+    def __init__(self, cmd: DKCommonCommands, channels: list = None, capacity: int = RING_CAPACITY):
+        self.cmd = cmd
+        self.channels = channels if channels is not None else default_channels()
+        self.buffer = TelemetryRingBuffer(capacity)
+        self.errors = 0
+
+        self._start_time = None
+        self._thread = None
+        self._is_running = False
+
+    def channel_index(self, name: str) -> int:
+        for index, channel in enumerate(self.channels):
+            if channel.name == name:
+                return index
+
+        raise KeyError(name)
+
+    def channel(self, name: str) -> (numpy.ndarray, numpy.ndarray):
+        return self.buffer.channel(self.channel_index(name))
+
+    def start(self):
+        self._reset()
+        self._is_running = True
+        self._thread = threading.Thread(target=self._loop, name='dk-telemetry', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._is_running = False
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    def run(self, duration: float):
+        # Blocking sampling in the calling thread
+        self._reset()
+        self._is_running = True
+        deadline = time.monotonic() + duration
+        try:
+            while time.monotonic() < deadline:
+                self.sample(deadline)
+        finally:
+            self._is_running = False
+
+    def sample(self, deadline: float = None) -> int:
+        # Waits for the next due channels, reads them and returns the number of samples
+        if self._start_time is None:
+            self._reset()
+
+        next_time = min(channel.next_time for channel in self.channels)
+        if deadline is not None and next_time > deadline:
+            time.sleep(max(0.0, deadline - time.monotonic()))
+            return 0
+
+        delay = next_time - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+        now = time.monotonic()
+        due = [index for index, channel in enumerate(self.channels) if channel.next_time <= now]
+        for index in due:
+            channel = self.channels[index]
+            # Skip missed ticks instead of bursting to catch up
+            channel.next_time = max(channel.next_time + 1 / channel.rate, now)
+
+        packages = [(self.channels[index].command, self.channels[index].params) for index in due]
+        responses = self.cmd.connect.exchange_many(packages, is_silent=True)
+        timestamp = time.monotonic() - self._start_time
+
+        samples = numpy.zeros(len(due), dtype=SAMPLE_DTYPE)
+        count = 0
+        for index, data in zip(due, responses):
+            if data is None:
+                self.errors += 1
+                continue
+
+            samples[count] = (timestamp, index, self.channels[index].parse(data))
+            count += 1
+
+        self.buffer.extend(samples[:count])
+        return count
+
+    def export_csv(self, file_name: str):
+        samples = self.buffer.array()
+        with open(file_name, 'w', newline='') as file:
+            writer = csv.writer(file)
+            writer.writerow(['time', 'channel', 'value'])
+            for timestamp, channel, value in samples.tolist():
+                writer.writerow(['{:.6f}'.format(timestamp), self.channels[channel].name, value])
+
+        logging.info('Telemetry exported: {}, samples: {}'.format(file_name, len(samples)))
+
+    def export_binary(self, file_name: str):
+        # magic, version, channel count, channel names (u8 length + utf-8),
+        # sample count, then packed little-endian samples
+        samples = self.buffer.array()
+        with open(file_name, 'wb') as file:
+            file.write(BINARY_MAGIC)
+            file.write(struct.pack('<HH', BINARY_VERSION, len(self.channels)))
+            for channel in self.channels:
+                name = channel.name.encode('utf-8')
+                file.write(struct.pack('<B', len(name)) + name)
+
+            file.write(struct.pack('<I', len(samples)))
+            file.write(samples.tobytes())
+
+        logging.info('Telemetry exported: {}, samples: {}'.format(file_name, len(samples)))
+
+    def _reset(self):
+        self._start_time = time.monotonic()
+        self.errors = 0
+        for channel in self.channels:
+            channel.next_time = self._start_time
+
+    def _loop(self):
+        while self._is_running:
+            try:
+                self.sample(time.monotonic() + 0.1)
+            except DKConnectDisconnectedError:
+                logging.warning('Telemetry stopped, device disconnected')
+                self._is_running = False
+            except (DKConnectError, OSError):
+                # A lost batch is counted, the next tick samples again
+                self.errors += 1
+                logging.warning('Telemetry sampling error, errors: {}'.format(self.errors), exc_info=True)
+                if not self.cmd.connect.is_connect():
+                    self._is_running = False
+
+
+def load_binary(file_name: str) -> (list, numpy.ndarray):
+    with open(file_name, 'rb') as file:
+        if file.read(len(BINARY_MAGIC)) != BINARY_MAGIC:
+            raise ValueError('Not a telemetry file')
+
+        version, channel_count = struct.unpack('<HH', file.read(4))
+        if version != BINARY_VERSION:
+            raise ValueError('Unsupported telemetry version: {}'.format(version))
+
+        names = []
+        for _ in range(channel_count):
+            size = file.read(1)[0]
+            names.append(file.read(size).decode('utf-8'))
+
+        count, = struct.unpack('<I', file.read(4))
+        samples = numpy.frombuffer(file.read(count * SAMPLE_DTYPE.itemsize), dtype=SAMPLE_DTYPE)
+
+    return names, samples
@@ -0,0 +1,213 @@
+import logging
+import time
+from collections import deque
+from typing import Union
+
+from .connect import DKConnect, DKConnectCommandsMismatch, DKConnectCrcError, DKConnectGotErrorCode, \
+    DKConnectResponseTimoutError
+from .metrics import ERROR_CODE, ERROR_MISMATCH, ERROR_TIMEOUT
+from .utils import bytes_to_uint
+
+
+POSITION_SIZE = 4
+MIN_RECEIVE_TIMEOUT = 0.001
+
+# Largest first. The size field of a frame is 16 bit, so data must stay below 64K.
+BLOCK_SIZES = (1024, 512, 256, 128, 64, 32, 16)
+
+
+class TransferPart:
+    # stream tells apart the files of an upload of several (e.g. the sound number)
+    def __init__(self, pos: int, params: bytes, size: int, stream=None):
+        self.pos = pos
+        self.params = params
+        self.size = size
+        self.stream = stream
+        self.attempts = 0
+        self.sent_time = 0.0
+        # An earlier attempt may have been written, its answer was lost
+        self.is_uncertain = False
+
+
+def write_pipelined(connect: DKConnect, command: int, parts, window: int, retry: int, verify=None):
+    # Sliding window upload: up to `window` write frames are in flight at once.
+    # Acks are matched to parts by the echoed position when the device sends one.
+    # Without the echo an ack can not tell which part it belongs to: after a lost
+    # frame FIFO matching would resend parts that are already written. Until the
+    # first echoed ack only one part is in flight, the DK firmware does not echo.
+    # Every part has its own deadline from the connection retry policy. After a lost
+    # or corrupted answer the link is resynced and the parts in flight are uncertain:
+    # they are resent one at a time, so every answer belongs to its part. An error
+    # answer is an error, unless verify(part) reads back that an earlier attempt
+    # of the part was written. Failed parts are resent.
+    # Parts of several streams (e.g. sound files) may share positions, such a part
+    # waits until the other one is acked, so an echoed position is never ambiguous.
+    # Yields the number of bytes acknowledged by each ack.
+    # Answers that may still come when it ends are left to the next resync of the connection.
+    connect.sync()
+    policy = connect.retry_policy
+    parts = iter(parts)
+    in_flight = deque()
+    resend = deque()
+    waiting = None
+    is_parts_done = False
+    is_echo = False
+
+    try:
+        while True:
+            packages = []
+            while len(in_flight) < (window if is_echo else 1):
+                if in_flight and in_flight[-1].is_uncertain:
+                    break
+
+                if resend:
+                    if resend[0].is_uncertain and in_flight:
+                        break
+                    part = resend.popleft()
+                elif waiting is not None:
+                    part, waiting = waiting, None
+                elif not is_parts_done:
+                    part = next(parts, None)
+                    if part is None:
+                        is_parts_done = True
+                        continue
+                else:
+                    break
+
+                if any(other.pos == part.pos for other in in_flight):
+                    if part.attempts:
+                        resend.appendleft(part)
+                    else:
+                        waiting = part
+                    break
+
+                part.attempts += 1
+                if part.attempts > 1:
+                    connect.notify('on_retry', command, part.attempts)
+                part.sent_time = time.monotonic()
+                in_flight.append(part)
+                packages.append((command, part.params))
+
+            connect.send_many(packages)
+
+            if not in_flight:
+                return
+
+            head = in_flight[0]
+            timeout = head.sent_time + policy.timeout(command, head.attempts) - time.monotonic()
+            try:
+                receive_command, receive_data = connect.receive(max(timeout, MIN_RECEIVE_TIMEOUT))
+            except DKConnectResponseTimoutError as exc:
+                logging.warning('Upload timeout, resending {} parts'.format(len(in_flight)))
+                connect.notify('on_error', command, ERROR_TIMEOUT)
+                _resync(connect, in_flight, resend, retry, exc)
+                continue
+            except DKConnectCrcError as exc:
+                logging.warning('Upload answer corrupted, resending {} parts'.format(len(in_flight)))
+                _resync(connect, in_flight, resend, retry, exc)
+                continue
+
+            if receive_command == DKConnect.COMMAND_ERROR:
+                part = in_flight.popleft()
+                error_code = bytes_to_uint(receive_data)
+                if part.is_uncertain and verify is not None and verify(part):
+                    logging.info('Part at position {} was written by an earlier attempt, error: {}'.format(
+                        part.pos, error_code))
+                    part.is_uncertain = False
+                    yield part.size
+                    continue
+
+                logging.warning('Upload error {} at position {}'.format(error_code, part.pos))
+                connect.notify('on_error', command, ERROR_CODE, error_code)
+                _retry(resend, [part], retry, DKConnectGotErrorCode(error_code))
+                continue
+
+            if receive_command != command:
+                logging.warning("Mismatch commands. Expected: {}, received: {}".format(command, receive_command))
+                connect.notify('on_error', command, ERROR_MISMATCH)
+                raise DKConnectCommandsMismatch(command, receive_command)
+
+            is_echo = is_echo or _is_echo(receive_data)
+            part = _match_ack(in_flight, receive_data)
+            if part is None:
+                # Ack of a part that is not in flight
+                continue
+
+            # The device answers in order: the parts sent before this one lost their answers
+            while in_flight[0] is not part:
+                lost = in_flight.popleft()
+                logging.warning('Upload answer lost at position {}'.format(lost.pos))
+                connect.notify('on_error', command, ERROR_TIMEOUT)
+                lost.is_uncertain = True
+                _retry(resend, [lost], retry, DKConnectResponseTimoutError())
+
+            in_flight.popleft()
+            part.is_uncertain = False
+            rtt = time.monotonic() - part.sent_time
+            if part.attempts == 1:
+                policy.observe(command, rtt)
+            if connect.hooks:
+                connect.notify('on_exchange', command, rtt, part.attempts)
+            yield part.size
+
+    finally:
+        if in_flight:
+            connect.add_late_responses(len(in_flight))
+
+
+def negotiate_block_size(probe, block_sizes=BLOCK_SIZES) -> (int, int):
+    # probe(block_size) writes the first block of the upload with the given size
+    # and returns the number of bytes written. The device answers an oversized
+    # block with an error code, then the next smaller size is tried.
+    exchange_exception = None
+    for block_size in block_sizes:
+        try:
+            written = probe(block_size)
+        except DKConnectGotErrorCode as exc:
+            logging.info('Block size {} rejected, error: {}'.format(block_size, exc.error_code))
+            exchange_exception = exc
+            continue
+
+        logging.info('Block size: {}'.format(block_size))
+        return block_size, written
+
+    raise exchange_exception
+
+
+def _is_echo(data: bytes) -> bool:
+    return bool(data) and len(data) == POSITION_SIZE
+
+
+def _match_ack(in_flight: deque, data: bytes) -> Union[TransferPart, None]:
+    if _is_echo(data):
+        pos = bytes_to_uint(data)
+        for part in in_flight:
+            if part.pos == pos:
+                return part
+
+        return None
+
+    return in_flight[0]
+
+
+def _resync(connect: DKConnect, in_flight: deque, resend: deque, retry: int, exc: Exception):
+    # Answers still on the way can not be told apart from the answers to the resent
+    # parts, the resync drops them. The device answers in order, the lost answer is the
+    # oldest one: the other parts are resent without using up their attempts.
+    parts = list(in_flight)
+    in_flight.clear()
+    for part in parts:
+        part.is_uncertain = True
+    for part in parts[1:]:
+        part.attempts -= 1
+    _retry(resend, parts, retry, exc)
+    connect.resync()
+
+
+def _retry(resend: deque, parts: list, retry: int, exc: Exception):
+    for part in parts:
+        if part.attempts > retry:
+            logging.error('Upload failed at position {}'.format(part.pos))
+            raise exc
+
+        resend.append(part)
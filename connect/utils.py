@@ -1,6 +1,12 @@
+import hashlib
+import mmap
+import os
 import struct
 
 
+FILE_CHUNK_SIZE = 1 << 16
+
+
 def bytes_to_float(data: bytes) -> float:
     return struct.unpack('<f', data)[0]
 
@@ -22,4 +28,23 @@ def int32_to_bytes(value: int) -> bytes:
 
 
 def float_to_bytes(value: float) -> bytes:
-    return struct.pack("f", value)
\ No newline at end of file
+    return struct.pack("f", value)
+
+def map_file(file_name: str) -> memoryview:
+    # Read-only view of the whole file, slices of it are not copied.
+    # The mapping is closed when the last view is released.
+    with open(file_name, 'rb') as file:
+        if not os.fstat(file.fileno()).st_size:
+            return memoryview(b'')
+
+        return memoryview(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ))
+
+
+def file_md5(file_name: str, chunk_size: int = FILE_CHUNK_SIZE) -> bytes:
+    # Read in chunks, the file is closed when done
+    md5 = hashlib.md5()
+    with open(file_name, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            md5.update(chunk)
+
+    return md5.digest()
@@ -9,11 +9,14 @@ os.environ['QT_QPA_PLATFORM_PLUGIN_PATH'] = plugin_path
 from PySide2 import QtCore
 from PySide2 import QtWidgets
 
-from app.device_widget import DeviceWidget
-from app.device_worker import DeviceWorker
+from app.device_manager import DeviceManager
+from app.device_manager_widget import DeviceManagerWidget
 
 
 LOG_FILE = 'dk_app.log'
+# Set to a file name to record the device traffic, see connect/interfaces/capture.py.
+# Every port gets its own file, the port name is added to the file name.
+CAPTURE_ENV = 'DK_CAPTURE'
 
 
 class MainWindow(QtWidgets.QMainWindow):
@@ -21,11 +24,11 @@ class MainWindow(QtWidgets.QMainWindow):
     def __init__(self, *args, **kwargs):
         super(MainWindow, self).__init__(*args, **kwargs)
 
-        self.device_worker = DeviceWorker()
-        self.device_widget = DeviceWidget(self.device_worker)
-
+        # One worker per DK port, the manager starts them on this pool
         self.threadpool = QtCore.QThreadPool()
-        self.threadpool.start(self.device_worker)
+        self.device_manager = DeviceManager(self.threadpool, capture_file=os.environ.get(CAPTURE_ENV))
+        self.device_widget = DeviceManagerWidget(self.device_manager)
+        self.device_manager.start()
 
         self.setWindowTitle("DK App")
 
@@ -38,7 +41,7 @@ class MainWindow(QtWidgets.QMainWindow):
         self.setCentralWidget(widget)
 
     def closeEvent(self, event):
-        self.device_worker.stop()
+        self.device_manager.stop()
         super().closeEvent(event)
 
 
@@ -1,8 +1,10 @@
 import time
 
 from connect import DKConnect, build_commands
+from connect.device_cache import DeviceInfoCache, DEFAULT_CACHE_FILE
 
 con = DKConnect()
+con.info_cache = DeviceInfoCache(DEFAULT_CACHE_FILE)
 while True:
     if con.find_and_connect():
         break
@@ -11,12 +13,13 @@ while True:
 
 cmd = build_commands(con)
 
-print("uid:", cmd.get_uid().hex())
-print("name:", cmd.get_name())
-print("software:", cmd.get_software_version())
-print("hardware:", cmd.get_hardware_version())
-print("license key:", cmd.get_license_key().hex())
-print("access level:", cmd.get_access_level())
+info = cmd.get_general_info()
+print("uid:", info['uid'].hex())
+print("name:", info['name'])
+print("software:", info['software_version'])
+print("hardware:", info['hardware_version'])
+print("license key:", info['license_key'].hex())
+print("access level:", info['access_level'])
 
 print("free mem:", cmd.get_free_mem())
-print("voltage:", cmd.get_battery_voltage())
+print("voltage:", cmd.get_voltage_battery())